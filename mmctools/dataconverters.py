@@ -1,5 +1,10 @@
 import os
 import sys
+import time
+import json
+import hashlib
+import logging
+import tempfile
 import datetime as dt
 import numpy as np
 import xarray as xr
@@ -8,85 +13,201 @@ import pickle
 from mmctools.mmcdata import MMCData
 
 
-def convertMMCToPickle(pathbase,year,dataDir,pklDir):
+def convertMMCToPickle(pathbase,year,dataDir,pklDir,
+                       nprocs=None,check='mtime',verbose=True,**kwargs):
+    """Convert all legacy MMC files in pathbase/year/dataDir into
+    pickled MMCData objects in pathbase/year/pklDir. See
+    convert_directory() for a description of the optional arguments.
+    """
     inpath = os.path.join(pathbase,year,dataDir)
     outpath = os.path.join(pathbase,year,pklDir)
-    inDirContents = os.listdir(inpath)
-    print("inpath: {:s}".format(inpath))
-    print("--contains: {:d} files/directories".format(len(inDirContents)))    
-    for item in inDirContents:
-        print("\t{:s}".format(item))
-    print("\n")
-    outDirContents = os.listdir(outpath)
-    inCnt = 0
-    for fname in inDirContents:
-        fpath = os.path.join(inpath,fname)
-        if os.path.isdir(fpath):
-            print("STOP! You may need to manually recurse subdirectory-- {:s}\n".format(fname))
-        else:
-            print("pkl-izing MMC file-- {:s}".format(fname))
-            if (not fname.endswith('.dat')) and (not fname.endswith('.txt')):
-                raise IOError('input file has neither .dat nor .txt extension. Bailing out!!\n')
-            else:
-                name,_ = os.path.splitext(fpath)
-            if(name+".pkl" in outDirContents):
-                print("MMC file-- "+fname+" already pkl-ized!\n")
-            else:
-                db = MMCData(pklfile=fpath)
-                outfile = os.path.join(outpath,name+".pkl")
-                outfptr = open(outfile,'wb')
-                pickle.dump(db,outfptr)
-                outfptr.close()
-                print("MMC file-- "+fname+" now pkl-ized!\n")
-    print("Done pkl-izing input files! ")
-    print("outpath: {:s}".format(outpath))
-    outDirContents = os.listdir(outpath)
-    print("--contains: {:d} files/directories".format(len(outDirContents)))
-    for item in outDirContents:
-        print("\t{:s}".format(item))
-    print("\n")
-
-def convertMMCToXarrayNCDF(pathbase,year,dataDir,ncDir, **kwargs):
+    return convert_directory(inpath, outpath, _mmc_to_pickle, '.pkl',
+                             nprocs=nprocs, check=check, verbose=verbose,
+                             **kwargs)
+
+def convertMMCToXarrayNCDF(pathbase,year,dataDir,ncDir,
+                           nprocs=None,check='mtime',verbose=True,**kwargs):
+    """Convert all legacy MMC files in pathbase/year/dataDir into
+    netCDF files in pathbase/year/ncDir with MMCData.to_xarray(). See
+    convert_directory() for a description of the optional arguments.
+    """
     inpath = os.path.join(pathbase,year,dataDir)
     outpath = os.path.join(pathbase,year,ncDir)
-    inDirContents = os.listdir(inpath)
-    print("inpath: {:s}".format(inpath))
-    print("--contains: {:d} files/directories".format(len(inDirContents)))
-    for item in inDirContents:
-        print("\t{:s}".format(item))
-    print("\n")
-    outDirContents = os.listdir(outpath)
-    inCnt = 0
-    for fname in inDirContents:
+    return convert_directory(inpath, outpath, _mmc_to_netcdf, '.nc',
+                             nprocs=nprocs, check=check, verbose=verbose,
+                             **kwargs)
+
+
+### Batch conversion engine
+
+def convert_directory(inpath,outpath,converter,outext,
+                      extensions=('.dat','.txt'),
+                      nprocs=None,check='mtime',
+                      verbose=True,
+                      **kwargs):
+    """Convert all files in `inpath` with the specified extensions into
+    files in `outpath` (with the same name, but extension `outext`)
+    using a pool of `nprocs` processes (all cores by default). Other
+    files are not converted; these are logged with a warning and listed
+    as 'ignored' in the returned summary.
+
+    Each output is written to a temporary file that is renamed when
+    complete, so an interrupted batch may be safely restarted: files
+    are skipped if their output is already up to date, as determined by
+    `check`:
+    - 'mtime': output exists and is newer than the input
+    - 'hash': output exists and the sha256 of the input matches the
+      value recorded at the last conversion (in outpath/.manifest.json)
+    - 'exists': output exists
+
+    Parameters
+    ==========
+    converter : callable
+        A picklable function, converter(inputfile,outputfile,**kwargs),
+        e.g., _mmc_to_pickle or _mmc_to_netcdf
+    kwargs : optional
+        Passed to the converter
+
+    Returns a dictionary summarizing the conversion.
+    """
+    if check not in ('mtime','hash','exists'):
+        raise ValueError('Unknown staleness check: {:s}'.format(check))
+    os.makedirs(outpath, exist_ok=True)
+    manifest_path = os.path.join(outpath, '.manifest.json')
+    manifest = _read_manifest(manifest_path) if (check == 'hash') else {}
+
+    # select files to convert
+    todo = []
+    summary = dict(converted=[], skipped=[], failed=[], ignored=[])
+    for fname in sorted(os.listdir(inpath)):
         fpath = os.path.join(inpath,fname)
-        if os.path.isdir(fpath):
-            print("STOP! You may need to manually recurse subdirectory-- {:s}\n".format(fname))
+        name,ext = os.path.splitext(fname)
+        if os.path.isdir(fpath) or (ext not in extensions):
+            if not os.path.isdir(fpath):
+                logging.warning('Ignoring {:s}, expected extension {}'.format(
+                                fpath, ' or '.join(extensions)))
+            elif verbose:
+                print('Ignoring {:s}'.format(fpath))
+            summary['ignored'].append(fname)
+            continue
+        outfile = os.path.join(outpath, name+outext)
+        inputhash = _file_hash(fpath) if (check == 'hash') else None
+        if _is_current(fpath, outfile, check, manifest.get(fname), inputhash):
+            summary['skipped'].append(fname)
         else:
-            print("xarray/netcdf-izing MMC file-- {:s}".format(fname))
-            if (not fname.endswith('.dat')) and (not fname.endswith('.txt')):
-                raise IOError('input file has neither .dat nor .txt extension. Bailing out!!\n')
-            else:
-                name,fileExtension = os.path.splitext(fpath)
-                print(fileExtension)
-            if(name+".nc" in outDirContents):
-                print("MMC file-- "+fname+" already xarray/netcdf-ized!\n")
+            todo.append((fname, fpath, outfile, inputhash))
+    if verbose:
+        print('Converting {:d} of {:d} files in {:s} with {:s}'.format(
+              len(todo), len(todo)+len(summary['skipped']), inpath,
+              converter.__name__))
+
+    # convert files in parallel
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    totalbytes = 0
+    time0 = time.time()
+    with ProcessPoolExecutor(nprocs) as pool:
+        futures = {
+            pool.submit(_convert_file, converter, fpath, outfile, **kwargs): \
+                    (fname, inputhash)
+            for fname, fpath, outfile, inputhash in todo
+        }
+        for future in as_completed(futures):
+            fname, inputhash = futures[future]
+            try:
+                nbytes, elapsed = future.result()
+            except Exception:
+                logging.exception('Error while converting {:s}'.format(fname))
+                summary['failed'].append(fname)
             else:
-                db = MMCData(asciifile=fpath, **kwargs)
-                #Now make an xarrays object out of the db-dictionary/database
-                xrDS = db.to_xarray()
-                outfilename ="{:s}/{:s}.nc".format(outpath,fname.split(fileExtension)[0])
-                print(outfilename)
-                xrDS.to_netcdf(outfilename,
-                               unlimited_dims='Times',
-                               encoding={
-                                  'datetime':{'units': 'seconds since 1970-01-01 00:00:00.0'}
-                               })
-                print("MMC file-- "+fname+" now xarray'd!\n")
-    print("Done xarray/netcdf-izing input files! ")
-    print("outpath: {:s}".format(outpath))
-    outDirContents = os.listdir(outpath)
-    print("--contains: {:d} files/directories".format(len(outDirContents)))
-    for item in outDirContents:
-        print("\t{:s}".format(item))
-    print("\n")
+                totalbytes += nbytes
+                summary['converted'].append(fname)
+                if check == 'hash':
+                    manifest[fname] = inputhash
+                    _write_manifest(manifest_path, manifest)
+                if verbose:
+                    print('  {:s} converted in {:g}s'.format(fname,elapsed))
+    totaltime = time.time() - time0
+
+    summary['bytes'] = totalbytes
+    summary['time'] = totaltime
+    if verbose:
+        rate = totalbytes / 1024.**2 / totaltime if (totaltime > 0) else 0.
+        print('{:d} converted, {:d} skipped, {:d} failed'.format(
+              len(summary['converted']), len(summary['skipped']),
+              len(summary['failed'])))
+        print('{:.1f} MB read in {:g}s ({:.2f} MB/s, {:.2f} files/s)'.format(
+              totalbytes/1024.**2, totaltime, rate,
+              len(summary['converted'])/max(totaltime,1e-12)))
+    return summary
+
+def _convert_file(converter,fpath,outfile,**kwargs):
+    """Called by convert_directory() in a worker process; the output is
+    written to a temporary file and renamed to outfile when complete.
+    """
+    time0 = time.time()
+    outdir, outname = os.path.split(outfile)
+    _,ext = os.path.splitext(outname)
+    fd, tmpfile = tempfile.mkstemp(prefix='.'+outname+'.', suffix=ext,
+                                   dir=outdir)
+    os.close(fd)
+    try:
+        converter(fpath, tmpfile, **kwargs)
+        # mkstemp creates the file readable only by the owner
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmpfile, 0o666 & ~umask)
+        os.replace(tmpfile, outfile)
+    finally:
+        if os.path.isfile(tmpfile):
+            os.remove(tmpfile)
+    return os.path.getsize(fpath), time.time()-time0
+
+def _is_current(fpath,outfile,check,lasthash=None,inputhash=None):
+    if not os.path.isfile(outfile):
+        return False
+    if check == 'mtime':
+        return os.path.getmtime(outfile) >= os.path.getmtime(fpath)
+    elif check == 'hash':
+        return (lasthash is not None) and (lasthash == inputhash)
+    else:
+        return True
+
+def _file_hash(fpath,blocksize=2**20):
+    sha = hashlib.sha256()
+    with open(fpath,'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def _read_manifest(fpath):
+    try:
+        with open(fpath,'r') as f:
+            return json.load(f)
+    except (IOError,ValueError):
+        return {}
+
+def _write_manifest(fpath,manifest):
+    tmpfile = fpath + '.tmp'
+    with open(tmpfile,'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmpfile, fpath)
+
+
+### Converters for use with convert_directory()
+
+def _mmc_to_pickle(fpath,outfile,**kwargs):
+    db = MMCData(asciifile=fpath, **kwargs)
+    with open(outfile,'wb') as f:
+        pickle.dump(db,f)
 
+def _mmc_to_netcdf(fpath,outfile,**kwargs):
+    from mmctools.datawriters import write_dataset
+    db = MMCData(asciifile=fpath, **kwargs)
+    #Now make an xarrays object out of the db-dictionary/database
+    xrDS = db.to_xarray()
+    write_dataset(xrDS, outfile,
+                  profile='profile',
+                  unlimited_dims='Times',
+                  encoding={
+                     'datetime':{'units': 'seconds since 1970-01-01 00:00:00.0'}
+                  })
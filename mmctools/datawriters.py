@@ -1,6 +1,9 @@
 """
 Standardized data output routines
 """
+import os
+import glob
+import time
 from datetime import datetime
 import numpy as np
 from netCDF4 import Dataset
@@ -10,11 +13,332 @@ standard_datetime_fmt = '%Y-%m-%d %H:%M:%S'
 # for netCDF output
 core_variables = ['Times','u','v','w','wspd','wdir','T','p','theta','RH']
 
+# dimensions treated as time for chunking
+time_dim_names = ['datetime','Times','Time','time','t']
+
+# target number of values per chunk (1 MiB of float64)
+chunk_target_size = 2**17
+
+# chunk shapes tuned for the expected access pattern
+# - 'timeseries': long records at a single point/level
+# - 'profile': all levels (and points) at a few times
+encoding_profiles = ['timeseries','profile']
+
+
+# WRF point extraction for wrf_to_netcdf
+wrf_surface_fields = ['HFX','PBLH','PSFC','UST','U10','V10','T2','TH2','SWDOWN']
+wrf_profile_fields = ['u','v','w','wspd','wdir','theta','p','qv']
+wrf_units = {
+    'HFX': 'W m-2', 'PBLH': 'm', 'PSFC': 'Pa', 'UST': 'm s-1',
+    'U10': 'm s-1', 'V10': 'm s-1', 'T2': 'K', 'TH2': 'K', 'SWDOWN': 'W m-2',
+    'u': 'm s-1', 'v': 'm s-1', 'w': 'm s-1', 'wspd': 'm s-1', 'wdir': 'deg',
+    'theta': 'K', 'p': 'Pa', 'qv': 'kg kg-1',
+}
+
 
 # TODO: consider deprecating `wrf.utils.WriteWRFdata2NCDF()`
 def wrf_to_netcdf(lat,lon,datadir,outputfile,dom=1,
-                  prefix='wrfout_d{:02d}_*00'):
-    print('This is a stub')
+                  prefix='wrfout_d{:02d}_*00',
+                  nprocs=None,resume=True,checkpoint=100,
+                  verbose=True,**kwargs):
+    """Extract surface variables and profiles closest to a lat/lon
+    from a series of WRF output files, and write them to a standardized
+    netCDF file with a NetCDFStreamWriter.
+
+    Files are found in `datadir` with the glob pattern `prefix`
+    (formatted with the domain number) and are processed in parallel by
+    a pool of `nprocs` processes (all cores by default). Every
+    `checkpoint` files, the output is flushed to disk and the completed
+    input files are listed in outputfile+'.extracted', followed by the
+    number of records committed to the output; if `resume` is True,
+    then a subsequent call will skip those files and continue writing
+    after the last committed record, overwriting any records that were
+    written after the last checkpoint.
+
+    Additional keyword arguments are passed to NetCDFStreamWriter.
+
+    Returns a dictionary of the wall time [s] spent in each stage.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from itertools import repeat
+    timings = {}
+
+    # discover files
+    time0 = time.time()
+    outputfile = outputfile.format(dom)
+    progressfile = outputfile + '.extracted'
+    wrfoutf = sorted(glob.glob(os.path.join(datadir,prefix.format(dom))))
+    assert len(wrfoutf) > 0, 'No files found matching '+prefix.format(dom)
+    done = []
+    nrecords = None
+    if resume and os.path.isfile(outputfile) and os.path.isfile(progressfile):
+        done, nrecords = _read_progress(progressfile)
+    done = set(done)
+    todo = [fpath for fpath in wrfoutf if fpath not in done]
+    timings['discover'] = time.time() - time0
+    if verbose:
+        print('Found {:d} files, {:d} already extracted'.format(
+              len(wrfoutf), len(wrfoutf)-len(todo)))
+    if len(todo) == 0:
+        return timings
+
+    # locate point and setup output
+    time0 = time.time()
+    i,j,heights,attrs = _locate_wrf_point(wrfoutf[0],lat,lon)
+    attrs['description'] = \
+            'Extracted using mmctools.datawriters.wrf_to_netcdf on {:s} from wrfout files located at {:s}'.format(
+                str(datetime.now()),datadir)
+    variables = dict([(varn,()) for varn in wrf_surface_fields]
+                     + [(varn,('height',)) for varn in wrf_profile_fields])
+    if len(done) > 0:
+        out = NetCDFStreamWriter(outputfile, variables, mode='a',
+                                 start=nrecords)
+        openmode = 'a'
+    else:
+        out = NetCDFStreamWriter(outputfile, variables,
+                                 dims={'height':heights},
+                                 units=wrf_units,
+                                 attrs=attrs,
+                                 **kwargs)
+        openmode = 'w'
+    timings['setup'] = time.time() - time0
+
+    # extract data in parallel and write in order
+    time0 = time.time()
+    timings['extract'] = 0.0 # cumulative time in workers
+    timings['write'] = 0.0
+    completed = []
+    with ProcessPoolExecutor(nprocs) as pool, \
+            open(progressfile, openmode) as progress:
+        results = pool.map(_extract_wrf_point, todo, repeat(i), repeat(j))
+        for fpath,(data,elapsed) in zip(todo,results):
+            timings['extract'] += elapsed
+            time1 = time.time()
+            times = data.pop('datetime')
+            out.append(times, **data)
+            completed.append(fpath)
+            if len(completed) >= checkpoint:
+                out.flush()
+                _write_progress(progress, completed, out.ntimes)
+                completed = []
+            timings['write'] += time.time() - time1
+        time1 = time.time()
+        out.flush()
+        _write_progress(progress, completed, out.ntimes)
+        out.close()
+        timings['write'] += time.time() - time1
+    timings['total'] = time.time() - time0 + timings['discover'] + timings['setup']
+    if verbose:
+        print('Extracted {:d} files: '.format(len(todo))
+              + ', '.join(['{:s} {:.2f}s'.format(stage,t)
+                           for stage,t in timings.items()]))
+    return timings
+
+def _write_progress(progress,completed,nrecords):
+    """Record the completed input files and the number of output
+    records committed to disk, called by wrf_to_netcdf()
+    """
+    progress.write(''.join(fpath+'\n' for fpath in completed))
+    progress.write('#records {:d}\n'.format(nrecords))
+    progress.flush()
+    os.fsync(progress.fileno())
+
+def _read_progress(progressfile):
+    """Return the list of completed input files and the number of
+    committed output records (None for progress files without record
+    counts); files listed after the last record count were not
+    committed
+    """
+    done, pending = [], []
+    nrecords = None
+    with open(progressfile,'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#records'):
+                done += pending
+                pending = []
+                nrecords = int(line.split()[1])
+            elif line != '':
+                pending.append(line)
+    if nrecords is None:
+        # older progress file, without record counts
+        done = pending
+    return done, nrecords
+
+def _locate_wrf_point(fpath,lat,lon):
+    """Find the grid indices closest to lat/lon and the heights of the
+    unstaggered levels there, called by wrf_to_netcdf()
+    """
+    from .wrf.utils import latlon_to_ij, get_height_at_ind
+    with Dataset(fpath) as wrfout:
+        i,j = latlon_to_ij(wrfout,lat,lon)
+        z,_ = get_height_at_ind(wrfout,j,i)
+        if z.ndim > 1:
+            z = z[0,:]
+        attrs = {
+            'location': '({:f}, {:f})'.format(wrfout.variables['XLAT'][0,j,i],
+                                              wrfout.variables['XLONG'][0,j,i]),
+            'elevation': '{:f} m'.format(wrfout.variables['HGT'][0,j,i]),
+        }
+    return i, j, np.asarray(z), attrs
+
+def _extract_wrf_point(fpath,i,j):
+    """Extract all times from a WRF output file at grid indices i,j,
+    called by wrf_to_netcdf() in a worker process
+    """
+    from netCDF4 import chartostring
+    from .wrf.utils import unstagger
+    time0 = time.time()
+    data = {}
+    with Dataset(fpath) as wrfout:
+        timestrs = chartostring(wrfout.variables['Times'][:])
+        data['datetime'] = np.array([np.datetime64(t.replace('_','T'))
+                                     for t in timestrs], dtype='datetime64[ns]')
+        for varn in wrf_surface_fields:
+            data[varn] = wrfout.variables[varn][:,j,i]
+        # U and V need to be interpolated to cell-center
+        u = unstagger(wrfout.variables['U'][:,:,j,i:i+2],axis=2)[:,:,0]
+        v = unstagger(wrfout.variables['V'][:,:,j:j+2,i],axis=2)[:,:,0]
+        data['u'] = u
+        data['v'] = v
+        # W needs to be unstaggered in the vertical direction
+        data['w'] = unstagger(wrfout.variables['W'][:,:,j,i],axis=1)
+        data['wspd'] = np.sqrt(u**2 + v**2)
+        data['wdir'] = 180. + np.degrees(np.arctan2(u, v))
+        # T is perturbation temp... need to add 300.0 K
+        data['theta'] = wrfout.variables['T'][:,:,j,i] + 300.0
+        # Pressure is perturbation + base
+        data['p'] = wrfout.variables['P'][:,:,j,i] \
+                  + wrfout.variables['PB'][:,:,j,i]
+        # Mixing ratio of water vapor
+        data['qv'] = wrfout.variables['QVAPOR'][:,:,j,i]
+    for varn in data.keys():
+        if isinstance(data[varn], np.ma.MaskedArray):
+            data[varn] = data[varn].filled(np.nan)
+    return data, time.time()-time0
+
+def get_encoding(ds,profile='timeseries',
+                 complevel=4,shuffle=True,
+                 float32=False,rtol=1e-5,
+                 backend='netcdf',
+                 encoding={}):
+    """Create an encoding dictionary for writing a standardized xarray
+    Dataset with to_netcdf() or to_zarr(), with chunking and
+    compression applied to all numeric variables.
+
+    Parameters
+    ==========
+    profile : str
+        Chunk-shape profile, one of `encoding_profiles`; 'timeseries'
+        chunks are long in time and contain one point along all other
+        dimensions, whereas 'profile' chunks span all other dimensions
+        and are short in time.
+    complevel : int
+        Compression level (0 to disable compression)
+    shuffle : bool
+        Apply the byte-shuffle filter before compression
+    float32 : bool
+        Store float64 data variables (not coordinates) as float32 if the
+        maximum roundoff error does not exceed rtol times the range of
+        the data; note that this check loads the data
+    backend : str
+        'netcdf' or 'zarr'
+    encoding : dict, optional
+        Per-variable encoding that overrides the generated values
+    """
+    if profile not in encoding_profiles:
+        raise ValueError('Unknown encoding profile: {:s}'.format(profile))
+    if backend == 'zarr':
+        compressor_key, compressor = _zarr_compressor(complevel, shuffle)
+    elif backend != 'netcdf':
+        raise ValueError('Unknown backend: {:s}'.format(backend))
+    varencoding = {}
+    for varname,var in ds.variables.items():
+        if (var.ndim == 0) or (var.dtype.kind not in 'iuf'):
+            continue
+        chunks = _chunk_shape(var.dims, var.shape, profile)
+        if backend == 'zarr':
+            enc = {'chunks': chunks}
+            if complevel > 0:
+                enc[compressor_key] = compressor
+        else:
+            enc = {'chunksizes': chunks,
+                   'zlib': (complevel > 0),
+                   'complevel': complevel,
+                   'shuffle': shuffle}
+        if float32 and (varname in ds.data_vars) \
+                and (var.dtype == np.float64) \
+                and _float32_is_exact_enough(var.values, rtol):
+            enc['dtype'] = 'float32'
+        varencoding[varname] = enc
+    for varname,enc in encoding.items():
+        varencoding[varname] = dict(varencoding.get(varname,{}), **enc)
+    return varencoding
+
+def write_dataset(ds,fpath,profile='timeseries',
+                  complevel=4,shuffle=True,
+                  float32=False,rtol=1e-5,
+                  encoding={},
+                  **kwargs):
+    """Write out a standardized xarray Dataset with chunking and
+    compression from get_encoding(). The backend is selected from the
+    file extension: zarr for '.zarr', netCDF otherwise.
+
+    Additional keyword arguments are passed to to_netcdf() or to_zarr().
+    """
+    backend = 'zarr' if fpath.rstrip('/').endswith('.zarr') else 'netcdf'
+    varencoding = get_encoding(ds, profile=profile,
+                               complevel=complevel, shuffle=shuffle,
+                               float32=float32, rtol=rtol,
+                               backend=backend, encoding=encoding)
+    if backend == 'zarr':
+        kwargs['mode'] = kwargs.get('mode','w')
+        return ds.to_zarr(fpath, encoding=varencoding, **kwargs)
+    else:
+        return ds.to_netcdf(fpath, encoding=varencoding, **kwargs)
+
+def _chunk_shape(dims,shape,profile):
+    """Chunk sizes for a variable, called by get_encoding()"""
+    itime = [i for i,dim in enumerate(dims) if dim in time_dim_names]
+    if len(itime) == 0:
+        # not time-varying
+        return tuple(int(max(1,n)) for n in shape)
+    itime = itime[0]
+    if profile == 'timeseries':
+        chunks = [1 for _ in shape]
+    else:
+        chunks = list(shape)
+    otherdims = max(1, int(np.prod(chunks)) // max(1,chunks[itime]))
+    chunks[itime] = min(shape[itime], max(1, chunk_target_size // otherdims))
+    return tuple(int(max(1,n)) for n in chunks)
+
+def _zarr_compressor(complevel,shuffle):
+    """Blosc/zstd compressor encoding for the installed zarr version,
+    called by get_encoding()
+    """
+    import zarr
+    if int(zarr.__version__.split('.')[0]) >= 3:
+        from zarr.codecs import BloscCodec
+        codec = BloscCodec(cname='zstd', clevel=complevel,
+                           shuffle=('shuffle' if shuffle else 'noshuffle'))
+        return 'compressors', (codec,)
+    else:
+        from numcodecs import Blosc
+        codec = Blosc(cname='zstd', clevel=complevel,
+                      shuffle=(Blosc.SHUFFLE if shuffle else Blosc.NOSHUFFLE))
+        return 'compressor', codec
+
+def _float32_is_exact_enough(values,rtol):
+    """Check that float32 roundoff is small compared with the range of
+    the data, called by get_encoding()
+    """
+    values = np.asarray(values)
+    with np.errstate(over='ignore', invalid='ignore'):
+        err = np.abs(values.astype(np.float32).astype(np.float64) - values)
+    if not np.all(np.isfinite(err[np.isfinite(values)])):
+        return False # out of float32 range
+    valrange = np.nanmax(values) - np.nanmin(values) if values.size > 0 else 0
+    return np.nanmax(err, initial=0) <= rtol * valrange
 
 # TODO: rename `write_to_netCDF` to `dict_to_netcdf`
 def write_to_netCDF(nc_filename, data,
@@ -42,11 +366,13 @@ def write_to_netCDF(nc_filename, data,
                                                data['vardtype'][vv],
                                                data['vardims'][vv],
                                                fill_value=data['fillValue'])
-                newvar[:] = data['data'][vv]
-                if verbose:
-                    print(varname)
-                    print(newvar[newvar == np.nan])
-                newvar[newvar == np.nan] = data['fillValue']
+                values = np.array(data['data'][vv])
+                if values.dtype.kind == 'f':
+                    isnan = np.isnan(values)
+                    if verbose:
+                        print(varname,'nan values:',np.count_nonzero(isnan))
+                    values[isnan] = data['fillValue']
+                newvar[:] = values
                 newvar.units = data['units'][vv]
     ncfile.createDimension('nchars',19)
     newvar[:] = data['time']
@@ -60,3 +386,215 @@ def write_to_netCDF(nc_filename, data,
     ncfile.createdby   = data['author']
     ncfile.close()
 
+
+
+class NetCDFStreamWriter(object):
+    """Write a standardized netCDF file incrementally, e.g., from a long
+    instrument record that does not fit in memory. The file is created
+    once with an unlimited time dimension; batches of records are added
+    with append() and written in whole (compressed) chunks, so memory
+    usage is bounded by the chunk size.
+
+    Example:
+        with NetCDFStreamWriter('tower.nc',
+                                dims={'height': [10.,50.,100.]},
+                                variables={'wspd':('height',),
+                                           'wdir':('height',)},
+                                units={'wspd':'m/s','wdir':'deg'}) as out:
+            for df in data_chunks:
+                out.append(times, wspd=..., wdir=...)
+    """
+    def __init__(self,fpath,variables,dims={},units={},
+                 timedim='datetime',
+                 time_units='microseconds since 1970-01-01 00:00:00',
+                 dtype=np.float64,fill_value=-999.0,
+                 profile='timeseries',complevel=4,shuffle=True,
+                 ncformat='NETCDF4',attrs={},
+                 mode='w',start=None):
+        """Create a new netCDF file
+
+        Parameters
+        ==========
+        variables : dict
+            Pairs of variable names and dimensions, excluding the time
+            dimension, e.g., ('height',) or () for a scalar time series
+        dims : dict
+            Pairs of non-time dimension names and coordinate values
+        units : dict, optional
+            Pairs of variable names and units
+        time_units : str, optional
+            CF time units; times are stored as 64-bit integers (or as
+            floats in netCDF3 classic/64-bit offset files) so that the
+            timestamps of high-rate data are exact to the unit
+        profile, complevel, shuffle : optional
+            Chunking and compression, as in get_encoding()
+        attrs : dict, optional
+            Global attributes
+        mode : str, optional
+            'w' to create a new file or 'a' to append records to an
+            existing file written by a NetCDFStreamWriter, in which case
+            the file layout is taken from the existing file
+        start : int, optional
+            In append mode, the index at which to write the next record;
+            by default, records are added after the existing ones.
+            Existing records from this index on are overwritten, or set
+            to the fill value on close() if they are not.
+        """
+        self.fpath = fpath
+        self.timedim = timedim
+        self.fill_value = fill_value
+        self.variables = variables
+        if mode == 'a':
+            self._open_existing(fpath, start)
+            return
+        self.ncfile = Dataset(fpath, 'w', format=ncformat, clobber=True)
+        self.ncfile.createDimension(timedim, None)
+        if ncformat in ('NETCDF3_CLASSIC','NETCDF3_64BIT_OFFSET'):
+            # no 64-bit integers
+            timevar = self.ncfile.createVariable(timedim, np.float64, (timedim,),
+                                                 fill_value=np.nan)
+        else:
+            timevar = self.ncfile.createVariable(timedim, np.int64, (timedim,),
+                                                 fill_value=np.iinfo(np.int64).min)
+        timevar.units = time_units
+        self._timedtype = timevar.dtype
+        self._epoch, self._timescale = _parse_time_units(time_units)
+        for dimname,coord in dims.items():
+            coord = np.asarray(coord)
+            self.ncfile.createDimension(dimname, len(coord))
+            coordvar = self.ncfile.createVariable(dimname, coord.dtype, (dimname,))
+            coordvar[:] = coord
+        # determine time chunk length from the chunk profile
+        self.chunklen = chunk_target_size
+        for varname,vardims in variables.items():
+            shape = [chunk_target_size] + [len(self.ncfile.dimensions[dim])
+                                           for dim in vardims]
+            chunks = _chunk_shape((timedim,)+tuple(vardims), shape, profile)
+            self.chunklen = min(self.chunklen, chunks[0])
+            newvar = self.ncfile.createVariable(varname, dtype,
+                                                (timedim,)+tuple(vardims),
+                                                zlib=(complevel > 0),
+                                                complevel=complevel,
+                                                shuffle=shuffle,
+                                                chunksizes=chunks,
+                                                fill_value=fill_value)
+            if varname in units:
+                newvar.units = units[varname]
+        for key,val in attrs.items():
+            self.ncfile.setncattr(key,val)
+        self.ncfile.createdon = datetime.now().strftime(standard_datetime_fmt)
+        self.ntimes = 0
+        self._buffer = []
+        self._buffered = 0
+
+    def _open_existing(self,fpath,start=None):
+        self.ncfile = Dataset(fpath, 'a')
+        timevar = self.ncfile.variables[self.timedim]
+        self._timedtype = timevar.dtype
+        self._epoch, self._timescale = _parse_time_units(timevar.units)
+        self.chunklen = chunk_target_size
+        for varname in self.variables.keys():
+            var = self.ncfile.variables[varname]
+            chunking = var.chunking()
+            if chunking not in (None,'contiguous'):  # (None for netCDF3)
+                self.chunklen = min(self.chunklen, chunking[0])
+            self.fill_value = getattr(var, '_FillValue', self.fill_value)
+        self.ntimes = len(self.ncfile.dimensions[self.timedim])
+        if start is not None:
+            assert 0 <= start <= self.ntimes, \
+                    'Cannot start at record {:d} of {:d}'.format(start,self.ntimes)
+            self.ntimes = start
+        self._buffer = []
+        self._buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def append(self,times,**data):
+        """Add a batch of records at the specified times (array-like of
+        datetimes or numeric values in the time units); keyword
+        arguments are arrays with leading dimension len(times) for each
+        variable. Variables that are not provided are set to the fill
+        value.
+        """
+        times = np.asarray(times)
+        if np.issubdtype(times.dtype, np.datetime64) or (times.dtype == object):
+            elapsed = times.astype('datetime64[ns]') - self._epoch
+            if self._timedtype.kind == 'i':
+                times = elapsed // self._timescale
+            else:
+                times = elapsed / self._timescale
+        elif self._timedtype.kind == 'i':
+            times = np.round(times)
+        batch = {self.timedim: times.astype(self._timedtype)}
+        for varname,values in data.items():
+            assert varname in self.variables, 'Unknown variable '+varname
+            values = np.asarray(values)
+            assert values.shape[0] == len(times), \
+                    '{:s} has inconsistent length'.format(varname)
+            batch[varname] = values
+        self._buffer.append(batch)
+        self._buffered += len(times)
+        if self._buffered >= self.chunklen:
+            self._write_buffer()
+
+    def flush(self):
+        """Write all buffered records to disk"""
+        self._write_buffer()
+        self.ncfile.sync()
+
+    def close(self):
+        if self.ncfile.isopen():
+            self._write_buffer()
+            self._clear_stale_records()
+            self.ncfile.close()
+
+    def _clear_stale_records(self):
+        """Set records past the last one written (left over from before
+        a restart) to the fill value, since the unlimited dimension
+        cannot be shortened; cleared times are set to the fill value
+        (decoded as NaT)
+        """
+        nstale = len(self.ncfile.dimensions[self.timedim]) - self.ntimes
+        if nstale <= 0:
+            return
+        print('Clearing {:d} stale records in {:s}'.format(nstale,self.fpath))
+        for varname in [self.timedim] + list(self.variables.keys()):
+            var = self.ncfile.variables[varname]
+            # (older files have no time _FillValue)
+            fill = getattr(var, '_FillValue', np.nan)
+            var[self.ntimes:] = np.full((nstale,)+var.shape[1:], fill, dtype=var.dtype)
+
+    def _write_buffer(self):
+        if self._buffered == 0:
+            return
+        i0, i1 = self.ntimes, self.ntimes + self._buffered
+        self.ncfile.variables[self.timedim][i0:i1] = \
+                np.concatenate([batch[self.timedim] for batch in self._buffer])
+        for varname in self.variables.keys():
+            var = self.ncfile.variables[varname]
+            values = np.concatenate([
+                batch[varname] if varname in batch
+                else np.full((len(batch[self.timedim]),)+var.shape[1:],
+                             self.fill_value)
+                for batch in self._buffer
+            ]).astype(var.dtype)
+            if values.dtype.kind == 'f':
+                values[np.isnan(values)] = self.fill_value
+            var[i0:i1] = values
+        self.ntimes = i1
+        self._buffer = []
+        self._buffered = 0
+
+
+def _parse_time_units(time_units):
+    """Get the reference datetime and time scale from a CF time units
+    string, e.g., 'microseconds since 1970-01-01 00:00:00'
+    """
+    unit,ref = time_units.split(' since ')
+    scale = {'nanoseconds':'ns', 'microseconds':'us', 'milliseconds':'ms',
+             'seconds':'s', 'minutes':'m', 'hours':'h', 'days':'D'}[unit.strip()]
+    return np.datetime64(ref.strip(),'ns'), np.timedelta64(1,scale)
@@ -255,8 +255,238 @@ def covariance(a,b,interval='10min',resample=False,**kwargs):
         return cov
 
 
+def covariances(df,pairs=None,interval='10min',resample=False,**kwargs):
+    """Calculate multiple covariances between columns of a dataframe
+    (with datetime index) in the specified interval, where the interval
+    is defined by a pandas offset string. This is equivalent to calling
+    covariance() for each pair, but all means and mean products are
+    computed in a single rolling or resampling pass.
+
+    Parameters
+    ==========
+    df : pd.DataFrame
+        Data columns; may have a (datetime, height) multiindex, in which
+        case covariances are calculated at all heights simultaneously
+    pairs : list or dict, optional
+        List of (a,b) column-name pairs, or dict of output names and
+        (a,b) pairs; output names default to a+b (e.g., 'uw'). If None,
+        all unique pairs (including variances) are calculated.
+    interval : str
+        Averaging interval; see covariance()
+    resample : bool
+        Return statistics at the specified interval instead of rolling
+        statistics with the same length as the input data.
+
+    Example:
+        stresses = covariances(df,
+                               [('u','u'),('u','v'),('u','w'),
+                                ('v','v'),('v','w'),('w','w'),('w','Ts')])
+    """
+    if pairs is None:
+        cols = list(df.columns)
+        pairs = [(a,b) for i,a in enumerate(cols) for b in cols[i:]]
+    if not isinstance(pairs, dict):
+        pairs = { a+b: (a,b) for a,b in pairs }
+    variables = list(dict.fromkeys([var for ab in pairs.values() for var in ab]))
+    # handle multiindices
+    have_multiindex = isinstance(df.index, pd.MultiIndex)
+    if have_multiindex:
+        assert len(df.index.levels) == 2
+        # assuming levels 0 and 1 are time and height, respectively
+        df = df[variables].unstack() # columns are (variable, height)
+    # check index
+    if isinstance(interval, str):
+        # make sure we have a compatible index
+        assert isinstance(df.index, (pd.DatetimeIndex, pd.TimedeltaIndex, pd.PeriodIndex))
+    # assemble all fields to be averaged, then do the calculations
+    fields = [df[var] for var in variables] \
+           + [df[a]*df[b] for a,b in pairs.values()]
+    keys = variables + ['_'+name for name in pairs.keys()]
+    combined = pd.concat(fields, axis=1, keys=keys)
+    if resample:
+        means = combined.resample(interval,**kwargs).mean()
+    else:
+        means = combined.rolling(interval,**kwargs).mean()
+    cov = pd.concat([means['_'+name] - means[a]*means[b]
+                     for name,(a,b) in pairs.items()],
+                    axis=1, keys=list(pairs.keys()))
+    if have_multiindex:
+        return cov.stack()
+    else:
+        return cov
+
+
+class StreamingStatistics(object):
+    """Accumulate exact interval statistics (means, variances,
+    covariances, skewness, and kurtosis) from a data stream that is
+    provided in chunks, e.g., high-frequency sonic anemometer data read
+    one file at a time, without keeping the raw data in memory.
+
+    Each chunk is reduced to per-interval (and per-height) counts, means,
+    and central moment sums, which are combined with the accumulated
+    values using the pairwise update formulas of Chan et al. (1979); the
+    results are identical to those computed from the full series (within
+    roundoff). Statistics for an interval are returned by update() as
+    soon as data beyond the end of the interval have been seen, assuming
+    chunks are provided in time order. Accumulators from independent
+    workers, e.g., processing different files in parallel, may be
+    combined with merge().
+
+    Rows with missing values in any of the variables are ignored.
+
+    Example:
+        stats = StreamingStatistics(['u','v','w','Ts'], interval='10min')
+        for fpath in filelist:
+            closed = stats.update(metmast.read_data(fpath, ...))
+            # closed intervals are available here
+        remaining = stats.finalize()
+    """
+    def __init__(self,variables,interval='10min',pairs=None,
+                 higher_moments=True):
+        """Setup accumulator
+
+        Parameters
+        ==========
+        variables : list
+            Names of columns in the data
+        interval : str
+            Averaging interval, as a pandas offset string
+        pairs : list, optional
+            List of (a,b) variable pairs for which to calculate
+            covariances, named a+b in the output as in covariances();
+            by default, all unique pairs are calculated
+        higher_moments : bool, optional
+            Calculate skewness and (excess) kurtosis for all variables
+        """
+        self.variables = list(variables)
+        self.interval = interval
+        if pairs is None:
+            pairs = [(a,b) for i,a in enumerate(self.variables)
+                     for b in self.variables[i:]]
+        self.pairs = list(pairs)
+        # variances are always needed for merging higher moments
+        self._pairs = list(dict.fromkeys(
+                self.pairs + [(var,var) for var in self.variables]))
+        self.higher_moments = higher_moments
+        self.state = None
+        self.last_time = None
+
+    def update(self,df,emit=True):
+        """Add a chunk of data with a datetime or (datetime, height)
+        index, and return the statistics for all intervals that have
+        been completed (or None if emit is False)
+        """
+        batch = self._reduce(df)
+        self.state = batch if self.state is None \
+                else self._combine(self.state, batch)
+        latest = df.index.get_level_values(0).max()
+        if (self.last_time is None) or (latest > self.last_time):
+            self.last_time = latest
+        if not emit:
+            return None
+        # intervals are closed if we've seen data past their end
+        starts = self.state.index.get_level_values(0)
+        closed = (starts + pd.to_timedelta(self.interval) <= self.last_time)
+        output = self._statistics(self.state.loc[closed])
+        self.state = self.state.loc[~closed]
+        return output
+
+    def merge(self,other):
+        """Combine the accumulated values from another
+        StreamingStatistics object with the same setup
+        """
+        assert (other.variables == self.variables) \
+                and (other._pairs == self._pairs) \
+                and (other.interval == self.interval)
+        if other.state is not None:
+            self.state = other.state.copy() if self.state is None \
+                    else self._combine(self.state, other.state)
+        if (other.last_time is not None) and \
+                ((self.last_time is None) or (other.last_time > self.last_time)):
+            self.last_time = other.last_time
+        return self
+
+    def finalize(self):
+        """Return the statistics for all remaining (including
+        incomplete) intervals and reset the accumulator
+        """
+        if self.state is None:
+            return None
+        output = self._statistics(self.state)
+        self.state = None
+        return output
+
+    def _reduce(self,df):
+        """Calculate counts, means, and central moment sums for each
+        interval in a chunk of data
+        """
+        data = df[self.variables].dropna()
+        keys = [data.index.get_level_values(0).floor(self.interval)]
+        names = [data.index.names[0]]
+        if isinstance(data.index, pd.MultiIndex):
+            keys.append(data.index.get_level_values(1))
+            names.append(data.index.names[1])
+        grouped = data.groupby(keys)
+        dev = data - grouped.transform('mean')
+        sums = { 'C_'+a+b: dev[a]*dev[b] for a,b in self._pairs }
+        if self.higher_moments:
+            for var in self.variables:
+                sums['M3_'+var] = dev[var]**3
+                sums['M4_'+var] = dev[var]**4
+        state = pd.DataFrame(sums).groupby(keys).sum()
+        state.insert(0, 'n', grouped.size())
+        means = grouped.mean()
+        for i,var in enumerate(self.variables):
+            state.insert(1+i, 'mean_'+var, means[var])
+        state.index.names = names
+        return state
+
+    def _combine(self,A,B):
+        """Merge accumulated values with the pairwise update formulas"""
+        index = A.index.union(B.index)
+        A = A.reindex(index, fill_value=0)
+        B = B.reindex(index, fill_value=0)
+        na, nb = A['n'], B['n']
+        n = na + nb
+        delta = { var: B['mean_'+var] - A['mean_'+var] for var in self.variables }
+        state = pd.DataFrame({'n': n}, index=index)
+        for var in self.variables:
+            state['mean_'+var] = A['mean_'+var] + delta[var]*nb/n
+        for a,b in self._pairs:
+            col = 'C_'+a+b
+            state[col] = A[col] + B[col] + delta[a]*delta[b]*na*nb/n
+        if self.higher_moments:
+            for var in self.variables:
+                d = delta[var]
+                M2a, M2b = A['C_'+var+var], B['C_'+var+var]
+                M3a, M3b = A['M3_'+var], B['M3_'+var]
+                state['M3_'+var] = M3a + M3b \
+                        + d**3 * na*nb*(na-nb)/n**2 \
+                        + 3*d * (na*M2b - nb*M2a)/n
+                state['M4_'+var] = A['M4_'+var] + B['M4_'+var] \
+                        + d**4 * na*nb*(na**2 - na*nb + nb**2)/n**3 \
+                        + 6*d**2 * (na**2*M2b + nb**2*M2a)/n**2 \
+                        + 4*d * (na*M3b - nb*M3a)/n
+        return state
+
+    def _statistics(self,state):
+        """Convert accumulated values into output statistics"""
+        n = state['n']
+        stats = pd.DataFrame({'count': n}, index=state.index)
+        for var in self.variables:
+            stats[var] = state['mean_'+var]
+        for a,b in self.pairs:
+            stats[a+b] = state['C_'+a+b] / n
+        if self.higher_moments:
+            for var in self.variables:
+                var2 = state['C_'+var+var] / n
+                stats[var+'_skew'] = state['M3_'+var] / n / var2**1.5
+                stats[var+'_kurt'] = state['M4_'+var] / n / var2**2 - 3
+        return stats
+
+
 def power_spectral_density(df,tstart=None,interval=None,window_size='10min',
-                           window_type='hanning',detrend='linear',scaling='density'):
+                           window_type='hann',detrend='linear',scaling='density'):
     """
     Calculate power spectral density using welch method and return
     a new dataframe. The spectrum is calculated for every column
@@ -265,8 +495,10 @@ def power_spectral_density(df,tstart=None,interval=None,window_size='10min',
     Notes:
     - Input can be a pandas series or dataframe
     - Output is a dataframe with frequency as index
+    - A float interval is in seconds
     """
     from scipy.signal import welch
+    window_type = _welch_window(window_type)
     
     # Determine time scale
     timevalues = df.index.get_level_values(0)
@@ -283,6 +515,8 @@ def power_spectral_density(df,tstart=None,interval=None,window_size='10min',
         interval = timevalues[-1] - timevalues[0]
     elif isinstance(interval,str):
         interval = pd.to_timedelta(interval)
+    elif timescale != 1:
+        interval = pd.to_timedelta(interval,'s')
 
     # Update timevalues
     inrange = (timevalues >= tstart) & (timevalues <= tstart+interval)
@@ -299,25 +533,159 @@ def power_spectral_density(df,tstart=None,interval=None,window_size='10min',
     if isinstance(df,pd.Series):
         df = df.to_frame()
 
-    spectra = {}
-    for col in df.columns:
-        f,P = welch( df.loc[inrange,col], fs=1./dt, nperseg=nperseg,
-            detrend=detrend,window=window_type,scaling=scaling)    
-        spectra[col] = P
-    spectra['frequency'] = f
-    return pd.DataFrame(spectra).set_index('frequency')
+    # Calculate spectra for all columns at once
+    f,P = welch( df.loc[inrange].values, fs=1./dt, nperseg=nperseg,
+        detrend=detrend,window=window_type,scaling=scaling,axis=0)
+    spectra = pd.DataFrame(P,index=f,columns=df.columns)
+    spectra.index.name = 'frequency'
+    return spectra
+
+
+def power_spectral_densities(df,tstart=None,tend=None,interval='10min',
+                             window_size='10min',window_type='hann',
+                             detrend='linear',scaling='density'):
+    """
+    Calculate power spectral densities using the welch method for
+    all columns and heights of the original dataframe, over successive
+    intervals (e.g., every 10 min for a day), with a single call to
+    scipy.signal.welch.
+
+    The data are stacked into an array with dimensions (interval,
+    time, variable, height) and the spectra are calculated along the
+    time axis. Intervals with missing samples yield NaN spectra.
+
+    Parameters
+    ==========
+    df : pd.DataFrame or pd.Series
+        Input data, indexed by time or by (time, height); time may be
+        a datetime or specified in seconds
+    tstart, tend : optional
+        Start and end of the analysis period, by default the first and
+        last times in the dataframe; only complete intervals are
+        considered
+    interval : str, float, or None
+        Length of each interval (a float is in seconds); if None, a
+        single interval spanning tstart to tend is used
+    window_size : str
+        Length of the welch segments
+
+    Notes:
+    - Output is an xarray DataArray with dimensions (interval,
+      frequency, variable, height); the height dimension is omitted
+      if the input is not indexed by height
+    """
+    from scipy.signal import welch
+    window_type = _welch_window(window_type)
+
+    # If input is series, convert to dataframe
+    if isinstance(df,pd.Series):
+        df = df.to_frame()
+
+    # Unstack heights so that each row corresponds to one time
+    if isinstance(df.index,pd.MultiIndex):
+        has_height = True
+        df = df.unstack(level=1)
+        variables = df.columns.unique(level=0)
+        heights = df.columns.unique(level=1)
+        df = df.reindex(columns=pd.MultiIndex.from_product([variables,heights]))
+    else:
+        has_height = False
+        variables = df.columns
+        heights = [None]
+    timevalues = df.index
+
+    # Determine time scale
+    if isinstance(timevalues,pd.DatetimeIndex):
+        timescale = pd.to_timedelta(1,'s')
+    else:
+        # Assuming time is specified in seconds
+        timescale = 1
+
+    # Determine sampling rate and samples per window and interval
+    dts = np.diff(timevalues)/timescale
+    dt = np.min(dts)
+    assert np.allclose(np.round(dts/dt), dts/dt),\
+        'Timestamps must be spaced at multiples of the sampling interval'
+    nperseg = int(round(pd.to_timedelta(window_size)/pd.to_timedelta(dt,'s')))
+
+    # Determine the number of samples per interval and of intervals
+    if tstart is None:
+        tstart = timevalues[0]
+    tsec = np.asarray((timevalues - tstart)/timescale, dtype=float)
+    if tend is None:
+        nsamples = int(round(tsec[-1]/dt)) + 1
+    else:
+        nsamples = int(round((tend - tstart)/timescale/dt))
+    if interval is None:
+        npts = nsamples
+        interval = pd.to_timedelta(npts*dt,'s') if (timescale != 1) \
+                else npts*dt
+    else:
+        if isinstance(interval,str):
+            interval = pd.to_timedelta(interval)
+        elif timescale != 1:
+            interval = pd.to_timedelta(interval,'s')
+        npts = int(round(interval/timescale/dt))
+    Nint = nsamples // npts
+    assert (Nint > 0), 'Analysis period is shorter than one interval'
+    assert (nperseg <= npts), 'Window size is longer than the interval'
+
+    # Place samples on a regular grid, leaving gaps as NaN
+    values = df.values.reshape((len(df),len(variables),len(heights)))
+    idx = np.round(tsec/dt).astype(int)
+    inrange = (idx >= 0) & (idx < Nint*npts)
+    data = np.full((Nint*npts,len(variables),len(heights)), np.nan)
+    data[idx[inrange]] = values[inrange]
+    data = data.reshape((Nint,npts,len(variables),len(heights)))
+
+    # Calculate all spectra along the time axis; incomplete intervals
+    # are zero-filled for welch and masked afterward
+    incomplete = np.isnan(data).any(axis=1)
+    data[np.isnan(data)] = 0.0
+    f,P = welch(data, fs=1./dt, nperseg=nperseg, detrend=detrend,
+                window=window_type, scaling=scaling, axis=1)
+    P = np.where(incomplete[:,np.newaxis,:,:], np.nan, P)
+
+    intervals = tstart + np.arange(Nint)*interval
+    spectra = xr.DataArray(
+        P,
+        dims=['interval','frequency','variable','height'],
+        coords={'interval': intervals,
+                'frequency': f,
+                'variable': list(variables),
+                'height': list(heights)},
+        name='PSD')
+    if not has_height:
+        spectra = spectra.isel(height=0,drop=True)
+    return spectra
+
+def _welch_window(window_type):
+    """Map the 'hanning' window name, which is no longer accepted by
+    scipy.signal, to 'hann'
+    """
+    if window_type == 'hanning':
+        return 'hann'
+    return window_type
     
 
 def power_law(z,zref=80.0,Uref=8.0,alpha=0.2):
     return Uref*(z/zref)**alpha
 
-def fit_powerlaw(df=None,z=None,U=None,zref=80.0,Uref=None):
+def fit_powerlaw(df=None,z=None,U=None,zref=80.0,Uref=None,heightdim='height'):
     """Calculate power-law exponent to estimate shear.
 
+    Since log(U/Uref) = alpha*log(z/zref) is linear in alpha, all
+    profiles are fit at once with a closed-form least-squares solution,
+    which is then clipped to the bounds 0 <= alpha <= 1. Heights at
+    which U or Uref is missing (NaN) or nonpositive are excluded from
+    each fit.
+
     Parameters
     ==========
-    df : pd.DataFrame, optional
-        Calculate from data columns; index should be height values
+    df : pd.DataFrame or xr.DataArray, optional
+        Calculate from data columns; index should be height values.
+        Alternatively, a DataArray of wind speeds with a height
+        dimension (e.g., dimensions (datetime, height))
     U : str or array-like, optional
         An array of wind speeds if dataframe 'df' is not provided speeds
     z : array-like, optional
@@ -327,15 +695,30 @@ def fit_powerlaw(df=None,z=None,U=None,zref=80.0,Uref=None):
     Uref : float or array-like, optional
         Power-law reference wind speed; if not specified, then the wind
         speeds are evaluated at zref to get Uref
+    heightdim : str, optional
+        Name of the height dimension if df is a DataArray
 
     Returns
     =======
-    alpha : float or pd.Series
+    alpha : float or pd.Series or xr.DataArray
         Shear exponents
-    R2 : float or pd.Series
+    R2 : float or pd.Series or xr.DataArray
         Coefficients of determination
     """
-    from scipy.optimize import curve_fit
+    if isinstance(df,xr.DataArray):
+        # fit along the height dimension, over all other dimensions
+        da = df.where(df[heightdim] > 0, drop=True).transpose(heightdim,...)
+        if Uref is None:
+            Uref = da.sel({heightdim: zref})
+        Uref = xr.DataArray(Uref).broadcast_like(da.isel({heightdim: 0},drop=True))
+        alpha, R2 = _fit_powerlaw(da[heightdim].values,
+                                  da.values.reshape((da.shape[0],-1)),
+                                  zref,
+                                  Uref.transpose(*da.dims[1:]).values.ravel())
+        template = da.isel({heightdim: 0},drop=True)
+        return (template.copy(data=alpha.reshape(template.shape)).rename('alpha'),
+                template.copy(data=R2.reshape(template.shape)).rename('R2'))
+
     # generalize all inputs
     if df is None:
         assert (U is not None) and (z is not None)
@@ -345,28 +728,40 @@ def fit_powerlaw(df=None,z=None,U=None,zref=80.0,Uref=None):
     # make sure we're only working with above-ground values
     df = df.loc[df.index > 0]
     z = df.index
-    logz = np.log(z) - np.log(zref)
     # evaluate Uref at zref, if needed
     if Uref is None:
         Uref = df.loc[zref]
     elif not hasattr(Uref, '__iter__'):
         Uref = pd.Series(Uref,index=df.columns)
     # calculate shear coefficient
-    alpha = pd.Series(index=df.columns)
-    R2 = pd.Series(index=df.columns)
-    def fun(x,*popt):
-        return popt[0]*x
-    for col,U in df.iteritems():
-        logU = np.log(U) - np.log(Uref[col])
-        popt, pcov = curve_fit(fun,xdata=logz,ydata=logU,p0=0.14,bounds=(0,1))
-        alpha[col] = popt[0]
-        U = df[col]
-        resid = U - Uref[col]*(z/zref)**alpha[col]
-        SSres = np.sum(resid**2)
-        SStot = np.sum((U - np.mean(U))**2)
-        R2[col] = 1.0 - (SSres/SStot)
+    alpha, R2 = _fit_powerlaw(np.asarray(z,dtype=float), df.values, zref,
+                              np.asarray(Uref,dtype=float))
+    alpha = pd.Series(alpha, index=df.columns)
+    R2 = pd.Series(R2, index=df.columns)
     return alpha.squeeze(), R2.squeeze()
 
+def _fit_powerlaw(z,U,zref,Uref):
+    """Vectorized power-law fit to wind speeds U with dimensions
+    (height, profile), given reference speeds Uref for each profile
+    """
+    logz = (np.log(z) - np.log(zref))[:,np.newaxis]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        logU = np.log(U) - np.log(Uref)[np.newaxis,:]
+    valid = np.isfinite(logU)
+    x = np.where(valid, logz, 0.0)
+    y = np.where(valid, logU, 0.0)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        alpha = np.sum(x*y, axis=0) / np.sum(x*x, axis=0)
+        alpha = np.clip(alpha, 0, 1)
+        # coefficient of determination of the fitted speeds
+        Ufit = Uref[np.newaxis,:] * (z[:,np.newaxis]/zref)**alpha[np.newaxis,:]
+        Uvalid = np.where(valid, U, np.nan)
+        SSres = np.nansum((Uvalid - Ufit)**2, axis=0)
+        SStot = np.nansum((Uvalid - np.nanmean(Uvalid,axis=0))**2, axis=0)
+        R2 = 1.0 - (SSres/SStot)
+    R2[~np.isfinite(alpha)] = np.nan
+    return alpha, R2
+
 def fit_power_law_alpha(z,U,zref=80.0,Uref=8.0):
     """DEPRECATED: use fit_powerlaw instead"""
     from scipy.optimize import curve_fit
@@ -391,18 +786,85 @@ def lowess_mean(ds,win_size,lowess_delta):
     win_size : float
     lowess_delta: float
     '''
-    series_length = ds.data.size
+    from statsmodels.nonparametric.smoothers_lowess import lowess
+    data = np.asarray(ds)
+    series_length = data.size
     sm_frac = win_size/series_length
-    exog = np.arange(len(ds.data))
-
-    init_ds_means = True
+    exog = np.arange(len(data))
 
-    lowess_smth = lowess(ds.data, exog, 
+    lowess_smth = lowess(data, exog, 
                          frac=sm_frac, 
                          delta=lowess_delta)[:,1]
     return(lowess_smth)
 
-def model4D_calcQOIs(ds,mean_dim,data_type='wrfout', mean_opt='static', lowess_delta=0, lowess_window=None):
+def lowess_smooth(da,win_size,dim='datetime',method='tricube'):
+    '''
+    Vectorized alternative to lowess_mean that smooths all series in a
+    data array along the specified dimension at once. With dask-backed
+    input, each spatial chunk is smoothed in parallel (the smoothing
+    dimension is rechunked into a single chunk).
+
+    da : xarray data array
+    win_size : float
+        Window size, in number of samples
+    dim : str
+        Dimension along which to smooth
+    method : str
+        'tricube' : tricube-weighted local linear fit over win_size
+            samples, i.e., a single (non-robust) lowess iteration with
+            fixed bandwidth
+        'savgol' : unweighted local linear fit (Savitzky-Golay filter)
+            over win_size samples
+        'gaussian' : gaussian filter with a standard deviation of
+            win_size/6 samples
+    '''
+    if method not in ('tricube','savgol','gaussian'):
+        raise ValueError('Unknown smoothing method: {:s}'.format(method))
+    if da.chunks is not None:
+        da = da.chunk({dim: -1})
+    # apply_ufunc moves the core dimension to the end
+    return xr.apply_ufunc(_smooth_along_axis, da,
+                          input_core_dims=[[dim]],
+                          output_core_dims=[[dim]],
+                          kwargs=dict(win_size=win_size,method=method),
+                          dask='parallelized',
+                          output_dtypes=[float]).transpose(*da.dims)
+
+def _smooth_along_axis(data,win_size,method='tricube',axis=-1):
+    """Smooth a numpy array along an axis; see lowess_smooth()"""
+    from scipy.ndimage import correlate1d, gaussian_filter1d
+    from scipy.signal import savgol_filter
+    data = np.asarray(data, dtype=float)
+    npts = data.shape[axis]
+    if method == 'gaussian':
+        return gaussian_filter1d(data, win_size/6., axis=axis, mode='nearest')
+    elif method == 'savgol':
+        window_length = min(2*int(win_size//2) + 1, npts - (1 - npts%2))
+        return savgol_filter(data, window_length, 1, axis=axis, mode='interp')
+
+    # tricube-weighted local linear fit: at each point, the fitted
+    # value is (S2*T0 - S1*T1)/(S0*S2 - S1**2), where Sn = sum(w*d**n)
+    # and Tn = sum(w*d**n*y) over offsets d; the sums are correlations
+    # with the kernels w and w*d, truncated at the ends of the series
+    halfwidth = win_size / 2.
+    m = int(np.ceil(halfwidth)) - 1
+    assert (m >= 1), 'Window size must be greater than 2 samples'
+    d = np.arange(-m, m+1, dtype=float)
+    w = (1 - (np.abs(d)/halfwidth)**3)**3
+    ones = np.ones(npts)
+    S0 = correlate1d(ones, w, mode='constant')
+    S1 = correlate1d(ones, w*d, mode='constant')
+    S2 = correlate1d(ones, w*d**2, mode='constant')
+    T0 = correlate1d(data, w, axis=axis, mode='constant')
+    T1 = correlate1d(data, w*d, axis=axis, mode='constant')
+    shape = [1] * data.ndim
+    shape[axis] = npts
+    coef0 = (S2 / (S0*S2 - S1**2)).reshape(shape)
+    coef1 = (S1 / (S0*S2 - S1**2)).reshape(shape)
+    return coef0*T0 - coef1*T1
+
+def model4D_calcQOIs(ds,mean_dim,data_type='wrfout', mean_opt='static', lowess_delta=0, lowess_window=None,
+                     lowess_method='tricube', lazy=False, average_dims=None):
     """
     Augment an a2e-mmc standard, xarrays-based, data structure of 
     4-dimensional model output with space-based quantities of interest
@@ -425,9 +887,34 @@ def model4D_calcQOIs(ds,mean_dim,data_type='wrfout', mean_opt='static', lowess_d
         e.g., wanting 30 min intervals with time step of 0.1 s would yeild
         lowess_delta = 1800.0*0.1 = 18000.0
         Setting lowess_delta = 0 means no linear averaging (default)
+        Only used with lowess_method='statsmodels'
+    lowess_window : float
+        Window size of the lowess smoother, in number of samples
+    lowess_method : string
+        Smoother used with mean_opt='lowess'; 'statsmodels' calls
+        lowess_mean() for each column, otherwise all columns are smoothed
+        at once (in parallel over dask chunks) by lowess_smooth() with
+        the specified method ('tricube', 'savgol', or 'gaussian')
+    lazy : bool
+        If True, the input dataset is not modified; instead, a new
+        dask-backed dataset is returned in which the means,
+        perturbations, and their products are only computed, chunk by
+        chunk, when a variable is accessed or reduced. Datasets that are
+        not already chunked (e.g., with xr.open_dataset(..., chunks=...))
+        are chunked automatically. This allows datasets larger than
+        memory to be processed.
+    average_dims : list, optional
+        If specified, the lazily evaluated quantities are directly
+        averaged over these dimensions and the (small) result is
+        returned in memory, e.g., average_dims=['datetime','ny','nx']
+        gives mean profiles
     """
 
     dim_keys = [*ds.dims.keys()]
+    if average_dims is not None:
+        lazy = True
+    if lazy and all(ds[varn].chunks is None for varn in ds.data_vars):
+        ds = ds.chunk('auto')
     print('Calculating means... this may take a while.')
     if data_type == 'ts':
         var_keys = ['u','v','w','theta','wspd','wdir']
@@ -439,65 +926,186 @@ def model4D_calcQOIs(ds,mean_dim,data_type='wrfout', mean_opt='static', lowess_d
         ds_means = ds.mean(dim=mean_dim)
     elif mean_opt == 'lowess':
         print('calculating lowess means')
-        init_ds_means = True
+        ds_means = xr.Dataset(coords=ds.coords)
+        loop_start = time.time()
         for varn in var_keys:
             print(varn)
-            if varn == 'wspd':
-                var_str = '{:s}Mean'.format('U')
+            if lowess_method == 'statsmodels':
+                var = ds[varn].transpose(mean_dim,...)
+                values = var.values.reshape((var.shape[0],-1))
+                lowess_smth = np.empty(values.shape)
+                for icol in range(values.shape[1]):
+                    lowess_smth[:,icol] = lowess_mean(values[:,icol],
+                                                      win_size=lowess_window,
+                                                      lowess_delta=lowess_delta)
+                ds_means[varn] = var.copy(data=lowess_smth.reshape(var.shape)) \
+                                    .transpose(*ds[varn].dims)
             else:
-                var_str = '{:s}Mean'.format(varn)
-
-            lowess_smth = np.zeros((ds.datetime.data.size, ds.nz.data.size, 
-                                    ds.ny.data.size, ds.nx.data.size))
-            loop_start = time.time()
-            for kk in ds.nz.data:
-                k_loop_start = time.time()
-                var = ds[varn].isel(nz=kk).values
-                for jj in ds.ny.data:
-                    for ii in ds.nx.data:
-                        lowess_smth[:,kk,jj,ii] = lowess_mean(var[:,jj,ii], 
-                                                         win_size=lowess_window,
-                                                         delta=lowess_delta)
-                print('k-loop: {} seconds'.format(time.time()-k_loop_start))
-                loop_end = time.time()
-            print('total time: {} seconds'.format(loop_end - loop_start))
-            if init_ds_means:
-                ds_means = xr.Dataset({varn:(['datetime','nz','ny','nx'], lowess_smth)},
-                                       coords=ds.coords)
-                init_ds_means = False
-            else:
-                ds_means[varn] = (['datetime','nz','ny','nx'], lowess_smth)
+                ds_means[varn] = lowess_smooth(ds[varn], lowess_window,
+                                               dim=mean_dim,
+                                               method=lowess_method)
+        print('total time: {} seconds'.format(time.time() - loop_start))
     else:
         print('Please select "static" or "lowess"')
         return
     ds_perts = ds-ds_means
 
-    ds['uMean'] = ds_means['u']
-    ds['vMean'] = ds_means['v']
-    ds['wMean'] = ds_means['w']
-    ds['thetaMean'] = ds_means['theta']
-    ds['UMean'] = ds_means['wspd']
-    ds['UdirMean'] = ds_means['wdir']
+    qois = {}
+    qois['uMean'] = ds_means['u']
+    qois['vMean'] = ds_means['v']
+    qois['wMean'] = ds_means['w']
+    qois['thetaMean'] = ds_means['theta']
+    qois['UMean'] = ds_means['wspd']
+    qois['UdirMean'] = ds_means['wdir']
     if data_type != 'ts':
-        ds['pMean'] = ds_means['p']
+        qois['pMean'] = ds_means['p']
 
     print('calculating variances / covariances...')
-    ds['uu'] = ds_perts['u']**2
-    ds['vv'] = ds_perts['v']**2
-    ds['ww'] = ds_perts['w']**2
-    ds['uv'] = ds_perts['u']*ds_perts['v']
-    ds['uw'] = ds_perts['u']*ds_perts['w']
-    ds['vw'] = ds_perts['v']*ds_perts['w']
-    ds['wth'] = ds_perts['w']*ds_perts['theta']
-    ds['UU'] = ds_perts['wspd']**2
-    ds['Uw'] = ds_perts['wspd']**2
-    ds['TKE'] = 0.5*np.sqrt(ds['UU']+ds['ww'])
+    qois['uu'] = ds_perts['u']**2
+    qois['vv'] = ds_perts['v']**2
+    qois['ww'] = ds_perts['w']**2
+    qois['uv'] = ds_perts['u']*ds_perts['v']
+    qois['uw'] = ds_perts['u']*ds_perts['w']
+    qois['vw'] = ds_perts['v']*ds_perts['w']
+    qois['wth'] = ds_perts['w']*ds_perts['theta']
+    qois['UU'] = ds_perts['wspd']**2
+    qois['Uw'] = ds_perts['wspd']**2
+    qois['TKE'] = 0.5*np.sqrt(qois['UU']+qois['ww'])
+    if lazy:
+        ds = ds.assign(qois)
+    else:
+        ds.update(qois)
     ds.attrs['MEAN_OPT'] = mean_opt
     if mean_opt == 'lowess':
         ds.attrs['WINDOW_SIZE'] = lowess_window
         ds.attrs['LOWESS_DELTA'] = lowess_delta
+        ds.attrs['LOWESS_METHOD'] = lowess_method
+    if average_dims is not None:
+        ds = ds.mean(dim=average_dims, keep_attrs=True).compute()
     return ds
 
+def _model4D_sample_spacing(ds,spectra_dim):
+    """Grid spacing or sampling interval (in s) along spectra_dim"""
+    if 'y' in spectra_dim:
+        return ds.attrs['DY']
+    elif 'x' in spectra_dim:
+        return ds.attrs['DX']
+    elif spectra_dim == 'datetime':
+        return float((ds.datetime[1] - ds.datetime[0]) / np.timedelta64(1,'s'))
+    else:
+        raise ValueError('Unexpected spectra_dim: {:s}'.format(spectra_dim))
+
+def _model4D_fft(ds,spectra_dim,average_dim,vert_levels,horizontal_locs,fld,fldMean):
+    """
+    Extract the fluctuations fld-fldMean at all of the specified
+    vertical levels and horizontal (nx) locations at once, and Fourier
+    transform them along spectra_dim with a single (batched) rfft.
+
+    Returns the frequencies, the Fourier coefficients with dimensions
+    (level, location, instance in average_dim, frequency), and the
+    scaling factor that converts |X|**2 into a two-sided power spectral
+    density, consistent with a single-segment scipy.signal.welch call.
+    The coefficients are a dask array if the dataset is dask-backed.
+    """
+    from scipy.signal.windows import hamming
+
+    sel = dict(nz=list(vert_levels), nx=list(horizontal_locs))
+    series = ds[fld].isel(sel) - ds[fldMean].isel(sel)
+    series = series.transpose('nz','nx',average_dim,spectra_dim)
+    data = series.data
+    nblock = data.shape[-1]
+    fs = 1.0 / _model4D_sample_spacing(ds,spectra_dim)
+    win = hamming(nblock, True) #Assumed non-periodic in the spectra_dim
+    scale = 1.0 / (fs * np.sum(win**2))
+    if isinstance(data, np.ndarray):
+        rfft = np.fft.rfft
+    else:
+        import dask.array as da
+        data = data.rechunk({3: -1})
+        rfft = da.fft.rfft
+    data = data - data.mean(axis=-1, keepdims=True) # detrend='constant'
+    X = rfft(data*win, axis=-1)
+    f = np.fft.rfftfreq(nblock, d=1.0/fs)
+    return f, X, scale
+
+def model4D_batch_spectra(ds,spectra_dim,average_dim,vert_levels,horizontal_locs,
+                          fields,pairs=[],means={}):
+    """
+    Using an a2e-mmc standard, xarrays-based, data structure of 
+    4-dimensional model output with space-based quantities of interest,
+    calculate energy spectra of one or more fields and cospectra of
+    pairs of fields at specified vertical indices and streamwise
+    horizontal indices, averaged over the dimension specified by
+    average_dim.
+
+    Each field is extracted once and transformed with a single rfft
+    along spectra_dim over all levels, locations, and instances; if the
+    dataset is backed by dask, the transforms and averages are
+    evaluated lazily and computed together.
+
+    Unlike model4D_spectra and model4D_cospectra, the result is the
+    (one-sided) power spectral density or cospectrum averaged over
+    instances, i.e., the periodograms are not squared.
+
+    Usage
+    ====
+    ds : mmc-4D standard xarray DataSet 
+        The raw standard mmc-4D data structure 
+    spectra_dim : string 
+        Dimension along which to calculate spectra
+    average_dim : string 
+        Dimension along which to average the spectra
+    vert_levels :
+        vertical levels over which to calculate spectra
+    horizontal_locs : 
+        horizontal (non-spectra_dim) locations at which to calculate spectra
+    fields : list of strings
+        Names of the fields in the dataset to calculate spectra of
+    pairs : list of (string,string)
+        Pairs of fields in the dataset to calculate cospectra of
+    means : dict
+        Names of the mean of each field in the dataset; by default,
+        '{fld}Mean'
+
+    Returns an xarray Dataset with dimensions (nz, nx, frequency), with
+    spectra named after the fields and cospectra named after the
+    concatenated pair of fields (e.g., 'uw').
+    """
+    print('Averaging spectra (in {:s}) over {:d} instances in {:s}'.format(
+          spectra_dim,ds.sizes[average_dim],average_dim))
+    allfields = list(fields)
+    for pair in pairs:
+        allfields += [fld for fld in pair if fld not in allfields]
+
+    coefs = {}
+    for fld in allfields:
+        f, coefs[fld], scale = _model4D_fft(ds,spectra_dim,average_dim,
+                                            vert_levels,horizontal_locs,
+                                            fld,means.get(fld,fld+'Mean'))
+    nhalf = ds.sizes[spectra_dim] // 2
+    f = f[:nhalf]
+
+    ###2.0 is to account for the dropping of the negative side of the FFT
+    names, spectra = [], []
+    for fld in fields:
+        X = coefs[fld][...,:nhalf]
+        names.append(fld)
+        spectra.append(2.0*scale*(X.real**2 + X.imag**2).mean(axis=2))
+    for fld0,fld1 in pairs:
+        X0 = coefs[fld0][...,:nhalf]
+        X1 = coefs[fld1][...,:nhalf]
+        names.append(fld0+fld1)
+        spectra.append(2.0*scale*(X0*X1.conj()).real.mean(axis=2))
+    if not all(isinstance(S, np.ndarray) for S in spectra):
+        import dask
+        spectra = dask.compute(*spectra)
+
+    return xr.Dataset(
+        {name: (['nz','nx','frequency'], S) for name,S in zip(names,spectra)},
+        coords={'nz': list(vert_levels),
+                'nx': list(horizontal_locs),
+                'frequency': f})
+
 def model4D_spectra(ds,spectra_dim,average_dim,vert_levels,horizontal_locs,fld,fldMean):
     """
     Using an a2e-mmc standard, xarrays-based, data structure of 
@@ -522,46 +1130,15 @@ def model4D_spectra(ds,spectra_dim,average_dim,vert_levels,horizontal_locs,fld,f
     fldMean : string
         Name of the mean of fld in the dataset
     """
-    from scipy.signal import welch
-    from scipy.signal.windows import hann, hamming
-
     print('Averaging spectra (in {:s}) over {:d} instances in {:s}'.format(
-                                spectra_dim,ds.dims[average_dim],average_dim))
-    nblock = ds.dims[spectra_dim]
-    if 'y' in spectra_dim:
-        dt = ds.attrs['DY']
-    elif 'x' in spectra_dim:
-        dt = ds.attrs['DX']
-    elif spectra_dim == 'datetime':
-        dt = float(ds.datetime[1].data - ds.datetime[0].data)/1e9
-        
-    fs = 1 / dt
-    overlap = 0
-    win = hamming(nblock, True) #Assumed non-periodic in the spectra_dim
-    Puuf_cum = np.zeros((len(vert_levels),len(horizontal_locs),ds.dims[spectra_dim]))
-
-    for cnt_lvl,level in enumerate(vert_levels): # loop over levels
-        print('grabbing a slice...')
-        spec_start = time.time()
-        series_lvl = ds[fld].isel(nz=level)-ds[fldMean].isel(nz=level)
-        print(time.time() - spec_start)
-        for cnt_i,iLoc in enumerate(horizontal_locs): # loop over x
-            for cnt,it in enumerate(range(ds.dims[average_dim])): # loop over y
-                if spectra_dim == 'datetime':
-                    series = series_lvl.isel(nx=iLoc,ny=it)
-                elif 'y' in spectra_dim:
-                    series = series_lvl.isel(nx=iLoc,datetime=it)
-                else:
-                    print('Please choose spectral_dim of \'ny\', or \'datetime\'')
-                f, Pxxfc = welch(series, fs, window=win, noverlap=overlap, 
-                                 nfft=nblock, return_onesided=False, detrend='constant')
-                Pxxf = np.multiply(np.real(Pxxfc),np.conj(Pxxfc))
-                if it is 0:
-                    Puuf_cum[cnt_lvl,cnt_i,:] = Pxxf
-                else:
-                    Puuf_cum[cnt_lvl,cnt_i,:] = Puuf_cum[cnt_lvl,cnt_i,:] + Pxxf
-    Puuf = 2.0*(1.0/cnt)*Puuf_cum[:,:,:(np.floor(ds.dims[spectra_dim]/2).astype(int))]   ###2.0 is to account for the dropping of the negative side of the FFT 
-    f = f[:(np.floor(ds.dims[spectra_dim]/2).astype(int))]
+                                spectra_dim,ds.sizes[average_dim],average_dim))
+    f, X, scale = _model4D_fft(ds,spectra_dim,average_dim,
+                               vert_levels,horizontal_locs,fld,fldMean)
+    nhalf = ds.sizes[spectra_dim] // 2
+    Pxxfc = scale * np.abs(X[...,:nhalf])**2
+    cnt = ds.sizes[average_dim] - 1
+    Puuf = 2.0*(1.0/cnt)*np.asarray((Pxxfc**2).sum(axis=2))   ###2.0 is to account for the dropping of the negative side of the FFT 
+    f = f[:nhalf]
 
     return f,Puuf
 
@@ -587,39 +1164,14 @@ def model4D_spatial_spectra(ds,spectra_dim,vert_levels,horizontal_locs,fld,fldMe
     fldMean : string
         Name of the mean of fld in the dataset
     """
-    from scipy.signal import welch
-    from scipy.signal.windows import hann, hamming
-
-    print('Averaging spectra over {:d} time-instances'.format(ds.dims['datetime']))
-    nblock = ds.dims[spectra_dim]
-    if 'y' in spectra_dim:
-        dt = ds.attrs['DY']
-    elif 'x' in spectra_dim:
-        dt = ds.attrs['DX']
-    fs = 1 / dt
-    overlap = 0
-    win = hamming(nblock, True) #Assumed non-periodic in the spectra_dim
-    Puuf_cum = np.zeros((len(vert_levels),len(horizontal_locs),ds.dims[spectra_dim]))
-
-    cnt=0.0
-    for it in range(ds.dims['datetime']):
-        cnt_lvl = 0
-        for level in vert_levels:
-            cnt_i = 0
-            for iLoc in horizontal_locs:
-                series = ds[fld].isel(datetime=it,nz=level,nx=iLoc)-ds[fldMean].isel(datetime=it,nz=level,nx=iLoc)
-
-                f, Pxxfc = welch(series, fs, window=win, noverlap=overlap, nfft=nblock, return_onesided=False, detrend='constant')
-                Pxxf = np.multiply(np.real(Pxxfc),np.conj(Pxxfc))
-                if it is 0:
-                    Puuf_cum[cnt_lvl,cnt_i,:] = Pxxf
-                else:
-                    Puuf_cum[cnt_lvl,cnt_i,:] = Puuf_cum[cnt_lvl,cnt_i,:] + Pxxf
-                    cnt_i = cnt_i+1
-            cnt_lvl = cnt_lvl + 1
-        cnt = cnt+1.0
-    Puuf = 2.0*(1.0/cnt)*Puuf_cum[:,:,:(np.floor(ds.dims['ny']/2).astype(int))]   ###2.0 is to account for the dropping of the negative side of the FFT 
-    f = f[:(np.floor(ds.dims['ny']/2).astype(int))]
+    print('Averaging spectra over {:d} time-instances'.format(ds.sizes['datetime']))
+    f, X, scale = _model4D_fft(ds,spectra_dim,'datetime',
+                               vert_levels,horizontal_locs,fld,fldMean)
+    nhalf = ds.sizes[spectra_dim] // 2
+    Pxxfc = scale * np.abs(X[...,:nhalf])**2
+    cnt = ds.sizes['datetime']
+    Puuf = 2.0*(1.0/cnt)*np.asarray((Pxxfc**2).sum(axis=2))   ###2.0 is to account for the dropping of the negative side of the FFT 
+    f = f[:nhalf]
 
     return f,Puuf
 
@@ -652,48 +1204,18 @@ def model4D_cospectra(ds,spectra_dim,average_dim,vert_levels,horizontal_locs,fld
     fldv1Mean : string
         Name of the mean of fldv1 in the dataset
     """
-    from scipy.signal import welch
-    from scipy.signal.windows import hann, hamming
-
     print('Averaging cospectra (in {:s}) over {:d} instances in {:s}'.format(
-          spectra_dim,ds.dims[average_dim],average_dim))
-    nblock = ds.dims[spectra_dim]
-    if 'y' in spectra_dim:
-        dt = ds.attrs['DY']
-    elif 'x' in spectra_dim:
-        dt = ds.attrs['DX']
-    elif spectra_dim == 'datetime':
-        dt = float(ds.datetime[1].data - ds.datetime[0].data)/1e9
-
-    fs = 1 / dt
-    overlap = 0
-    win = hamming(nblock, True) #Assumed non-periodic in the spectra_dim
-    Puuf_cum = np.zeros((len(vert_levels),len(horizontal_locs),ds.dims[spectra_dim]))
-    for cnt_lvl,level in enumerate(vert_levels): # loop over levels
-        spec_start = time.time()
-        print('Grabbing slices in z')
-        series0_lvl = ds[fldv0].isel(nz=level)-ds[fldv0Mean].isel(nz=level)
-        series1_lvl = ds[fldv1].isel(nz=level)-ds[fldv1Mean].isel(nz=level)
-        for cnt_i,iLoc in enumerate(horizontal_locs): # loop over x
-            for cnt,it in enumerate(range(ds.dims[average_dim])): # loop over average dim
-                if spectra_dim == 'datetime':
-                    series0 = series0_lvl.isel(nx=iLoc,ny=it)
-                    series1 = series1_lvl.isel(nx=iLoc,ny=it)
-                elif 'y' in spectra_dim:
-                    series0 = series0_lvl.isel(nx=iLoc,datetime=it)
-                    series1 = series1_lvl.isel(nx=iLoc,datetime=it)
-                f, Pxxfc0 = welch(series0, fs, window=win, noverlap=overlap, 
-                            nfft=nblock, return_onesided=False, detrend='constant')
-                f, Pxxfc1 = welch(series1, fs, window=win, noverlap=overlap, 
-                            nfft=nblock, return_onesided=False, detrend='constant')
-                Pxxf = (np.multiply(np.real(Pxxfc0),np.conj(Pxxfc1))+
-                        np.multiply(np.real(Pxxfc1),np.conj(Pxxfc0)))
-                if it is 0:
-                    Puuf_cum[cnt_lvl,cnt_i,:] = Pxxf
-                else:
-                    Puuf_cum[cnt_lvl,cnt_i,:] = Puuf_cum[cnt_lvl,cnt_i,:] + Pxxf
-    Puuf = 2.0*(1.0/cnt)*Puuf_cum[:,:,:(np.floor(ds.dims[spectra_dim]/2).astype(int))]  ###2.0 is to account for the dropping of the negative side of the FFT
-    f = f[:(np.floor(ds.dims[spectra_dim]/2).astype(int))]
+          spectra_dim,ds.sizes[average_dim],average_dim))
+    f, X0, scale = _model4D_fft(ds,spectra_dim,average_dim,
+                                vert_levels,horizontal_locs,fldv0,fldv0Mean)
+    f, X1, scale = _model4D_fft(ds,spectra_dim,average_dim,
+                                vert_levels,horizontal_locs,fldv1,fldv1Mean)
+    nhalf = ds.sizes[spectra_dim] // 2
+    Pxxfc0 = scale * np.abs(X0[...,:nhalf])**2
+    Pxxfc1 = scale * np.abs(X1[...,:nhalf])**2
+    cnt = ds.sizes[average_dim] - 1
+    Puuf = 2.0*(1.0/cnt)*np.asarray((2*Pxxfc0*Pxxfc1).sum(axis=2))  ###2.0 is to account for the dropping of the negative side of the FFT
+    f = f[:nhalf]
 
     return f,Puuf
 
@@ -723,44 +1245,85 @@ def model4D_spatial_cospectra(ds,spectra_dim,vert_levels,horizontal_locs,fldv0,f
     fldv1Mean : string
         Name of the mean of fldv1 in the dataset
     """
-    from scipy.signal import welch
-    from scipy.signal.windows import hann, hamming
-
-    print('Averaging spectra over {:d} time-instances'.format(ds.dims['datetime']))
-    nblock = ds.dims[spectra_dim]
-    if 'y' in spectra_dim:
-        dt = ds.attrs['DY']
-    elif 'x' in spectra_dim:
-        dt = ds.attrs['DX']
-    fs = 1 / dt
-    overlap = 0
-    win = hamming(nblock, True) #Assumed non-periodic in the spectra_dim
-    Puuf_cum = np.zeros((len(vert_levels),len(horizontal_locs),ds.dims[spectra_dim]))
-
-    cnt=0.0
-    for it in range(ds.dims['datetime']):
-        cnt_lvl = 0
-        for level in vert_levels:
-            cnt_i = 0
-            for iLoc in horizontal_locs:
-                series0 = ds[fldv0].isel(datetime=it,nz=level,nx=iLoc)-ds[fldv0Mean].isel(datetime=it,nz=level,nx=iLoc)
-                f, Pxxfc0 = welch(series0, fs, window=win, noverlap=overlap, nfft=nblock, return_onesided=False, detrend='constant')
-                series1 = ds[fldv1].isel(datetime=it,nz=level,nx=iLoc)-ds[fldv1Mean].isel(datetime=it,nz=level,nx=iLoc)
-                f, Pxxfc1 = welch(series1, fs, window=win, noverlap=overlap, nfft=nblock, return_onesided=False, detrend='constant')
-
-                Pxxf = (np.multiply(np.real(Pxxfc0),np.conj(Pxxfc1))+np.multiply(np.real(Pxxfc1),np.conj(Pxxfc0)))
-                if it is 0:
-                    Puuf_cum[cnt_lvl,cnt_i,:] = Pxxf
-                else:
-                    Puuf_cum[cnt_lvl,cnt_i,:] = Puuf_cum[cnt_lvl,cnt_i,:] + Pxxf
-                    cnt_i = cnt_i+1
-            cnt_lvl = cnt_lvl + 1
-        cnt = cnt+1.0
-    Puuf = 2.0*(1.0/cnt)*Puuf_cum[:,:,:(np.floor(ds.dims['ny']/2).astype(int))]  ###2.0 is to account for the dropping of the negative side of the FFT
-    f = f[:(np.floor(ds.dims['ny']/2).astype(int))]
+    print('Averaging spectra over {:d} time-instances'.format(ds.sizes['datetime']))
+    f, X0, scale = _model4D_fft(ds,spectra_dim,'datetime',
+                                vert_levels,horizontal_locs,fldv0,fldv0Mean)
+    f, X1, scale = _model4D_fft(ds,spectra_dim,'datetime',
+                                vert_levels,horizontal_locs,fldv1,fldv1Mean)
+    nhalf = ds.sizes[spectra_dim] // 2
+    Pxxfc0 = scale * np.abs(X0[...,:nhalf])**2
+    Pxxfc1 = scale * np.abs(X1[...,:nhalf])**2
+    cnt = ds.sizes['datetime']
+    Puuf = 2.0*(1.0/cnt)*np.asarray((2*Pxxfc0*Pxxfc1).sum(axis=2))  ###2.0 is to account for the dropping of the negative side of the FFT
+    f = f[:nhalf]
 
     return f,Puuf
 
+def _model4D_hist_moments(ds,vert_levels,horizontal_locs,fld,fldMean,bins_vector):
+    """
+    Extract the fluctuations fld-fldMean at all of the specified
+    vertical levels and horizontal (nx) locations at once and calculate
+    their histograms and skewness/kurtosis (as in np.histogram and the
+    biased scipy.stats.skew/kurtosis) over all remaining dimensions.
+
+    Histograms and power sums are accumulated block by block, so
+    dask-backed datasets are processed one chunk at a time.
+    """
+    sel = dict(nz=list(vert_levels), nx=list(horizontal_locs))
+    dist = ds[fld].isel(sel) - ds[fldMean].isel(sel)
+    dims = ['nz','nx'] + [dim for dim in dist.dims if dim not in ('nz','nx')]
+    data = dist.transpose(*dims).data
+    bins_vector = np.asarray(bins_vector, dtype=float)
+    if isinstance(data, np.ndarray):
+        hist, sums = _hist_moments_block(data, bins_vector)
+    else:
+        import dask
+        data = data.rechunk({0: -1, 1: -1})
+        partials = dask.compute(*[
+            dask.delayed(_hist_moments_block)(block, bins_vector)
+            for block in data.to_delayed().ravel()
+        ])
+        hist = sum(partial[0] for partial in partials)
+        sums = sum(partial[1] for partial in partials)
+
+    # central moments from power sums
+    n = sums[...,0]
+    mean = sums[...,1] / n
+    m2 = sums[...,2]/n - mean**2
+    m3 = sums[...,3]/n - 3*mean*sums[...,2]/n + 2*mean**3
+    m4 = sums[...,4]/n - 4*mean*sums[...,3]/n + 6*mean**2*sums[...,2]/n \
+            - 3*mean**4
+    with np.errstate(divide='ignore',invalid='ignore'):
+        sk_vec = m3 / m2**1.5
+        kurt_vec = m4 / m2**2 - 3.0
+    return hist, bins_vector, sk_vec, kurt_vec
+
+def _hist_moments_block(data,bins_vector):
+    """Histogram counts and power sums (orders 0 to 4) for each (level,
+    location) in a block of data with dimensions (level, location, ...)
+    """
+    nlev, nloc = data.shape[:2]
+    npairs = nlev * nloc
+    nbins = bins_vector.size - 1
+    x = np.asarray(data, dtype=float).reshape((npairs,-1))
+
+    # bin indices offset by pair, with the last bin closed on the right
+    idx = np.searchsorted(bins_vector, x, side='right') - 1
+    idx[x == bins_vector[-1]] = nbins - 1
+    valid = (idx >= 0) & (idx < nbins)
+    offset = np.arange(npairs)[:,np.newaxis] * nbins
+    hist = np.bincount((idx + offset)[valid], minlength=npairs*nbins)
+
+    sums = np.empty((npairs,5))
+    sums[:,0] = x.shape[1]
+    xp = x.copy()
+    for p in range(1,5):
+        sums[:,p] = xp.sum(axis=1)
+        if p < 4:
+            xp *= x
+    return (hist.reshape((nlev,nloc,nbins)).astype(float),
+            sums.reshape((nlev,nloc,5)))
+
 def model4D_pdfs(ds,pdf_dim,vert_levels,horizontal_locs,fld,fldMean,bins_vector):
     """
     Using an a2e-mmc standard, xarrays-based, data structure of 
@@ -783,44 +1346,9 @@ def model4D_pdfs(ds,pdf_dim,vert_levels,horizontal_locs,fld,fldMean,bins_vector)
     fldMean : string
 	Name of the mean of fld in the dataset 
     """
-
-    from scipy.stats import skew,kurtosis
-    print('Accumulating statistics over {:d} time-instances'.format(ds.dims['datetime']))
-    sk_vec=np.zeros((len(vert_levels),len(horizontal_locs)))
-    kurt_vec=np.zeros((len(vert_levels),len(horizontal_locs)))
-    hist_cum = np.zeros((len(vert_levels),len(horizontal_locs),bins_vector.size-1))
-    cnt_lvl = 0
-    for level in vert_levels:
-        cnt_i = 0
-        for iLoc in horizontal_locs:
-            dist=np.ndarray.flatten(((ds[fld]).isel(nz=level,nx=iLoc)-(ds[fldMean]).isel(nz=level,nx=iLoc)).values)
-            sk_vec[cnt_lvl,cnt_i]=skew(dist)
-            kurt_vec[cnt_lvl,cnt_i]=kurtosis(dist)
-            hist,bin_edges=np.histogram(dist, bins=bins_vector)
-            hist_cum[cnt_lvl,cnt_i,:] = hist
-            cnt_i = cnt_i+1
-        cnt_lvl = cnt_lvl+1
-#    cnt=0.0
-#    for it in range(ds.dims['datetime']):
-#        ##### If it seems like this is taking a long time, check progress occasionally by uncommenting 2-lines below
-#        #if int((it/ds.dims['datetime'])%10*100)%10 == 0:
-#        #    print('working...{:2d}% complete'.format(int((it/ds.dims['datetime'])%10*100)))
-#        cnt_lvl = 0
-#        for level in vert_levels:
-#            cnt_i = 0
-#            for iLoc in horizontal_locs:
-#                y = (ds[fld].isel(datetime=it,nz=level,nx=iLoc)-ds[fldMean].isel(datetime=it,nz=level,nx=iLoc))
-#                #y = np.ndarray.flatten(dist.isel(nz=level,nx=iLoc).values)
-#                hist,bin_edges=np.histogram(y, bins=bins_vector)
-#                if it is 0:
-#                    hist_cum[cnt_lvl,cnt_i,:] = hist
-#                else:
-#                    hist_cum[cnt_lvl,cnt_i,:] = hist_cum[cnt_lvl,cnt_i,:] + hist
-#                cnt_i = cnt_i+1
-#            cnt_lvl = cnt_lvl+1
-#        cnt = cnt+1.0
-
-    return hist_cum, bin_edges, sk_vec, kurt_vec
+    print('Accumulating statistics over {:d} time-instances'.format(ds.sizes['datetime']))
+    return _model4D_hist_moments(ds,vert_levels,horizontal_locs,
+                                 fld,fldMean,bins_vector)
 
 def model4D_spatial_pdfs(ds,pdf_dim,vert_levels,horizontal_locs,fld,fldMean,bins_vector):
     """
@@ -844,42 +1372,9 @@ def model4D_spatial_pdfs(ds,pdf_dim,vert_levels,horizontal_locs,fld,fldMean,bins
     fldMean : string
 	Name of the mean of fld in the dataset 
     """
-
-    from scipy.stats import skew,kurtosis
-    print('Accumulating statistics over {:d} time-instances'.format(ds.dims['datetime']))
-    sk_vec=np.zeros((len(vert_levels),len(horizontal_locs)))
-    kurt_vec=np.zeros((len(vert_levels),len(horizontal_locs)))
-    hist_cum = np.zeros((len(vert_levels),len(horizontal_locs),bins_vector.size-1))
-    cnt_lvl = 0
-    for level in vert_levels:
-        cnt_i = 0
-        for iLoc in horizontal_locs:
-            dist=np.ndarray.flatten(((ds[fld]).isel(nz=level,nx=iLoc)-(ds[fldMean]).isel(nz=level,nx=iLoc)).values)
-            sk_vec[cnt_lvl,cnt_i]=skew(dist)
-            kurt_vec[cnt_lvl,cnt_i]=kurtosis(dist)
-            cnt_i = cnt_i+1
-        cnt_lvl = cnt_lvl+1
-    cnt=0.0
-    for it in range(ds.dims['datetime']):
-        ##### If it seems like this is taking a long time, check progress occasionally by uncommenting 2-lines below
-        #if int((it/ds.dims['datetime'])%10*100)%10 == 0:
-        #    print('working...{:2d}% complete'.format(int((it/ds.dims['datetime'])%10*100)))
-        cnt_lvl = 0
-        for level in vert_levels:
-            cnt_i = 0
-            for iLoc in horizontal_locs:
-                y = (ds[fld].isel(datetime=it,nz=level,nx=iLoc)-ds[fldMean].isel(datetime=it,nz=level,nx=iLoc))
-                #y = np.ndarray.flatten(dist.isel(nz=level,nx=iLoc).values)
-                hist,bin_edges=np.histogram(y, bins=bins_vector)
-                if it is 0:
-                    hist_cum[cnt_lvl,cnt_i,:] = hist
-                else:
-                    hist_cum[cnt_lvl,cnt_i,:] = hist_cum[cnt_lvl,cnt_i,:] + hist
-                cnt_i = cnt_i+1
-            cnt_lvl = cnt_lvl+1
-        cnt = cnt+1.0
-
-    return hist_cum, bin_edges, sk_vec, kurt_vec
+    print('Accumulating statistics over {:d} time-instances'.format(ds.sizes['datetime']))
+    return _model4D_hist_moments(ds,vert_levels,horizontal_locs,
+                                 fld,fldMean,bins_vector)
 
 
 def reference_lines(x_range, y_start, slopes, line_type='log'):
@@ -912,10 +1407,16 @@ def estimate_ABL_height(T=None,Tw=None,uw=None,sanitycheck=True,**kwargs):
     a variety of methods. The recommended approach is Tw during convective
     conditions and uw during stable conditions.
 
+    All profiles are processed at once, so long records (e.g., a year of
+    10-min profiles) may be handled efficiently.
+
     Parameters
     ==========
     All inputs should be multi-indexed pandas Series, unless otherwise
     specified, with the index levels being datetime (0) and height (1).
+    Alternatively, inputs may be xarray DataArrays with a height
+    dimension (see `heightdim`) or 2D numpy arrays with dimensions
+    (time, height) (see `heights`).
     T : 
         Estimate the height of the ABL from the potential temperature
         (T) profile. The height is given as where the gradient of
@@ -940,44 +1441,101 @@ def estimate_ABL_height(T=None,Tw=None,uw=None,sanitycheck=True,**kwargs):
     sanitycheck : boolean, optional
         Perform additional sanity checks (if any).
     kwargs : optional keywords
-        Additional method-specific parameters.
+        Additional method-specific parameters, and:
+        - heights
+            Array of heights, required for numpy array inputs
+        - heightdim (default='height')
+            Name of the height dimension of DataArray inputs
+
+    Returns
+    =======
+    ablh : pd.Series, xr.DataArray, or np.ndarray
+        ABL heights, matching the type of the input
     """
-    ablh = None
     if T is not None:
+        values, heights, wrap = _profile_array(T, **kwargs)
         threshold = kwargs.get('threshold',0.065) # [K/m]
         zmin = kwargs.get('zmin',0) # [m]
-        T = T.loc[T.index.get_level_values(1) >= zmin].unstack()
-        heights = np.array(T.columns)
-        dz = np.diff(heights)
+        above = (heights >= zmin)
+        values, heights = values[:,above], heights[above]
+        dTdz = np.diff(values, axis=1) / np.diff(heights)
         newheights = (heights[:-1] + heights[1:]) / 2
-        dTdz = T.diff(axis=1).drop(columns=[heights[0]])
-        dTdz.columns = newheights
-        dTdz = dTdz.divide(dz, axis=1)
-        ablh = dTdz[dTdz >= threshold].apply(lambda s: s.first_valid_index(), axis=1)
+        ablh = _first_height(dTdz >= threshold, newheights)
     elif Tw is not None:
-        ablh = Tw.unstack().idxmin(axis=1)
+        values, heights, wrap = _profile_array(Tw, **kwargs)
+        allnan = np.all(np.isnan(values), axis=1)
+        imin = np.argmin(np.where(np.isnan(values), np.inf, values), axis=1)
+        ablh = np.where(allnan, np.nan, heights[imin])
         if sanitycheck:
-            Tw_at_ablh = Tw.loc[[(t,z) for t,z in ablh.iteritems()]]
+            Tw_at_ablh = values[np.arange(len(values)),imin][~allnan]
             assert np.all(Tw_at_ablh <= 0)
     elif uw is not None:
+        values, heights, wrap = _profile_array(uw, **kwargs)
         # assume the turbulent stress maxima occur near the surface and
         # equal u*
-        unstacked = uw.unstack()
-        ustar = unstacked.max(axis=1)
-        uw_norm = unstacked.divide(ustar, axis=0)
+        with np.errstate(invalid='ignore'):
+            ustar = np.nanmax(values, axis=1)
+            uw_norm = values / ustar[:,np.newaxis]
         cutoff = kwargs.get('cutoff',0.05)
-        z_near0 = uw_norm[uw_norm <= cutoff].apply(lambda s: s.first_valid_index(), axis=1)
-        z_near0 = z_near0.fillna(method='bfill').fillna(method='ffill')
-        # get near-zero value of uw for extrapolation
-        uw_norm = uw_norm.stack(dropna=False)
-        uw_norm_near0 = uw_norm.loc[[(t,z) for t,z in z_near0.iteritems()]]
+        with np.errstate(invalid='ignore'):
+            mask = (uw_norm <= cutoff)
+        # heights where the cutoff is first reached, backward- and then
+        # forward-filled in time for profiles where it is never reached
+        found = mask.any(axis=1)
+        izero = np.argmax(mask, axis=1)
+        if np.any(found):
+            itimes = np.arange(len(found))
+            nexttime = np.where(found, itimes, len(found))
+            nexttime = np.minimum.accumulate(nexttime[::-1])[::-1]
+            prevtime = np.maximum.accumulate(np.where(found, itimes, -1))
+            source = np.where(nexttime < len(found), nexttime, prevtime)
+            izero = izero[source]
+            z_near0 = heights[izero]
+            # get near-zero value of uw for extrapolation
+            uw_norm_near0 = uw_norm[itimes,izero]
+        else:
+            z_near0 = np.full(len(found), np.nan)
+            uw_norm_near0 = np.full(len(found), np.nan)
         if sanitycheck:
-            assert np.all(uw_norm_near0.loc[~pd.isna(uw_norm_near0)] >= 0) 
+            assert np.all(uw_norm_near0[~np.isnan(uw_norm_near0)] >= 0)
         # extrapolate
         ablh = z_near0 / (1 - uw_norm_near0)
-        ablh = ablh.reset_index(level=1)[0]
     else:
         raise ValueError('No valid inputs provided')
-    ablh.name = 'ABLheight'
-    return ablh
+    return wrap(ablh)
+
+def _profile_array(data,heights=None,heightdim='height',**kwargs):
+    """Convert profile data into a 2D (time, height) array of values
+    and an array of heights; also returns a function to convert a 1D
+    array of results back into the type of the input data
+    """
+    if isinstance(data,pd.Series):
+        unstacked = data.unstack()
+        def wrap(ablh):
+            return pd.Series(ablh, index=unstacked.index, name='ABLheight')
+        return (unstacked.values.astype(float),
+                np.asarray(unstacked.columns, dtype=float),
+                wrap)
+    elif isinstance(data,xr.DataArray):
+        assert (data.ndim == 2), 'Expected 2D (time, height) data'
+        data = data.transpose(...,heightdim)
+        template = data.isel({heightdim: 0}, drop=True)
+        def wrap(ablh):
+            return template.copy(data=ablh).rename('ABLheight')
+        return (data.values.astype(float),
+                np.asarray(data[heightdim].values, dtype=float),
+                wrap)
+    else:
+        assert (heights is not None), \
+                'Heights must be specified for array inputs'
+        values = np.asarray(data, dtype=float)
+        assert (values.ndim == 2), 'Expected 2D (time, height) data'
+        return values, np.asarray(heights, dtype=float), lambda ablh: ablh
+
+def _first_height(mask,heights):
+    """Height at which mask is first True in each (time, height) row,
+    or NaN if never True
+    """
+    found = mask.any(axis=1)
+    return np.where(found, heights[np.argmax(mask, axis=1)], np.nan)
 
@@ -3,6 +3,208 @@ Data readers for remote sensing devices (e.g., 3D data)
 
 Based on https://github.com/NWTC/datatools/blob/master/remote_sensing.py
 """
+import re
 import numpy as np
 import pandas as pd
 
+# Standard names for profiling lidar quantities, and regular expressions
+# to get the height and quantity from the data column names
+windcube_variables = {
+    'Wind Speed': 'wspd',
+    'Wind Speed Dispersion': 'wspd_std',
+    'Wind Speed min': 'wspd_min',
+    'Wind Speed max': 'wspd_max',
+    'Wind Direction': 'wdir',
+    'Z-wind': 'w',
+    'Z-wind Dispersion': 'w_std',
+    'CNR': 'CNR',
+    'CNR min': 'CNR_min',
+    'Dopp Spect Broad': 'spectral_broadening',
+    'Data Availability': 'availability',
+}
+# e.g., "40m Wind Speed (m/s)"
+windcube_column = re.compile(r'^(?P<height>\d+(?:\.\d+)?)m (?P<variable>.+?)(?: \(.*\))?$')
+
+zephir_variables = {
+    'Horizontal Wind Speed': 'wspd',
+    'Wind Direction': 'wdir',
+    'Vertical Wind Speed': 'w',
+    'TI': 'TI',
+    'Packets in Average': 'packets',
+}
+# e.g., "Horizontal Wind Speed (m/s) at 38m"
+zephir_column = re.compile(r'^(?P<variable>.+?)(?: \(.*?\))? at (?P<height>\d+(?:\.\d+)?)m$')
+
+
+def windcube(fname,variables=['wspd','wdir'],heights=None,
+             datetime_format=None,chunksize=None,
+             sep='\t',encoding='latin-1',
+             verbose=False,
+             **kwargs):
+    """Leosphere WindCube v2 10-min statistics (.sta) file, or CSV
+    export with the same data column names, e.g., "40m Wind Speed (m/s)"
+
+    Usage
+    =====
+    variables : list or None
+        Standard names of the quantities to read (see
+        `windcube_variables`), or None to read all recognized columns
+    heights : list or None
+        Heights to read, or None to read all heights
+    datetime_format : str or None
+        Format of the timestamps in the first column; if None, then
+        the format is inferred
+    chunksize : int or None
+        Read and process the datafile this many rows at a time
+    **kwargs : optional
+        Additional arguments to pass to pandas.read_csv()
+    """
+    with open(fname,'r',encoding=encoding) as f:
+        firstline = f.readline()
+    if firstline.startswith('HeaderSize='):
+        # skip the header lines with instrument and configuration info
+        kwargs['skiprows'] = int(firstline.split('=')[1]) + 1
+    return _read_wide_csv(fname, windcube_column, windcube_variables,
+                          variables=variables, heights=heights,
+                          datetime_format=datetime_format,
+                          chunksize=chunksize,
+                          sep=sep, encoding=encoding,
+                          verbose=verbose,
+                          **kwargs)
+
+def zephir(fname,variables=['wspd','wdir'],heights=None,
+           datetime_format=None,dayfirst=True,chunksize=None,
+           na_values=[9998,9999],
+           verbose=False,
+           **kwargs):
+    """ZephIR 300 / ZX300 CSV export with data column names like
+    "Horizontal Wind Speed (m/s) at 38m"
+
+    Usage
+    =====
+    variables : list or None
+        Standard names of the quantities to read (see
+        `zephir_variables`), or None to read all recognized columns
+    heights : list or None
+        Heights to read, or None to read all heights
+    datetime_format : str or None
+        Format of the timestamps in the first column; if None, then
+        the format is inferred (with `dayfirst`)
+    chunksize : int or None
+        Read and process the datafile this many rows at a time
+    na_values : list
+        Values to be considered n/a and set to nan
+    **kwargs : optional
+        Additional arguments to pass to pandas.read_csv()
+    """
+    return _read_wide_csv(fname, zephir_column, zephir_variables,
+                          variables=variables, heights=heights,
+                          datetime_format=datetime_format,
+                          dayfirst=dayfirst,
+                          chunksize=chunksize,
+                          na_values=na_values,
+                          verbose=verbose,
+                          **kwargs)
+
+def profile_netcdf(fname,
+                   variables={'wspd':'wind_speed','wdir':'wind_direction'},
+                   time_name='time',height_name='height',
+                   chunksize=None,
+                   verbose=False,
+                   **kwargs):
+    """Profiling lidar data in netCDF format with time and height
+    dimensions
+
+    Usage
+    =====
+    fname : str or list
+        Data file, or list of data files to open as a single dataset
+    variables : dict
+        Standard names and the corresponding names of the variables in
+        the data file; only these variables are read
+    time_name, height_name : str
+        Names of the time and height dimensions in the data file
+    chunksize : int or None
+        Load and process this many times at once
+    **kwargs : optional
+        Additional arguments to pass to xarray.open_dataset(), e.g., the
+        netCDF group
+    """
+    import xarray
+    if isinstance(fname,str):
+        ds = xarray.open_dataset(fname, **kwargs)
+    else:
+        ds = xarray.open_mfdataset(fname, combine='by_coords', **kwargs)
+    ds = ds[list(variables.values())]
+    ds = ds.rename({fieldname: name for name,fieldname in variables.items()})
+    ds = ds.transpose(time_name, height_name)
+    ntimes = ds.sizes[time_name]
+    if chunksize is None:
+        chunksize = ntimes
+    dataframes = []
+    for itime in range(0,max(ntimes,1),chunksize):
+        if verbose:
+            print('Reading times',itime,'to',min(itime+chunksize,ntimes))
+        chunk = ds.isel({time_name: slice(itime,itime+chunksize)}).load()
+        df = chunk.to_dataframe()
+        df.index.names = ['datetime','height']
+        dataframes.append(df[list(variables.keys())])
+    ds.close()
+    return pd.concat(dataframes)
+
+
+def _read_wide_csv(fname,column_pattern,variable_names,
+                   variables=None,heights=None,
+                   datetime_format=None,dayfirst=False,
+                   chunksize=None,
+                   verbose=False,
+                   **kwargs):
+    """Read a text file with a datetime column and a data column for
+    each height and quantity, where the column name is parsed by
+    `column_pattern` to get the height and quantity. Only the requested
+    columns are read, and each chunk of rows is reshaped into a
+    dataframe with a (datetime, height) MultiIndex.
+    """
+    columns = pd.read_csv(fname, nrows=0, **kwargs).columns
+    datetime_column = columns[0]
+    # associate data columns with heights and standard names
+    selected = {}
+    for col in columns:
+        match = column_pattern.match(col.strip())
+        if match is None:
+            continue
+        name = variable_names.get(match.group('variable'))
+        if (name is None) or ((variables is not None) and (name not in variables)):
+            continue
+        z = float(match.group('height'))
+        if (heights is not None) and (z not in heights):
+            continue
+        selected[(z,name)] = col
+    if len(selected) == 0:
+        raise ValueError('No data columns found for {}'.format(variables))
+    zs = sorted(set([z for z,_ in selected]))
+    names = list(dict.fromkeys([name for _,name in selected]))
+    if variables is not None:
+        names = [name for name in variables if name in names]
+    if verbose:
+        print('Reading',names,'at',len(zs),'heights')
+    izs = { z: i for i,z in enumerate(zs) }
+    inames = { name: i for i,name in enumerate(names) }
+
+    reader = pd.read_csv(fname, usecols=[datetime_column]+list(selected.values()),
+                         chunksize=chunksize, **kwargs)
+    if chunksize is None:
+        reader = [reader]
+    dataframes = []
+    for chunk in reader:
+        datetime = pd.to_datetime(chunk[datetime_column],
+                                  format=datetime_format, dayfirst=dayfirst)
+        data = np.full((len(chunk),len(zs),len(names)), np.nan)
+        for (z,name),col in selected.items():
+            data[:,izs[z],inames[name]] = chunk[col].to_numpy(dtype=float)
+        index = pd.MultiIndex.from_arrays(
+                [np.repeat(datetime.values,len(zs)), np.tile(zs,len(chunk))],
+                names=['datetime','height'])
+        dataframes.append(pd.DataFrame(data=data.reshape((-1,len(names))),
+                                       index=index, columns=names))
+    return pd.concat(dataframes)
@@ -4,7 +4,9 @@ Data readers for meteorological towers
 Based on https://github.com/NWTC/datatools/blob/master/metmast.py
 """
 import os
+import re
 import inspect
+import functools
 from collections import OrderedDict
 import numpy as np
 import pandas as pd
@@ -79,7 +81,8 @@ def read_data(fpath, column_spec,
               datetime_start='', datetime_start_format='',
               data_freq=None, max_data_rows=None, output_freq=None,
               datetime=None, datetime_offset=None,
-              start=pd.datetime(1990,1,1), end=pd.datetime.today(),
+              start=pd.Timestamp(1990,1,1), end=pd.Timestamp.today(),
+              chunksize=None, resample=None, pairs=None,
               return_description=False,
               verbose=False,
               **kwargs):
@@ -125,14 +128,358 @@ def read_data(fpath, column_spec,
         number of data rows in output files
     start,end : str or datetime, optional
         Trim the data down to this specified time range
+    chunksize : int, optional
+        Read and process the datafile this many rows at a time
+    resample : str, optional
+        Instead of the raw data, return the means and covariances of
+        all data columns in intervals described by a pandas offset
+        string (e.g., '10min'), as calculated by
+        helper_functions.StreamingStatistics; with chunksize, the raw
+        data are never held in memory all at once. Intervals spanning
+        chunk boundaries are handled exactly. The wind speed and
+        direction are calculated from the mean velocity components.
+    pairs : list, optional
+        If resample is specified, list of (a,b) column-name pairs for
+        which to calculate covariances (named a+b in the output); by
+        default, all unique pairs are calculated
     **kwargs : optional
         Additional arguments to pass to pandas.read_csv()
     """
     columns = column_spec.keys()
-    df = pd.read_csv(fpath,names=columns,**kwargs)
+    datetime_columns = [col for col,fmt in column_spec.items()
+                        if isinstance(fmt,str)]
+    if (len(datetime_columns) == 0) and \
+            ((datetime is None) and ((datetime_start=='') or (data_freq is None))):
+        raise ValueError('No datetime data in file; need to specify datetime, or datetime_start and data_freq')
+    elif (len(datetime_columns) > 0) and (datetime is not None):
+        if verbose:
+            print('Note: datetime specified; datetime information in datafile ignored')
+    elif (len(datetime_columns) > 0) and \
+            (datetime_start != '') and (data_freq is not None):
+        if verbose:
+            print('Note: datetime_start and data_freq specified; datetime information in datafile ignored')
+
+    if callable(datetime_start):
+        # parse datetime from file name
+        fname = os.path.split(fpath)[-1]
+        datetime_start = datetime_start(fname)
+
+    if chunksize is None:
+        chunks = [pd.read_csv(fpath,names=columns,**kwargs)]
+    else:
+        chunks = pd.read_csv(fpath,names=columns,chunksize=chunksize,**kwargs)
+
+    return _standardize_chunks(chunks, column_spec,
+                               height=height, multi_index=multi_index,
+                               datetime_start=datetime_start,
+                               datetime_start_format=datetime_start_format,
+                               data_freq=data_freq,
+                               max_data_rows=max_data_rows,
+                               output_freq=output_freq,
+                               datetime=datetime,
+                               datetime_offset=datetime_offset,
+                               start=start, end=end,
+                               resample=resample, pairs=pairs,
+                               return_description=return_description,
+                               verbose=verbose)
+
+
+# Campbell Scientific datalogger files
+# ====================================
+# Data types in TOB1 binary files, see the LoggerNet manual
+campbell_tob1_types = {
+    'IEEE4': '<f4', 'IEEE4L': '<f4', 'IEEE4B': '>f4',
+    'IEEE8': '<f8', 'IEEE8L': '<f8', 'IEEE8B': '>f8',
+    'FP2': '>u2', # Campbell 2-byte floating point, decoded in _decode_fp2()
+    'ULONG': '<u4', 'LONG': '<i4',
+    'UINT2': '<u2', 'INT2': '<i2', 'UINT4': '<u4', 'INT4': '<i4',
+    'BOOL': 'u1', 'BOOL2': '<u2', 'BOOL4': '<u4',
+    'SecNano': [('seconds','<u4'),('nanoseconds','<u4')],
+}
+campbell_epoch = np.datetime64('1990-01-01','ns')
+campbell_time_fields = ['TIMESTAMP','RECORD','SECONDS','NANOSECONDS']
+
+def read_campbell(fpath, column_spec, chunksize=None, verbose=False,
+                  **kwargs):
+    """Read in data from a Campbell Scientific datalogger file in TOB1
+    (binary) or TOA5 (ASCII) format and standardize outputs as in
+    read_data()
+
+    Datetimes are taken from the datalogger timestamps. The data
+    fields are associated with the column_spec entries by name if all
+    (non-datetime) column_spec names appear in the file, otherwise in
+    order, as for read_data(). TOB1 records are mapped into memory and
+    decoded one chunk at a time.
+
+    Inputs
+    ------
+    fpath : str
+        Path to TOB1 or TOA5 file
+    column_spec : OrderedDict
+        Pairs of column names and data formats, e.g., Metek_USA1
+    chunksize : int, optional
+        Read and process the datafile this many records at a time
+    **kwargs : optional
+        See read_data() for a description of the optional arguments
+    """
+    header = read_campbell_header(fpath)
+    fieldmap = _campbell_field_map(header['fields'], column_spec)
+    if verbose:
+        print('Reading {:s} file from {:s}, table {:s}'.format(
+              header['format'],header['station'],header['table']))
+        for col,field in fieldmap.items():
+            print('  {:s} : {:s}'.format(col,field))
+    if header['format'] == 'TOB1':
+        chunks = _tob1_chunks(fpath, header, fieldmap, chunksize)
+    elif header['format'] == 'TOA5':
+        chunks = _toa5_chunks(fpath, header, fieldmap, chunksize)
+    else:
+        raise ValueError('Unsupported Campbell file format: {:s}'.format(
+                         header['format']))
+    return _standardize_chunks(chunks, column_spec, verbose=verbose, **kwargs)
+
+def read_campbell_header(fpath):
+    """Read the ASCII header of a Campbell Scientific TOB1 or TOA5
+    file and return a dictionary with the file format, station and
+    table names, field names, units, processing, data types (TOB1
+    only), and the number of header bytes
+    """
+    with open(fpath,'rb') as f:
+        firstline = f.readline()
+        fileinfo = _split_campbell_line(firstline)
+        fmt = fileinfo[0]
+        nlines = 5 if (fmt == 'TOB1') else 4
+        lines = [_split_campbell_line(f.readline()) for _ in range(nlines-1)]
+        nbytes = f.tell()
+    header = dict(format=fmt,
+                  station=fileinfo[1] if len(fileinfo) > 1 else '',
+                  table=fileinfo[-1],
+                  fields=lines[0],
+                  units=lines[1],
+                  processing=lines[2],
+                  header_bytes=nbytes)
+    if fmt == 'TOB1':
+        header['types'] = lines[3]
+    return header
+
+def _split_campbell_line(line):
+    return [s.strip('"') for s in line.decode('ascii').strip().split(',')]
 
-    # standardize the data
-    datetime_columns = []
+def _campbell_field_map(fields,column_spec):
+    """Associate column_spec names with datalogger fields"""
+    datafields = [field for field in fields
+                  if field not in campbell_time_fields]
+    columns = [col for col,fmt in column_spec.items()
+               if not isinstance(fmt,str)]
+    if all([col in datafields for col in columns]):
+        return OrderedDict([(col,col) for col in columns])
+    if len(datafields) < len(columns):
+        raise ValueError('Expected {:d} data fields, found {:s}'.format(
+                         len(columns),str(datafields)))
+    return OrderedDict(zip(columns,datafields))
+
+def _tob1_dtype(header):
+    """Numpy structured dtype describing a TOB1 record"""
+    dtype = []
+    for field,typename in zip(header['fields'],header['types']):
+        if typename.startswith('ASCII'):
+            # e.g., ASCII(16)
+            dtype.append((field, 'S'+typename[6:-1]))
+        else:
+            try:
+                dtype.append((field, campbell_tob1_types[typename]))
+            except KeyError:
+                raise ValueError('Unknown TOB1 data type {:s} for field {:s}'.format(
+                                 typename,field))
+    return np.dtype(dtype)
+
+def _tob1_chunks(fpath,header,fieldmap,chunksize=None):
+    """Generate dataframes from consecutive chunks of TOB1 records"""
+    dtype = _tob1_dtype(header)
+    nrec = (os.path.getsize(fpath) - header['header_bytes']) // dtype.itemsize
+    if nrec == 0:
+        return
+    records = np.memmap(fpath, dtype=dtype, mode='r',
+                        offset=header['header_bytes'], shape=(nrec,))
+    if chunksize is None:
+        chunksize = nrec
+    for i in range(0,nrec,chunksize):
+        chunk = records[i:i+chunksize]
+        data = OrderedDict()
+        data[datetime_name] = _tob1_datetime(chunk, header)
+        for col,field in fieldmap.items():
+            values = chunk[field]
+            if header['types'][header['fields'].index(field)] == 'FP2':
+                values = _decode_fp2(values)
+            elif values.dtype.kind == 'f':
+                # standardize in double precision, as for read_data()
+                values = values.astype(np.float64)
+            elif not values.dtype.isnative:
+                values = values.astype(values.dtype.newbyteorder('='))
+            data[col] = values
+        yield pd.DataFrame(data)
+
+def _tob1_datetime(records,header):
+    """Datalogger timestamps of TOB1 records"""
+    fields = header['fields']
+    types = dict(zip(fields,header['types']))
+    if ('SECONDS' in fields) and ('NANOSECONDS' in fields):
+        seconds = records['SECONDS']
+        nanoseconds = records['NANOSECONDS']
+    else:
+        try:
+            field = fields[list(types.values()).index('SecNano')]
+        except ValueError:
+            raise ValueError('No datalogger timestamp in TOB1 file')
+        seconds = records[field]['seconds']
+        nanoseconds = records[field]['nanoseconds']
+    nanoseconds = seconds.astype(np.int64)*10**9 + nanoseconds
+    return campbell_epoch + nanoseconds.astype('timedelta64[ns]')
+
+def _decode_fp2(raw):
+    """Decode Campbell 2-byte floating point values: a sign bit, 2-bit
+    negative decimal exponent, and 13-bit mantissa
+    """
+    raw = raw.astype(np.uint16)
+    sign = np.where(raw & 0x8000, -1.0, 1.0)
+    exponent = (raw >> 13) & 0x3
+    mantissa = (raw & 0x1FFF).astype(np.float64)
+    values = sign * mantissa / 10.0**exponent
+    values[raw == 0x1FFF] = np.inf
+    values[raw == 0x9FFF] = -np.inf
+    values[raw == 0x9FFE] = np.nan
+    return values
+
+def _toa5_chunks(fpath,header,fieldmap,chunksize=None):
+    """Generate dataframes from consecutive chunks of TOA5 records"""
+    reader = pd.read_csv(fpath, header=None, names=header['fields'],
+                         skiprows=4, usecols=['TIMESTAMP']+list(fieldmap.values()),
+                         na_values=['NAN','INF','-INF'],
+                         chunksize=chunksize)
+    if chunksize is None:
+        reader = [reader]
+    for chunk in reader:
+        data = OrderedDict()
+        data[datetime_name] = _toa5_datetime(chunk['TIMESTAMP'])
+        for col,field in fieldmap.items():
+            data[col] = chunk[field]
+        yield pd.DataFrame(data)
+
+def _toa5_datetime(timestamps):
+    """Convert TOA5 timestamps, which only include fractional seconds
+    where these are nonzero (e.g., "2020-01-01 00:00:00" followed by
+    "2020-01-01 00:00:00.1"), splitting off the fraction so that a
+    single explicit format can be used
+    """
+    parts = timestamps.str.partition('.')
+    datetime = pd.to_datetime(parts[0], format='%Y-%m-%d %H:%M:%S', cache=True)
+    nanoseconds = parts[2].str.ljust(9,'0').str[:9].astype(np.int64)
+    return datetime + pd.to_timedelta(nanoseconds.values, unit='ns')
+
+
+def _standardize_chunks(chunks,column_spec,
+                        height=None, multi_index=True,
+                        datetime_start='', datetime_start_format='',
+                        data_freq=None, max_data_rows=None, output_freq=None,
+                        datetime=None, datetime_offset=None,
+                        start=pd.Timestamp(1990,1,1), end=pd.Timestamp.today(),
+                        resample=None, pairs=None,
+                        return_description=False,
+                        verbose=False):
+    """Standardize a sequence of dataframes read from consecutive rows
+    of a datafile, with columns named by column_spec; see read_data()
+    for a description of the optional arguments
+    """
+    datetime_columns = [col for col,fmt in column_spec.items()
+                        if isinstance(fmt,str)]
+    stats = None
+    output = []
+    description = []
+    nrows = 0
+    for df in chunks:
+        if (max_data_rows is not None) and (nrows >= max_data_rows):
+            break
+        df, description = _standardize_columns(df, column_spec)
+        df = _set_datetime(df, column_spec, datetime_columns,
+                           datetime=datetime,
+                           datetime_start=datetime_start,
+                           datetime_start_format=datetime_start_format,
+                           data_freq=data_freq, row_offset=nrows,
+                           verbose=verbose)
+        row_offset = nrows
+        nrows += len(df)
+
+        if max_data_rows is not None:
+            df = df.iloc[:max_data_rows-row_offset]
+        if output_freq is not None:
+            # every Nth row of the datafile, counting from the first row
+            N = int(output_freq)
+            df = df.iloc[(-row_offset)%N::N,:]
+
+        # add time offset, e.g., for standardizing data that were averaged to the
+        # beginning/end of an interval
+        if datetime_offset is not None:
+            offset = pd.to_timedelta(datetime_offset,unit='s')
+            df[datetime_name] += offset
+
+        # trim datetime
+        start = pd.to_datetime(start)
+        end = pd.to_datetime(end)
+        datetime_range = (df[datetime_name] >= start) & (df[datetime_name] <= end)
+        df = df.loc[datetime_range]
+
+        # set height column (and multi-index)
+        df[height_name] = height
+        if height and multi_index:
+            df = df.set_index([datetime_name,height_name])
+        else:
+            df = df.set_index(datetime_name)
+
+        if resample is None:
+            output.append(df)
+        elif len(df) > 0:
+            # reduce to interval statistics, carrying incomplete intervals
+            # over to the next chunk
+            if stats is None:
+                from ..helper_functions import StreamingStatistics
+                variables = [col for col in df.columns
+                             if pd.api.types.is_numeric_dtype(df[col])
+                             and (col != height_name)]
+                stats = StreamingStatistics(variables, interval=resample,
+                                            pairs=pairs, higher_moments=False)
+            output.append(stats.update(df))
+        if verbose:
+            print('Processed',nrows,'rows')
+    if stats is not None:
+        output.append(stats.finalize())
+    elif resample is not None:
+        raise ValueError('No data between {} and {}'.format(start,end))
+    df = pd.concat(output)
+
+    # standard calculations
+    if not windspeed_name in column_spec.keys():
+        # assume we have u,v velocity components
+        df[windspeed_name] = np.sqrt(df['u']**2 + df['v']**2)
+    if not winddirection_name in column_spec.keys():
+        # assume we have u,v velocity components
+        wdir = np.degrees(np.arctan2(-df['u'],-df['v']))
+        df[winddirection_name] = wdir.where(wdir >= 0, wdir + 360.0)
+    try:
+        # drop "nonstandard" variables
+        df = df.drop(columns=['u','v'])
+    except KeyError: pass
+
+    #print('\n'.join(description))
+    if return_description:
+        return df, description
+    else:
+        return df
+
+
+def _standardize_columns(df,column_spec):
+    """Convert data columns to standard units and drop ignored columns,
+    as described by column_spec
+    """
     description = []
     for col,fmt in column_spec.items():
         if fmt==1:
@@ -144,48 +491,46 @@ def read_data(fpath, column_spec,
             df[col] = df[col] / fmt
         elif callable(fmt):
             # apply function to column
-            funcdesc = inspect.getsource(fmt)
-            eqidx = funcdesc.index('=')
-            funcdesc = funcdesc[eqidx+1:].strip()
+            funcdesc = _describe_function(fmt)
             description.append('applied function ({:s}) to column {:s}'.format(funcdesc,col))
-            df[col] = df[col].apply(fmt)
+            df[col] = _apply_function(fmt, df[col])
         elif isinstance(fmt,str):
-            # collect datetime column names
+            # datetime column, handled by _set_datetime()
             #description.append('read datetime-related column {:s}'.format(col))
-            datetime_columns.append(col)
+            continue
         elif fmt is None:
             description.append('ignored column {:s}'.format(col))
             df = df.drop(columns=col)
         else:
             raise TypeError('Unexpected column name/format:',(col,fmt))
-    if (len(datetime_columns) == 0) and \
-            ((datetime is None) and ((datetime_start=='') or (data_freq is None))):
-        raise ValueError('No datetime data in file; need to specify datetime, or datetime_start and data_freq')
-    elif (len(datetime_columns) > 0) and (datetime is not None):
-        if verbose:
-            print('Note: datetime specified; datetime information in datafile ignored')
-    elif (len(datetime_columns) > 0) and \
-            (datetime_start != '') and (data_freq is not None):
-        if verbose:
-            print('Note: datetime_start and data_freq specified; datetime information in datafile ignored')
-
-    if callable(datetime_start):
-        # parse datetime from file name
-        fname = os.path.split(fpath)[-1]
-        datetime_start = datetime_start(fname)
+    return df, description
 
-    # set up date/time column
+def _set_datetime(df,column_spec,datetime_columns,datetime=None,
+                  datetime_start='',datetime_start_format='',data_freq=None,
+                  row_offset=0,verbose=False):
+    """Set up the datetime column of a (chunk of a) datafile that starts
+    at row number row_offset; see read_data() for a description of the
+    optional arguments
+    """
     if datetime is not None:
         # use user-specified datetime
-        df[datetime_name] = datetime
+        if row_offset == 0 and len(datetime) == len(df):
+            df[datetime_name] = datetime
+        else:
+            df[datetime_name] = np.asarray(datetime)[row_offset:row_offset+len(df)]
     elif datetime_start and data_freq:
         # use user-specified start datetime and time interval ('data_freq')
         # specified by a pandas offset string
         # ref: http://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html#dateoffset-objects
         datetime_start = pd.to_datetime(datetime_start,
                                         format=datetime_start_format)
-        df[datetime_name] = pd.DatetimeIndex(start=datetime_start,
-                                             periods=len(df), freq=data_freq)
+        if row_offset > 0:
+            datetime_start += row_offset * pd.tseries.frequencies.to_offset(data_freq)
+        df[datetime_name] = pd.date_range(start=datetime_start,
+                                          periods=len(df), freq=data_freq)
+    elif pd.api.types.is_datetime64_any_dtype(df.get(datetime_name)):
+        # datetimes were read with the data, e.g., datalogger timestamps
+        pass
     elif datetime_name in datetime_columns:
         # we have complete information
         datetime_format = column_spec[datetime_name]
@@ -200,6 +545,14 @@ def read_data(fpath, column_spec,
         df[datetime_name] = pd.to_datetime(df[date_name]+df[time_name],
                                            format=date_format+time_format)
         df = df.drop(columns=[date_name,time_name])
+    elif (datetime_start == '') and \
+            _integer_datetime_columns(df, datetime_columns, column_spec):
+        # all datetime information is stored as integers, e.g., year
+        # (%Y), day (%j), and time (%H%M) columns: get the components
+        # arithmetically
+        df[datetime_name] = _datetime_from_integers(df, datetime_columns,
+                                                    column_spec)
+        df = df.drop(columns=datetime_columns)
     else:
         # try to cobble together datetime information from all text columns
         # - convert datetime columns into string type (so that we can add them
@@ -208,21 +561,21 @@ def read_data(fpath, column_spec,
         #   e.g. %H%M : 01:00 --> 100 (instead of '0100')
         test_strings = ['%H','%M','%S']
         for col in datetime_columns:
-            if df[col].dtype == np.int64:
+            if pd.api.types.is_integer_dtype(df[col]):
                 fmt = column_spec[col]
                 if any([s in fmt for s in test_strings]):
                     for strftime_str in test_strings:
                         fmt = fmt.replace(strftime_str,'00')
                     timestrlen = len(fmt)
                     # convert integer column data into zero-padded string
-                    zeropadfmt = '{:0' + str(timestrlen) + '}'
-                    df[col] = df[col].apply(lambda t: zeropadfmt.format(t))
+                    df[col] = df[col].astype(str).str.zfill(timestrlen)
                 else:
                     # convert integer column, e.g., year(, month, day) into str
                     df[col] = df[col].astype(str)
         # - combine all datetime columns into a series
-        datetime = datetime_start \
-                + df[datetime_columns].apply(lambda cols: ''.join(cols), axis=1)
+        datetime = pd.Series(datetime_start, index=df.index)
+        for col in datetime_columns:
+            datetime = datetime + df[col].astype(str)
         # - combine all format strings
         datetime_format = datetime_start_format \
                 + ''.join([column_spec[col] for col in datetime_columns])
@@ -232,50 +585,79 @@ def read_data(fpath, column_spec,
             print(datetime)
         df[datetime_name] = pd.to_datetime(datetime, format=datetime_format)
         df = df.drop(columns=datetime_columns)
+    return df
 
-    if max_data_rows is not None:
-        df = df.iloc[:max_data_rows]
-    if output_freq is not None:
-        N = int(output_freq)
-        df = df.iloc[::N,:]
-
-    # add time offset, e.g., for standardizing data that were averaged to the
-    # beginning/end of an interval
-    if datetime_offset is not None:
-        offset = pd.to_timedelta(datetime_offset,unit='s')
-        df[datetime_name] += offset
-
-    # trim datetime
-    start = pd.to_datetime(start)
-    end = pd.to_datetime(end)
-    datetime_range = (df[datetime_name] >= start) & (df[datetime_name] <= end)
-    df = df.loc[datetime_range]
-
-    # set height column (and multi-index)
-    df[height_name] = height
-    if height and multi_index:
-        df = df.set_index([datetime_name,height_name])
-    else:
-        df = df.set_index(datetime_name)
 
-    # standard calculations
-    if not windspeed_name in column_spec.keys():
-        # assume we have u,v velocity components
-        df[windspeed_name] = np.sqrt(df['u']**2 + df['v']**2)
-    if not winddirection_name in column_spec.keys():
-        # assume we have u,v velocity components
-        df[winddirection_name] = np.degrees(np.arctan2(-df['u'],-df['v']))
-        df.loc[df[winddirection_name] < 0, winddirection_name] += 360.0
+@functools.lru_cache(maxsize=None)
+def _describe_function(func):
+    """Description of a callable column spec, from its source code"""
     try:
-        # drop "nonstandard" variables
-        df = df.drop(columns=['u','v'])
-    except KeyError: pass
+        funcdesc = inspect.getsource(func)
+    except (OSError,TypeError):
+        return repr(func)
+    eqidx = funcdesc.find('=')
+    return funcdesc[eqidx+1:].strip()
 
-    #print('\n'.join(description))
-    if return_description:
-        return df, description
+def _apply_function(func,series):
+    """Apply a callable column spec to a whole column at once, falling
+    back to elementwise evaluation for functions that do not accept
+    arrays
+    """
+    try:
+        result = func(series)
+    except Exception:
+        # e.g., AttributeError for str methods such as lambda x: x.strip()
+        result = None
+    if not isinstance(result,pd.Series) or (len(result) != len(series)):
+        result = series.apply(func)
+    return result
+
+# number of digits in integer datetime components
+_datetime_directive_widths = {
+    '%Y': 4, '%y': 2, '%m': 2, '%d': 2, '%j': 3, '%H': 2, '%M': 2, '%S': 2,
+}
+_integer_datetime_format = re.compile(
+        '^(' + '|'.join(_datetime_directive_widths.keys()) + ')+$')
+
+def _integer_datetime_columns(df,datetime_columns,column_spec):
+    """Whether the datetime columns are all integers with purely
+    numeric formats (e.g., %Y, %j, %H%M) that include the year
+    """
+    if len(datetime_columns) == 0:
+        return False
+    fmts = ''.join([column_spec[col] for col in datetime_columns])
+    return all([pd.api.types.is_integer_dtype(df[col])
+                and _integer_datetime_format.match(column_spec[col])
+                for col in datetime_columns]) \
+            and (('%Y' in fmts) or ('%y' in fmts))
+
+def _datetime_from_integers(df,datetime_columns,column_spec):
+    """Assemble datetimes from integer datetime columns, e.g., 1330
+    with format %H%M is split into 13 h and 30 min
+    """
+    parts = {}
+    for col in datetime_columns:
+        values = df[col].values.astype(np.int64)
+        directives = re.findall('%[A-Za-z]', column_spec[col])
+        for i,directive in enumerate(directives[::-1]):
+            if i < len(directives)-1:
+                ndigits = 10**_datetime_directive_widths[directive]
+                parts[directive] = values % ndigits
+                values = values // ndigits
+            else:
+                parts[directive] = values
+    if '%Y' in parts:
+        year = parts['%Y']
     else:
-        return df
+        year = parts['%y'] + np.where(parts['%y'] < 69, 2000, 1900)
+    ones = np.ones(len(df), dtype=np.int64)
+    datetime = pd.to_datetime(dict(year=year,
+                                   month=parts.get('%m',ones),
+                                   day=parts.get('%d',ones)))
+    offset = 86400*(parts['%j'] - 1) if ('%j' in parts) else 0
+    offset = offset + 3600*parts.get('%H',0) + 60*parts.get('%M',0) \
+            + parts.get('%S',0)
+    return datetime + pd.to_timedelta(offset, unit='s')
 
 
 def standard_output(df,output=None,**kwargs):
@@ -291,6 +673,9 @@ def standard_output(df,output=None,**kwargs):
         # Output type will be dictated by the output file extension
         standard_output(df,'/path/to/data.csv')
         standard_output(df,'/path/to/data.nc')
+        standard_output(df,'/path/to/data.zarr')
+    For netCDF/zarr output, chunking and compression are set by
+    datawriters.write_dataset(), to which kwargs are passed.
     """
     index_names = df.index.names
     df = df.reset_index()
@@ -305,8 +690,9 @@ def standard_output(df,output=None,**kwargs):
         _,ext = os.path.splitext(output)        
         if ext == '.csv':
             df.to_csv(output,**kwargs)
-        elif ext == '.nc':
-            df.to_xarray().to_netcdf(output,**kwargs)
+        elif ext in ('.nc','.zarr'):
+            from ..datawriters import write_dataset
+            write_dataset(df.to_xarray(),output,**kwargs)
         else:
             raise NotImplementedError('Output extension {:s} not supported'.format(ext))
 
@@ -315,7 +701,12 @@ def tilt_correction(u,v,w,
                     tilts=[[]]):
     """Corrects sonic velocities for tilt given regularization
     coefficients and tilt angles. Velocities should have dimensions
-    (time,height) or (height,).
+    (time,height) or (height,). The inputs are not modified.
+
+    The rotation matrices for all levels are assembled into one
+    (Nz,3,3) array and applied to all times and levels at once.
+    Regularization coefficients and tilt angles may be estimated from
+    the data with planar_fit().
 
     Based on JAS' implementation of Branko's correction from EOL 
     description.
@@ -326,6 +717,9 @@ def tilt_correction(u,v,w,
         v = v.values
     if isinstance(w,pd.DataFrame):
         w = w.values
+    u = np.asarray(u, dtype=float)
+    v = np.asarray(v, dtype=float)
+    w = np.asarray(w, dtype=float)
     if len(u.shape) == 1:
         Nt = 1
         Nz = len(u)
@@ -339,33 +733,78 @@ def tilt_correction(u,v,w,
     assert u.shape == v.shape == w.shape
     assert len(reg_coefs) == Nz
     assert len(tilts) == Nz
-    for lvl in range(Nz):
-        a,b,c = reg_coefs[lvl]
-        tilt, tiltaz = tilts[lvl]
-        #Wf = ( sin(tilt)*cos(tiltaz), sin(tilt)*sin(tiltaz), cos(tilt) )
-        wf1 = np.sin(tilt) * np.cos(tiltaz)
-        wf2 = np.sin(tilt) * np.sin(tiltaz)
-        wf3 = np.cos(tilt)
-        #U'f = ((cos(tilt), 0, -sin(tilt)*cos(tiltaz))
-        uf1 = np.cos(tilt)
-        uf2 = 0.
-        uf3 = -np.sin(tilt) * np.cos(tiltaz)
-        ufm = np.sqrt(uf1**2 + uf2**2 + uf3**2)
-        uf1 = uf1 / ufm
-        uf2 = uf2 / ufm
-        uf3 = uf3 / ufm
-        #vf = wf x uf
-        vf1 = wf2*uf3 - wf3*uf2
-        vf2 = wf3*uf1 - wf1*uf3
-        vf3 = wf1*uf2 - wf2*uf1
-        ug = uf1*u[:,lvl] + uf2*v[:,lvl] + uf3*(w[:,lvl] - a)
-        vg = vf1*u[:,lvl] + vf2*v[:,lvl] + vf3*(w[:,lvl] - a)
-        wg = wf1*u[:,lvl] + wf2*v[:,lvl] + wf3*(w[:,lvl] - a)
-        u[:,lvl] = ug
-        v[:,lvl] = vg
-        w[:,lvl] = wg
+    a = np.asarray(reg_coefs, dtype=float)[:,0]
+    tilt, tiltaz = np.asarray(tilts, dtype=float).T
+    R = np.empty((Nz,3,3))
+    #Wf = ( sin(tilt)*cos(tiltaz), sin(tilt)*sin(tiltaz), cos(tilt) )
+    R[:,2,0] = np.sin(tilt) * np.cos(tiltaz)
+    R[:,2,1] = np.sin(tilt) * np.sin(tiltaz)
+    R[:,2,2] = np.cos(tilt)
+    #U'f = ((cos(tilt), 0, -sin(tilt)*cos(tiltaz))
+    R[:,0,0] = np.cos(tilt)
+    R[:,0,1] = 0.
+    R[:,0,2] = -np.sin(tilt) * np.cos(tiltaz)
+    R[:,0,:] /= np.linalg.norm(R[:,0,:], axis=1, keepdims=True)
+    #vf = wf x uf
+    R[:,1,:] = np.cross(R[:,2,:], R[:,0,:])
+    vel = np.stack([u, v, w - a], axis=-1)
+    ug,vg,wg = np.moveaxis(np.einsum('zij,tzj->tzi', R, vel, optimize=True),
+                           -1, 0)
     if Nt == 1:
-        return u.squeeze(),v.squeeze(),w.squeeze()
+        return ug.squeeze(),vg.squeeze(),wg.squeeze()
     else:
-        return u,v,w
+        return ug,vg,wg
+
+def planar_fit(u,v,w):
+    """Estimate the regularization coefficients and tilt angles for
+    tilt_correction() by fitting the plane
+
+        w = a + b*u + c*v
+
+    to the sonic velocities at each level, e.g., interval-mean
+    velocities over a long period (Wilczak et al., Boundary-Layer
+    Meteorol., 2001). Velocities should have dimensions (time,height);
+    all levels are fit at once by least squares, ignoring times with
+    missing (NaN) data. Levels without enough valid data to determine
+    the plane (e.g., fewer than 3 valid times) get NaN coefficients and
+    tilt angles.
+
+    Returns
+    -------
+    reg_coefs : np.ndarray
+        Coefficients (a,b,c) with dimensions (height,3)
+    tilts : np.ndarray
+        Tilt and tilt azimuth angles [rad] with dimensions (height,2)
+    """
+    if isinstance(u,pd.DataFrame):
+        u = u.values
+    if isinstance(v,pd.DataFrame):
+        v = v.values
+    if isinstance(w,pd.DataFrame):
+        w = w.values
+    u = np.asarray(u, dtype=float)
+    v = np.asarray(v, dtype=float)
+    w = np.asarray(w, dtype=float)
+    if len(u.shape) == 1:
+        u = u[:,np.newaxis]
+        v = v[:,np.newaxis]
+        w = w[:,np.newaxis]
+    assert u.shape == v.shape == w.shape
+    valid = np.isfinite(u) & np.isfinite(v) & np.isfinite(w)
+    X = np.stack([np.ones(u.shape), u, v], axis=-1)
+    X[~valid] = 0
+    y = np.where(valid, w, 0)
+    # normal equations for each level
+    XtX = np.einsum('tzi,tzj->zij', X, X)
+    Xty = np.einsum('tzi,tz->zi', X, y)
+    fitted = (valid.sum(axis=0) >= 3) & (np.linalg.matrix_rank(XtX) == 3)
+    XtX[~fitted] = np.eye(3)
+    reg_coefs = np.linalg.solve(XtX, Xty[...,np.newaxis])[...,0]
+    reg_coefs[~fitted] = np.nan
+    b = reg_coefs[:,1]
+    c = reg_coefs[:,2]
+    # the unit normal of the plane is Wf in tilt_correction()
+    tilts = np.stack([np.arctan(np.sqrt(b**2 + c**2)),
+                      np.arctan2(-c, -b)], axis=-1)
+    return reg_coefs, tilts
 
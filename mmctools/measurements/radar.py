@@ -3,6 +3,10 @@ Data readers for remote sensing devices (e.g., 3D data)
 
 Based on https://github.com/NWTC/datatools/blob/master/remote_sensing.py
 """
+import os
+import io
+import mmap
+import functools
 import numpy as np
 import pandas as pd
 
@@ -15,6 +19,7 @@ def profiler(fname,scans=None,
              check_na=['SPD','DIR'],na_values=999999,
              height_name='HT',
              read_scan_properties=False,
+             nprocs=1,
              verbose=False):
     """Wind Profiler radar with RASS
 
@@ -34,8 +39,13 @@ def profiler(fname,scans=None,
     Additional data format reference:
     https://www.esrl.noaa.gov/psd/data/obs/formats/
 
+    The byte offsets of the data blocks in each file are indexed first
+    (and cached), so that only the requested scans are parsed.
+
     Usage
     =====
+    fname : str or list
+        Data file, or list of data files to read and concatenate
     scans : int, list, or None
         Number of data blocks to read from file; a list of zero-indexed
         scans to read from file; or set to None to read all data
@@ -63,6 +73,8 @@ def profiler(fname,scans=None,
         scan information list is provided (to be updated). Note that
         this has only be implemented for the TTU radar format at the 
         moment.
+    nprocs : int, optional
+        Number of processes with which to parse data blocks
     """
     dataframes = []
     if read_scan_properties is True:
@@ -74,8 +86,15 @@ def profiler(fname,scans=None,
         scantypes = read_scan_properties
         read_scan_properties = True
         print_scan_properties = False
-    def match_scan_type(newscan):
+    # registry of scan type ids, keyed by the scan information text
+    scantype_ids = {}
+    def match_scan_type(newscan,key):
         assert (newscan is not None)
+        try:
+            return scantype_ids[key]
+        except KeyError:
+            pass
+        # first occurrence of this scan information text
         match = False
         for itype, scaninfo in enumerate(scantypes):
             if newscan==scaninfo:
@@ -87,56 +106,62 @@ def profiler(fname,scans=None,
             # new scan type
             scantypes.append(newscan)
             scantypeid = len(scantypes)-1
+        scantype_ids[key] = scantypeid
         return scantypeid
-    with open(fname,'r') as f:
-        if scans is not None:
-            if hasattr(scans,'__iter__'):
-                # specified scans to read
-                scans_to_read = np.arange(np.max(scans)+1)
-            else:
-                # specified number of scans
-                scans_to_read = np.arange(scans)
-                scans = scans_to_read
-            for iscan in scans_to_read:
-                try:
-                    df,scaninfo = _read_profiler_data_block(
-                            f, expected_data_type=data_type,
-                            datetime_format=datetime_format,
-                            num_info_lines=num_info_lines,
-                            read_scan_properties=read_scan_properties)
-                except (IOError,IndexError):
-                    break
-                if iscan in scans:
-                    if verbose:
-                        print('Adding scan',iscan,
-                              'at',df['datetime'].unique(),df.index)
-                    if read_scan_properties:
-                        df['scan_type'] = match_scan_type(scaninfo)
-                    dataframes.append(df)
-                else:
-                    if verbose:
-                        print('Skipping scan',iscan,
-                              'at',df['datetime'].unique(),df.index)
+    # find the requested data blocks
+    fnames = [fname] if isinstance(fname,str) else list(fname)
+    blocks = []
+    for fpath in fnames:
+        offsets = profiler_block_index(fpath)
+        if scans is None:
+            scans_to_read = np.arange(len(offsets))
+        elif hasattr(scans,'__iter__'):
+            # specified scans to read
+            scans_to_read = np.unique(scans)
+            scans_to_read = scans_to_read[scans_to_read < len(offsets)]
         else:
-            # read all scans
-            iscan = 0
-            while True:
-                try:
-                    df,scaninfo = _read_profiler_data_block(
-                            f, expected_data_type=data_type,
-                            datetime_format=datetime_format,
-                            num_info_lines=num_info_lines,
-                            read_scan_properties=read_scan_properties)
-                except (IOError,IndexError):
-                    break
-                else:
-                    if verbose:
-                        print('Read scan',iscan,
-                              'at',df['datetime'].unique(),df.index)
-                    if read_scan_properties:
-                        df['scan_type'] = match_scan_type(scaninfo)
-                    dataframes.append(df)
-                    iscan += 1
+            # specified number of scans
+            scans_to_read = np.arange(min(scans,len(offsets)))
+        for iscan in scans_to_read:
+            blocks.append((fpath, iscan) + tuple(offsets[iscan]))
+    # parse the data blocks
+    readargs = dict(expected_data_type=data_type,
+                    datetime_format=datetime_format,
+                    num_info_lines=num_info_lines,
+                    read_scan_properties=read_scan_properties)
+    if (len(blocks) > 0) and ((nprocs is None) or (nprocs > 1)):
+        from concurrent.futures import ProcessPoolExecutor
+        fpaths, _, starts, ends = zip(*blocks)
+        chunksize = max(1, len(blocks) // (4*(nprocs or os.cpu_count())))
+        with ProcessPoolExecutor(nprocs) as pool:
+            results = list(pool.map(functools.partial(_read_profiler_block_at,
+                                                      **readargs),
+                                    fpaths, starts, ends,
+                                    chunksize=chunksize))
+    else:
+        results = [_read_profiler_block_at(fpath, start, end, **readargs)
+                   for fpath,_,start,end in blocks]
+    # combine consecutive blocks with the same columns into dataframes
+    runs = []
+    for (fpath,iscan,_,_),(header,block,datetime,scaninfo,scankey) \
+            in zip(blocks,results):
+        if verbose:
+            print('Read scan',iscan,'from',fpath,'at',datetime,
+                  'with',len(block),'range gates')
+        scantype = match_scan_type(scaninfo,scankey) \
+                if read_scan_properties else None
+        if (len(runs) == 0) or (runs[-1][0] != header):
+            runs.append((header,[],[],[]))
+        runs[-1][1].append(block)
+        runs[-1][2].append(datetime)
+        runs[-1][3].append(scantype)
+    for header,data,datetimes,scantypes_read in runs:
+        counts = [len(block) for block in data]
+        df = pd.DataFrame(data=np.concatenate(data),columns=header)
+        df['datetime'] = pd.DatetimeIndex(datetimes).repeat(counts)
+        if read_scan_properties:
+            df['scan_type'] = np.repeat(scantypes_read, counts)
+        dataframes.append(df)
     df = pd.concat(dataframes)
     if na_values is not None:
         nalist = []
@@ -168,13 +193,64 @@ def profiler(fname,scans=None,
         df = df.set_index('datetime')
     return df
 
-def _read_profiler_data_block(f,
-                              expected_data_type=None,
-                              datetime_format=None,
-                              num_info_lines=5,
-                              read_scan_properties=False):
+def profiler_block_index(fname):
+    """Return an array with the starting and ending byte offsets of
+    each '$'-terminated data block in a radar profiler data file. The
+    index is cached until the file is modified.
+    """
+    st = os.stat(fname)
+    return _profiler_block_index(os.path.abspath(fname),
+                                 st.st_mtime_ns, st.st_size)
+
+@functools.lru_cache(maxsize=256)
+def _profiler_block_index(fname,mtime,size):
+    """Called by profiler_block_index(); the modification time and
+    size are only used as part of the cache key
+    """
+    if size == 0:
+        return np.zeros((0,2), dtype=np.int64)
+    with open(fname,'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            # find lines containing only the '$' block terminator
+            ends = []
+            pos = buf.find(b'$')
+            while pos >= 0:
+                linestart = buf.rfind(b'\n', 0, pos) + 1
+                lineend = buf.find(b'\n', pos)
+                lineend = size if (lineend < 0) else lineend+1
+                if buf[linestart:lineend].strip() == b'$':
+                    ends.append(lineend)
+                pos = buf.find(b'$', lineend)
+            # data after the last terminator, e.g., from an incomplete file
+            lastend = ends[-1] if (len(ends) > 0) else 0
+            if buf[lastend:].strip():
+                ends.append(size)
+    ends = np.array(ends, dtype=np.int64)
+    starts = np.concatenate([[0], ends[:-1]])
+    offsets = np.stack([starts,ends], axis=-1)
+    offsets.setflags(write=False)
+    return offsets
+
+def _read_profiler_block_at(fname,start,end,**kwargs):
+    """Read the data block between the specified byte offsets; called
+    by profiler(), possibly from a worker process
+    """
+    with open(fname,'rb') as f:
+        f.seek(start)
+        text = f.read(end-start).decode()
+    return _parse_profiler_data_block(io.StringIO(text), **kwargs)
+
+def _parse_profiler_data_block(f,
+                               expected_data_type=None,
+                               datetime_format=None,
+                               num_info_lines=5,
+                               read_scan_properties=False):
     """Used by radar profiler. This was originally developed to process
-    the TTU radar profiler output (WINDS/RASS).
+    the TTU radar profiler output (WINDS/RASS). The file-like object
+    `f` should contain a single data block, e.g., as located by
+    profiler_block_index(). Returns the column labels, data array,
+    datetime, and scan information and scan type key (if
+    read_scan_properties).
 
     General expected data block format, line by line, terminated by the
     '$' character:
@@ -217,61 +293,67 @@ def _read_profiler_data_block(f,
             # not enough values to unpack (expected 7, got ...)
             raise ValueError('Unexpected header line 4--need to specify datetime_format')
         else:
-            datetime = pd.to_datetime('20{}{}{} {}{}{}'.format(Y,m,d,H,M,S))
+            datetime = pd.Timestamp(2000+int(Y),int(m),int(d),
+                                    int(H),int(M),int(S))
     else:
         # more general data, e.g., "2015-08-24    12:00:00     00:00"
         # - figure out expected string length by evaluating strftime
         #   with the specified format
-        testdate_str = pd.datetime.strftime(pd.datetime.today(),
-                                            format=datetime_format)
+        testdate_str = pd.Timestamp.today().strftime(datetime_format)
         # - recombine the split string with spaces (this gets rid of
         #   repeated spaces)
         datetime_str = ' '.join(datetime_info)[:len(testdate_str)]
         datetime = pd.to_datetime(datetime_str,format=datetime_format)
     if read_scan_properties:
+        # Lines 6-10: scan information; the normalized text identifies
+        # the scan type
+        infolines = [f.readline() for _ in range(5)]
+        scankey = (name, data_format) \
+                + tuple(' '.join(line.split()) for line in infolines)
+        scanlines = iter(infolines)
         # Line 6: consensus averaging time [min], # beams, # range gates
-        cns_avg_time, num_beams, num_ranges = [int(val) for val in f.readline().split()]
+        cns_avg_time, num_beams, num_ranges = [int(val) for val in next(scanlines).split()]
         # Line 7: for each beam: num_records:tot_records (consensus_window_size)
-        lineitems = f.readline().split()
+        lineitems = next(scanlines).split()
         assert len(lineitems) == 2*num_beams
         num_records = [int(item.split(':')[0]) for item in lineitems[::2]]
         tot_records = [int(item.split(':')[1]) for item in lineitems[::2]]
         cns_window_size = [float(item.strip('()')) for item in lineitems[1::2]]
         if datatype=='WINDS':
             # Line 8: processing info (oblique/vertical pairs)
-            lineitems = [int(val) for val in f.readline().split()]
+            lineitems = [int(val) for val in next(scanlines).split()]
             num_coherent_integrations = lineitems[:2]
             num_spectral_averages = lineitems[2:4]
             pulse_width = lineitems[4:6] # [ns]
             inner_pulse_period = lineitems[6:8] # [ms]
             # Line 9: processing info (oblique/vertical pairs)
-            lineitems = f.readline().split()
+            lineitems = next(scanlines).split()
             doppler_value = [float(val) for val in lineitems[:2]] # [m/s]
             vertical_correction = bool(lineitems[2])
             delay = [int(val) for val in lineitems[3:5]] # [ns]
             num_gates = [int(val) for val in lineitems[5:7]]
             gate_spacing = [int(val) for val in lineitems[7:9]] # [ns]
             # Line 10: for each beam: azimuth, elevation
-            lineitems = [float(val) for val in f.readline().split()]
+            lineitems = [float(val) for val in next(scanlines).split()]
             assert len(lineitems) == 2*num_beams
             beam_azimuth = lineitems[::2] # [deg]
             beam_elevation = lineitems[1::2] # [deg]
         elif datatype=='RASS':
             # Line 8: processing info
-            lineitems = [int(val) for val in f.readline().split()]
+            lineitems = [int(val) for val in next(scanlines).split()]
             num_coherent_integrations = lineitems[0]
             num_spectral_averages = lineitems[1]
             pulse_width = lineitems[2] # [ns]
             inner_pulse_period = lineitems[3] # [ms]
             # Line 9: processing info (oblique/vertical pairs)
-            lineitems = f.readline().split()
+            lineitems = next(scanlines).split()
             doppler_value = float(lineitems[0]) # [m/s]
             vertical_correction = 'n/a'
             delay = int(lineitems[1]) # [ns]
             num_gates = int(lineitems[2])
             gate_spacing = int(lineitems[3]) # [ns]
             # Line 10: for each beam: azimuth, elevation
-            lineitems = [float(val) for val in f.readline().split()]
+            lineitems = [float(val) for val in next(scanlines).split()]
             assert len(lineitems) == 2*num_beams
             beam_azimuth = lineitems[::2] # [deg]
             beam_elevation = lineitems[1::2] # [deg]
@@ -284,14 +366,11 @@ def _read_profiler_data_block(f,
                if header.count(col) > 1
                else col
                for i,col in enumerate(header) ]
-    # Line 12: Start of data
-    block = []
-    line = f.readline()
-    while not line.strip()=='$' and not line=='':
-        block.append(line.split())
-        line = f.readline()
-    df = pd.DataFrame(data=block,columns=header,dtype=float)
-    df['datetime'] = datetime
+    # Line 12: Start of data, through the end of the block
+    block = f.read().split()
+    if (len(block) > 0) and (block[-1] == '$'):
+        block = block[:-1]
+    block = np.array(block, dtype=float).reshape((-1,len(header)))
     # return data and header info if requested
     if read_scan_properties:
         scaninfo = {
@@ -320,6 +399,6 @@ def _read_profiler_data_block(f,
             'beam:azimuth_deg': beam_azimuth,
             'beam:elevation_deg': beam_elevation,
         }
-        return df, scaninfo
+        return header, block, datetime, scaninfo, scankey
     else:
-        return df, None
+        return header, block, datetime, None, None
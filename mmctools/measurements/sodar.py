@@ -3,6 +3,103 @@ Data readers for remote sensing devices (e.g., 3D data)
 
 Based on https://github.com/NWTC/datatools/blob/master/remote_sensing.py
 """
+import io
 import numpy as np
 import pandas as pd
 
+# Standard names for Scintec variable symbols
+scintec_variables = {
+    'z': 'height',
+    'speed': 'wspd',
+    'dir': 'wdir',
+    'W': 'w',
+    'sigW': 'w_std',
+}
+
+
+def scintec_mfc(fname,variables=['wspd','wdir'],
+                verbose=False):
+    """Scintec sodar main data file (.mnd) in the MFC "FORMAT-1"
+    format, e.g., from an SFAS or MFAS
+
+    Expected data file format:
+        FORMAT-1
+        (file creation time, number of header lines, ...)
+        # variables
+        z # height # m # ... # gap value
+        speed # wind speed # m/s # ... # gap value
+        ...
+        # beginning of data block
+        YYYY-MM-DD HH:MM:SS HH:MM:SS  (end of interval, averaging time)
+        # z speed dir ...
+          height0  speed0  dir0  ...
+          height1  speed1  dir1  ...
+          ...
+        (blank line)
+        YYYY-MM-DD HH:MM:SS HH:MM:SS
+        ...
+
+    Timestamps correspond to the end of each averaging interval. Gap
+    values are set to nan. All lines are classified at once and the
+    numeric data are parsed in a single pass, reading only the
+    requested columns; multi-year archives (one file per day) may be
+    read with dataloaders.read_dir().
+
+    Usage
+    =====
+    variables : list or None
+        Standard names (see `scintec_variables`) or Scintec symbols of
+        the quantities to read, or None to read all variables
+    """
+    with open(fname,'r',encoding='latin-1') as f:
+        lines = pd.Series(f.read().splitlines()).str.strip()
+    if not lines.iloc[0].startswith('FORMAT'):
+        raise ValueError('Unexpected first line: '+lines.iloc[0])
+
+    # split header and data blocks
+    begin = np.nonzero((lines.str.lower() == '# beginning of data block').values)[0]
+    start = begin[0]+1 if (len(begin) > 0) else 2
+    header = lines.iloc[:start]
+    data = lines.iloc[start:]
+
+    # gap values from variable definitions: symbol # name # unit # ... # gap
+    gap_values = {}
+    for line in header:
+        fields = [field.strip() for field in line.split('#')]
+        if (len(fields) >= 6) and (fields[0] != ''):
+            try:
+                gap_values[fields[0]] = float(fields[-1])
+            except ValueError:
+                pass
+
+    # classify all data lines
+    is_time = data.str.match(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}').values
+    is_label = data.str.startswith('#').values
+    is_data = ~is_time & ~is_label & (data != '').values
+    labels = data[is_label].iloc[0].lstrip('#').split()
+    times = pd.to_datetime(data[is_time].str[:19], format='%Y-%m-%d %H:%M:%S')
+    profile = np.cumsum(is_time)[is_data] - 1
+    assert np.all(profile >= 0), 'Data found before first timestamp'
+
+    # select columns
+    symbols = { name: symbol for symbol,name in scintec_variables.items() }
+    if variables is None:
+        usecols = labels
+    else:
+        usecols = [symbols['height']] + [symbols.get(name,name) for name in variables]
+    missing = [col for col in usecols if col not in labels]
+    if len(missing) > 0:
+        raise ValueError('Variables not found: {}'.format(missing))
+    if verbose:
+        print('Reading',usecols,'from',len(times),'profiles')
+    df = pd.read_csv(io.StringIO('\n'.join(data[is_data])), sep=r'\s+',
+                     header=None, names=labels, usecols=usecols)
+    df = df[usecols]
+    for col in usecols:
+        # (error codes are kept as is)
+        if (col in gap_values) and (col != 'error'):
+            df[col] = df[col].mask(df[col] == gap_values[col])
+    df = df.rename(columns=scintec_variables)
+    df['height'] = df['height'].astype(float)
+    df['datetime'] = times.values[profile]
+    return df.set_index(['datetime','height'])
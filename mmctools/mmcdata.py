@@ -10,6 +10,8 @@ the data stream
 """
 
 from math import *
+import re
+import gzip as gz
 import collections
 import numpy as np
 import datetime as dt
@@ -45,6 +47,69 @@ SURFACE FLUX [Km/s]     = {qwall:10.5f}
 """
 datarow = 4*'{:18.3f}' + 2*'{:18.2f}' + '{:18.3f}' + 7*'{:18.5f}' + '\n'
 
+# %-style equivalents of the legacy templates, for block-wise formatting
+# of many records with a single string operation
+_record_pctfmt = re.sub(r'\{\w*:([^}]*)\}', r'%\1', record)
+_datarow_pctfmt = re.sub(r'\{\w*:([^}]*)\}', r'%\1', datarow)
+
+# legacy data columns, in order, and record-header surface quantities
+ascii_columns = ['height','u','v','w','theta','pres','tke',
+                 'tau11','tau12','tau13','tau22','tau23','tau33','hflux']
+ascii_surface_fields = ['ustar','z0','T0','qwall']
+
+# standard variables for xarray/dataframe output: (name, description, units)
+output_variables = [
+    ('u', 'west-east velocity', 'm s-1'),
+    ('v', 'south-north velocity', 'm s-1'),
+    ('w', 'vertical velocity', 'm s-1'),
+    ('theta', 'potential temperature', 'K'),
+    ('pres', 'pressure', 'mbar'),
+]
+
+# fields calculated from the raw data on first access
+derived_fields = {
+    'wspd': lambda d: np.sqrt(d['u']**2 + d['v']**2),
+    'wdir': lambda d: (270.0-np.arctan2(d['v'],d['u'])*180./np.pi)%360,
+    ### The follwing will yield correct results, but sneaky usage of arctan2 where first argument is defined as y-oriented
+    ### 'wdir': lambda d: 180. + np.arctan2(d['v'],d['u'])*180./np.pi,
+}
+
+# running means, initialized to 0 on first access and set by
+# MMCData.setRunningMeans()
+mean_fields = [
+    'u_mean', 'v_mean', 'w_mean', 'theta_mean', 'tke_mean', 'hflux_mean',
+    'uu_mean', 'uv_mean', 'uw_mean', 'vv_mean', 'vw_mean', 'ww_mean',
+    'wt_mean', 'wspd_mean', 'wdir_mean', 'shear_mean',
+]
+
+
+class MMCDataDict(dict):
+    """Dictionary of MMC data fields in which derived quantities (e.g.,
+    wspd and wdir) and running-mean arrays are only created when first
+    accessed, and then cached. Like the defaultdict(list) that this
+    replaces, any other missing key returns an empty list.
+    """
+    def __missing__(self,key):
+        if key in derived_fields:
+            value = derived_fields[key](self)
+        elif key in mean_fields:
+            value = np.zeros(self['u'].shape)
+        else:
+            value = []
+        self[key] = value
+        return value
+
+    def release(self,*fields):
+        """Free cached derived and mean fields (all of them, by default);
+        these will be recalculated or reinitialized on the next access.
+        """
+        if len(fields) == 0:
+            fields = list(derived_fields.keys()) + mean_fields
+        for field in fields:
+            assert (field in derived_fields) or (field in mean_fields), \
+                    '{:s} is not a derived field'.format(field)
+            self.pop(field, None)
+
 
 class MMCData():
     """A given set of 'observed' (via instrument or model) timeseries of
@@ -62,9 +127,13 @@ class MMCData():
         """
         self.description = None
         self.records = []
-        self.dataDict = collections.defaultdict(list)
+        self.dataDict = MMCDataDict()
         if asciifile:
-            with open(asciifile,'r') as f:
+            if asciifile.endswith('.gz'):
+                openfile = gz.open
+            else:
+                openfile = open
+            with openfile(asciifile,'rt') as f:
                 data = self._read_ascii(f)
             if self.dataSetLength > 0:
                 self._process_data(data,**kwargs)
@@ -163,29 +232,15 @@ class MMCData():
         self.dataDict['tau23'] = np.asarray(tau23)
         self.dataDict['tau33'] = np.asarray(tau33)
         self.dataDict['hflux'] = np.asarray(hflux)
-        self.dataDict['wspd']  = np.sqrt(self.dataDict['u']**2
-                                       + self.dataDict['v']**2)
-        self.dataDict['wdir']  = (270.0-np.arctan2(self.dataDict['v'],self.dataDict['u'])*180./np.pi)%360 
-        ### The follwing will yield correct results, but sneaky usage of arctan2 where first argument is defined as y-oriented
-        ### self.dataDict['wdir']  = 180. + np.arctan2(self.dataDict['v'],self.dataDict['u'])*180./np.pi
-
-        #Declare and initialize to 0 the *_mean arrays
-        self.dataDict['u_mean']     = np.zeros(self.dataDict['u'].shape)
-        self.dataDict['v_mean']     = np.zeros(self.dataDict['u'].shape)
-        self.dataDict['w_mean']     = np.zeros(self.dataDict['u'].shape)
-        self.dataDict['theta_mean'] = np.zeros(self.dataDict['u'].shape)
-        self.dataDict['tke_mean']   = np.zeros(self.dataDict['u'].shape)
-        self.dataDict['hflux_mean'] = np.zeros(self.dataDict['u'].shape)
-        self.dataDict['uu_mean']    = np.zeros(self.dataDict['u'].shape)
-        self.dataDict['uv_mean']    = np.zeros(self.dataDict['u'].shape)
-        self.dataDict['uw_mean']    = np.zeros(self.dataDict['u'].shape)
-        self.dataDict['vv_mean']    = np.zeros(self.dataDict['u'].shape)
-        self.dataDict['vw_mean']    = np.zeros(self.dataDict['u'].shape)
-        self.dataDict['ww_mean']    = np.zeros(self.dataDict['u'].shape)
-        self.dataDict['wt_mean']    = np.zeros(self.dataDict['u'].shape)
-        self.dataDict['wspd_mean']  = np.zeros(self.dataDict['u'].shape)
-        self.dataDict['wdir_mean']  = np.zeros(self.dataDict['u'].shape)
-        self.dataDict['shear_mean'] = np.zeros(self.dataDict['u'].shape)
+        # wspd, wdir, and the *_mean fields are derived on first access
+        # (see MMCDataDict)
+
+    def release(self,*fields):
+        """Free memory associated with cached derived (wspd, wdir) and
+        running-mean (*_mean) fields; if no fields are specified, then
+        all are released. Released fields are recalculated on demand.
+        """
+        self.dataDict.release(*fields)
 
     def to_pickle(self,pklfile):
         """pickle the entire class instance"""
@@ -196,54 +251,61 @@ class MMCData():
         """return a multi-indexed pandas dataframe with standard
         variables
         """
-        df = self.to_xarray().to_dataframe()
-        # the resulting dataframe has an integer multiindex formed by
-        # range(num_samples) and range(num_levels)
-        df = df.reset_index().drop(columns=['Times','bottom_top'])
-        return df.set_index(['datetime','height'])
-          
-    def to_xarray(self,timedim='Times',heightdim='bottom_top'):
-        """return an xarray dataset with standard variables"""
+        # build the (datetime, height) multiindex directly instead of
+        # going through to_xarray().to_dataframe()
+        Nt,Nz = self.dataDict['u'].shape
+        heights = self._mean_heights()
+        index = pd.MultiIndex.from_arrays(
+                [np.repeat(self.dataDict['datetime'],Nz), np.tile(heights,Nt)],
+                names=['datetime','height'])
+        data = { varn: np.asarray(self.dataDict[varn]).ravel()
+                 for varn,_,_ in output_variables }
+        return pd.DataFrame(data, index=index)
+
+    def to_xarray(self,timedim='Times',heightdim='bottom_top',
+                  timevarying_height=True):
+        """return an xarray dataset with standard variables
+
+        Heights at each level are set to their temporal mean. If
+        timevarying_height is False, then height is a 1D coordinate
+        along heightdim; otherwise, it is broadcast to (timedim,
+        heightdim) for compatibility with existing output.
+        """
+        heights = self._mean_heights()
+        if timevarying_height:
+            Nt = len(self.dataDict['datetime'])
+            height = xarray.DataArray(np.repeat(heights[np.newaxis,:],Nt,axis=0),
+                                      name='height',
+                                      dims=[timedim, heightdim],
+                                      attrs={'units':'m'})
+        else:
+            height = xarray.DataArray(heights,
+                                      name='height',
+                                      dims=[heightdim],
+                                      attrs={'units':'m'})
         coords = {
             'datetime': xarray.DataArray(self.dataDict['datetime'],
                                   name='datetime',
                                   dims=[timedim]),
-            'height': xarray.DataArray(self.dataDict['z'],
-                                  name='height',
-                                  dims=[timedim, heightdim],
-                                  attrs={'units':'m'}),
+            'height': height,
         }
         data_vars = {
-            'u': xarray.DataArray(self.dataDict['u'],
-                                  name='west-east velocity',
-                                  dims=[timedim, heightdim],
-                                  attrs={'units':'m s-1'}),
-            'v': xarray.DataArray(self.dataDict['v'],
-                                  name='south-north velocity',
-                                  dims=[timedim, heightdim],
-                                  attrs={'units':'m s-1'}),
-            'w': xarray.DataArray(self.dataDict['w'],
-                                  name='vertical velocity',
-                                  dims=[timedim, heightdim],
-                                  attrs={'units':'m s-1'}),
-            'theta': xarray.DataArray(self.dataDict['theta'],
-                                  name='potential temperature',
-                                  dims=[timedim, heightdim],
-                                  attrs={'units':'K'}),
-            'pres': xarray.DataArray(self.dataDict['pres'],
-                                  name='pressure',
-                                  dims=[timedim, heightdim],
-                                  attrs={'units':'mbar'}),
+            varn: xarray.DataArray(self.dataDict[varn],
+                                   name=longname,
+                                   dims=[timedim, heightdim],
+                                   attrs={'units':units})
+            for varn,longname,units in output_variables
         }
         #ds=xarray.decode_cf(xarray.Dataset(data_vars,coords))
         ds=xarray.Dataset(data_vars,coords)
-        #Remove the time dependence of heights by setting heights from each level as their temporal mean
-        heights=ds['height'].groupby('bottom_top').mean()
-        Nt,Nz = ds['height'].shape
-        for i in range(Nt):
-            ds['height'][i,:]=heights
         return ds
 
+    def _mean_heights(self):
+        """Remove the time dependence of heights by setting heights from
+        each level as their temporal mean
+        """
+        return np.nanmean(self.dataDict['z'], axis=0)
+
     def getDataSetDict(self):
         return self.description
     
@@ -473,6 +535,99 @@ def read_ascii_records(f,Nlevels):
     return recordarray
 
 
+### Writers for legacy MMC data
+
+def write_ascii(ds,fpath,description=None,
+                chunksize=1000,nprocs=1,gzip=False,
+                fill_value=0.0):
+    """Write an MMC-standard xarray Dataset, e.g., from MMCData.to_xarray(),
+    in the legacy MMC ascii format.
+
+    Records are formatted in blocks of `chunksize` times, each with a
+    single string-formatting operation, and optionally in parallel over
+    `nprocs` processes. Output is gzipped if `gzip` is True or `fpath`
+    ends with '.gz'.
+
+    Parameters
+    ==========
+    ds : xarray.Dataset
+        Should have a 'datetime' coordinate and (time, height) data
+        variables named as in `ascii_columns`; 'height' may be a 1D or
+        2D coordinate. Missing variables are written as `fill_value`.
+        Surface quantities in the record header (`ascii_surface_fields`)
+        are read from time-varying variables, if available.
+    description : dict, optional
+        Header information (institution, location, latitude, longitude,
+        codename, codetype, casename, benchmark); defaults are taken
+        from ds.attrs. The 'lab' key from read_ascii_header() is
+        accepted in place of 'institution'.
+    """
+    datetime = pd.DatetimeIndex(ds['datetime'].values)
+    timedim = ds['datetime'].dims[0]
+    heightdim = [dim for dim in ds['u'].dims if dim != timedim][0]
+    Nt = ds.sizes[timedim]
+    Nz = ds.sizes[heightdim]
+
+    # collect data into a (time, height, column) array
+    fields = np.full((Nt,Nz,len(ascii_columns)), fill_value, dtype=float)
+    for icol,varn in enumerate(ascii_columns):
+        if varn in ds.variables:
+            fields[:,:,icol] = ds[varn].broadcast_like(ds['u']) \
+                                       .transpose(timedim,heightdim).values
+    surface = np.full((Nt,len(ascii_surface_fields)), fill_value, dtype=float)
+    for icol,varn in enumerate(ascii_surface_fields):
+        if varn in ds.variables:
+            surface[:,icol] = ds[varn].values
+    dates = np.asarray(datetime.strftime('%Y-%m-%d'))
+    times = np.asarray(datetime.strftime('%H:%M:%S'))
+
+    # setup file header
+    headerinfo = dict(institution='', location='', latitude=0.0,
+                      longitude=0.0, codename='', codetype='', casename='',
+                      benchmark='')
+    for key in headerinfo.keys():
+        headerinfo[key] = ds.attrs.get(key, headerinfo[key])
+    if description is None:
+        description = {}
+    if 'lab' in description:
+        headerinfo['institution'] = description['lab']
+    headerinfo.update({key: val for key,val in description.items()
+                       if key in headerinfo})
+    headerinfo['levels'] = Nz
+
+    chunks = (
+        (dates[i:i+chunksize], times[i:i+chunksize],
+         surface[i:i+chunksize], fields[i:i+chunksize])
+        for i in range(0,Nt,chunksize)
+    )
+    if gzip or fpath.endswith('.gz'):
+        openfile = gz.open
+    else:
+        openfile = open
+    with openfile(fpath,'wt') as f:
+        f.write(header.format(**headerinfo))
+        if nprocs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(nprocs) as pool:
+                for text in pool.map(_format_ascii_records, *zip(*chunks)):
+                    f.write(text)
+        else:
+            for chunk in chunks:
+                f.write(_format_ascii_records(*chunk))
+
+def _format_ascii_records(dates,times,surface,fields):
+    """Format a block of legacy MMC records, called by write_ascii()"""
+    Nrec,Nz,Ncol = fields.shape
+    # interleave record header and data values
+    values = np.empty((Nrec, 2+surface.shape[1]+Nz*Ncol), dtype=object)
+    values[:,0] = dates
+    values[:,1] = times
+    values[:,2:2+surface.shape[1]] = surface
+    values[:,2+surface.shape[1]:] = fields.reshape((Nrec,Nz*Ncol))
+    fmt = Nrec * (_record_pctfmt + Nz*_datarow_pctfmt)
+    return fmt % tuple(values.ravel())
+
+
 ### Utility functions for MMC class
 
 def linearly_interpolate_nans(y):
@@ -40,57 +40,431 @@ def Paulson_h(x):
     return 2 * np.log((1 + x**2) / 2)
 
 
-def Jimenez_m(z_L, a=6.1, b=2.5, alpha_m=10.0):
+def Jimenez_m(z_L, a=6.1, b=2.5, alpha_m=10.0, out=None):
     """Momentum similarity function used by WRF
 
+    If specified, results are written into the array `out`, which must
+    have the same shape as z_L. See also PsiTable for a tabulated
+    approximation.
+
     Ref: Jimenez, P.A., J. Dudhia, J.F. Gonzalez-Rouco, J. Navarro, J.P.
          Montavez and E. Garcia-Bustamante, 2012: A Revised Scheme for
          the WRF Surface Layer Formulation. Mon. Weather Rev., 140, 898-918.
     """
-    zeta = np.array(z_L)
-    psi = np.zeros(zeta.shape)
+    zeta = np.asarray(z_L, dtype=float)
+    if out is None:
+        psi = np.zeros(zeta.shape)
+    else:
+        if np.shares_memory(out, zeta):
+            # out is (a view of) the input, which is still needed
+            zeta = zeta.copy()
+        psi = out
+        psi.fill(0)
 
     # Unstable conditions (Eqn. 17)
-    uns = np.where(zeta < 0)
-    x = (1 - 16*zeta[uns])**0.25
+    uns = (zeta < 0)
+    zeta_uns = zeta[uns]
+    x = (1 - 16*zeta_uns)**0.25
     paulson_func = Paulson_m(x)  # "Kansas-type" functions
-    y = (1 - alpha_m*zeta[uns])**(1./3)
+    y = (1 - alpha_m*zeta_uns)**(1./3)
     conv_func = 3./2 * np.log(y**2 + y + 1./3) \
             - np.sqrt(3) * np.arctan(2*y + 1/np.sqrt(3)) \
             + np.pi/np.sqrt(3)  # convective contribution
-    psi[uns] = (paulson_func + zeta[uns]**2 * conv_func) \
-            / (1 + zeta[uns]**2)
+    psi[uns] = (paulson_func + zeta_uns**2 * conv_func) \
+            / (1 + zeta_uns**2)
 
     # Stable conditions (Eqn. 18)
-    sta = np.where(zeta >= 0)
-    psi[sta] = -a * np.log(zeta[sta] + (1 + zeta[sta]**b)**(1./b))
+    sta = (zeta >= 0)
+    zeta_sta = zeta[sta]
+    psi[sta] = -a * np.log(zeta_sta + (1 + zeta_sta**b)**(1./b))
 
     return psi
 
-def Jimenez_h(z_L, c=5.3, d=1.1, alpha_h=34.0):
+def Jimenez_h(z_L, c=5.3, d=1.1, alpha_h=34.0, out=None):
     """Heat similarity function used by WRF
 
+    If specified, results are written into the array `out`, which must
+    have the same shape as z_L. See also PsiTable for a tabulated
+    approximation.
+
     Ref: Jimenez, P.A., J. Dudhia, J.F. Gonzalez-Rouco, J. Navarro, J.P.
          Montavez and E. Garcia-Bustamante, 2012: A Revised Scheme for
          the WRF Surface Layer Formulation. Mon. Weather Rev., 140, 898-918.
     """
-    zeta = np.array(z_L)
-    psi = np.zeros(zeta.shape)
+    zeta = np.asarray(z_L, dtype=float)
+    if out is None:
+        psi = np.zeros(zeta.shape)
+    else:
+        if np.shares_memory(out, zeta):
+            # out is (a view of) the input, which is still needed
+            zeta = zeta.copy()
+        psi = out
+        psi.fill(0)
 
     # Unstable conditions (Eqn. 17)
-    uns = np.where(zeta < 0)
-    x = (1 - 16*zeta[uns])**0.25
+    uns = (zeta < 0)
+    zeta_uns = zeta[uns]
+    x = (1 - 16*zeta_uns)**0.25
     paulson_func = Paulson_h(x)  # "Kansas-type" functions
-    y = (1 - alpha_h*zeta[uns])**(1./3)
+    y = (1 - alpha_h*zeta_uns)**(1./3)
     conv_func = 3./2 * np.log(y**2 + y + 1./3) \
             - np.sqrt(3) * np.arctan(2*y + 1/np.sqrt(3)) \
             + np.pi/np.sqrt(3)  # convective contribution
-    psi[uns] = (paulson_func + zeta[uns]**2 * conv_func) \
-            / (1 + zeta[uns]**2)
+    psi[uns] = (paulson_func + zeta_uns**2 * conv_func) \
+            / (1 + zeta_uns**2)
 
     # Stable conditions (Eqn. 19)
-    sta = np.where(zeta >= 0)
-    psi[sta] = -c * np.log(zeta[sta] + (1 + zeta[sta]**d)**(1./d))
+    sta = (zeta >= 0)
+    zeta_sta = zeta[sta]
+    psi[sta] = -c * np.log(zeta_sta + (1 + zeta_sta**d)**(1./d))
 
     return psi
 
+
+class PsiTable(object):
+    """Tabulated similarity function, for fast evaluation inside
+    iterative solvers (e.g., solve_obukhov) over many points
+
+    The function is tabulated at uniformly spaced values of z/L from
+    zmin to zmax (rounded outward to multiples of the resolution, so
+    that z/L=0, where the stable and unstable branches meet, is always
+    a node) and evaluated with piecewise linear or cubic Hermite
+    interpolation. Values outside of the table range are evaluated
+    with the analytical function.
+
+    The interpolation error in each interval of the table is estimated
+    by comparison with the analytical function at `nsub` points,
+    including the midpoint, where the error of both interpolants is
+    largest for smooth functions. If `tol` is specified, the resolution
+    is repeatedly halved until the error does not exceed tol, up to
+    `max_points` table entries; any remaining intervals that exceed tol
+    (e.g., next to z/L=0 for Jimenez_h, which is not smooth there) are
+    then evaluated with the analytical function. The maximum error of
+    the interpolated intervals is stored in the `max_error` attribute.
+
+    Example:
+    >>> psi_m = PsiTable(Jimenez_m, tol=1e-6)
+    >>> solve_obukhov(U, theta, theta0, z, psi_m=psi_m)
+    """
+    def __init__(self,psi,zmin=-10.0,zmax=10.0,resolution=0.01,
+                 kind='linear',tol=None,nsub=9,max_points=2**17,**kwargs):
+        """
+        Parameters
+        ==========
+        psi : callable
+            Analytical similarity function of z/L, e.g., Jimenez_m
+        zmin, zmax : float, optional
+            Range of z/L to tabulate
+        resolution : float, optional
+            Initial spacing of the table
+        kind : str, optional
+            'linear' or 'cubic' (Hermite) interpolation
+        tol : float, optional
+            Maximum allowable interpolation error
+        nsub : int, optional
+            Number of points per interval used to estimate the error;
+            should be odd to include the midpoint
+        max_points : int, optional
+            Maximum number of table entries when refining to meet tol
+        kwargs : optional
+            Passed to psi, e.g., coefficients of the Jimenez functions
+        """
+        if kind not in ('linear','cubic'):
+            raise ValueError('Unknown interpolation: {:s}'.format(kind))
+        self.psi = psi
+        self.kind = kind
+        self.kwargs = kwargs
+        self._tabulate(zmin, zmax, resolution, nsub)
+        while (tol is not None) and (self.max_error > tol) \
+                and (2*self.size - 1 <= max_points):
+            self._tabulate(zmin, zmax, self.resolution/2, nsub)
+        if (tol is not None) and (self.max_error > tol):
+            self.analytic = (self.errors > tol)
+            self.max_error = np.max(self.errors[~self.analytic],
+                                    initial=0.0)
+
+    def _tabulate(self,zmin,zmax,resolution,nsub):
+        self.resolution = resolution
+        self.zmin = np.floor(zmin/resolution) * resolution
+        nintervals = int(np.ceil(zmax/resolution - self.zmin/resolution))
+        self.zmax = self.zmin + nintervals*resolution
+        self.size = nintervals + 1
+        self.analytic = None
+        zeta = self.zmin + resolution*np.arange(self.size)
+        zeta[np.argmin(np.abs(zeta))] = 0.0
+        f = self.psi(zeta, **self.kwargs)
+        self.coefs = [f[:-1].copy(), f[1:] - f[:-1]]
+        if self.kind == 'cubic':
+            # one-sided derivatives at both ends of each interval, so
+            # that each interval only uses values from one branch
+            eps = 1e-5 * resolution
+            f0 = self.psi(zeta[:-1]+eps, **self.kwargs)
+            f1 = self.psi(zeta[:-1]+2*eps, **self.kwargs)
+            df0 = resolution * (-3*f[:-1] + 4*f0 - f1) / (2*eps)
+            f0 = self.psi(zeta[1:]-eps, **self.kwargs)
+            f1 = self.psi(zeta[1:]-2*eps, **self.kwargs)
+            df1 = resolution * (3*f[1:] - 4*f0 + f1) / (2*eps)
+            self.coefs = [f[:-1].copy(),
+                          df0,
+                          3*(f[1:] - f[:-1]) - 2*df0 - df1,
+                          2*(f[:-1] - f[1:]) + df0 + df1]
+        # estimate the interpolation error in each interval
+        frac = (np.arange(nsub) + 1.0) / (nsub + 1)
+        zeta = self.zmin + resolution*(np.arange(nintervals)[:,np.newaxis]
+                                       + frac)
+        err = np.abs(self(zeta.ravel()) - self.psi(zeta.ravel(), **self.kwargs))
+        self.errors = np.max(err.reshape(zeta.shape), axis=1)
+        self.max_error = np.max(self.errors)
+
+    def __call__(self,z_L,out=None):
+        """Evaluate the tabulated function at z_L; if specified, results
+        are written into the array `out`, which must have the same shape
+        as z_L
+        """
+        zeta = np.asarray(z_L, dtype=float)
+        if zeta.ndim == 0:
+            psi = self(zeta.reshape(1))
+            if out is None:
+                return psi.reshape(())
+            out[...] = psi[0]
+            return out
+        if (out is not None) and np.shares_memory(out, zeta):
+            # out is (a view of) the input, which is still needed
+            zeta = zeta.copy()
+        s = (zeta - self.zmin) * (1.0/self.resolution)
+        inrange = (s >= 0) & (s <= self.size - 1)
+        with np.errstate(invalid='ignore'):
+            idx = s.astype(np.intp)
+        np.clip(idx, 0, self.size - 2, out=idx)
+        s -= idx
+        # evaluate polynomial in s = fractional position in interval
+        coefs = self.coefs[::-1]
+        out = np.take(coefs[0], idx, out=out)
+        for c in coefs[1:]:
+            out *= s
+            out += np.take(c, idx)
+        if self.analytic is not None:
+            inrange &= ~np.take(self.analytic, idx)
+        if not np.all(inrange):
+            outside = ~inrange
+            out[outside] = self.psi(zeta[outside], **self.kwargs)
+        return out
+
+
+#
+# Monin-Obukhov similarity solutions
+#
+
+kappa = 0.4 # von Karman constant
+g = 9.81 # gravitational acceleration [m/s^2]
+
+def solve_obukhov(U,theta,theta0,z,z0=0.1,zt=None,z0h=None,
+                  theta_ref=None,psi_m=Jimenez_m,psi_h=Jimenez_h,
+                  max_iter=50,tol=1e-6,zeta_max=10.0,full_output=False):
+    """Solve for the friction velocity, temperature scale, and Obukhov
+    length from the wind speed and potential temperature at one height
+    in the surface layer, for any number of points at once.
+
+    The log profile equations (see module docstring) are solved by
+    fixed-point iteration on 1/L, starting from neutral conditions;
+    only unconverged points are updated in each iteration, and the
+    number of iterations is bounded by `max_iter`.
+
+    Parameters
+    ==========
+    U : float or array-like
+        Wind speed [m/s] at height z
+    theta : float or array-like
+        Potential temperature [K] at height zt
+    theta0 : float or array-like
+        Surface potential temperature [K]
+    z : float or array-like
+        Height of the wind speed [m]
+    z0 : float or array-like, optional
+        Roughness length [m]
+    zt : float or array-like, optional
+        Height of the potential temperature [m]; default is z
+    z0h : float or array-like, optional
+        Roughness length for heat [m]; default is z0
+    theta_ref : float or array-like, optional
+        Reference potential temperature [K] in the buoyancy parameter
+        g/theta_ref; default is theta
+    psi_m, psi_h : callable, optional
+        Momentum and heat similarity functions of z/L
+    max_iter : int, optional
+        Maximum number of iterations
+    tol : float, optional
+        Convergence tolerance for the stability parameter, z/L
+    zeta_max : float, optional
+        Bound on |z/L| during the iteration
+    full_output : bool, optional
+        If True, also return a dictionary with the number of iterations
+        and whether each point converged
+
+    Returns
+    =======
+    ustar, thetastar, L : float or np.ndarray
+        Friction velocity [m/s], temperature scale [K], and Obukhov
+        length [m] (inf under neutral conditions)
+    """
+    if zt is None:
+        zt = z
+    if z0h is None:
+        z0h = z0
+    if theta_ref is None:
+        theta_ref = theta
+    inputs = np.broadcast_arrays(
+            *[np.asarray(val, dtype=float)
+              for val in (U,theta,theta0,z,z0,zt,z0h,theta_ref)])
+    shape = inputs[0].shape
+    U,theta,theta0,z,z0,zt,z0h,theta_ref = [val.ravel() for val in inputs]
+    dtheta = theta - theta0
+    logz = np.log(z/z0)
+    logzt = np.log(zt/z0h)
+
+    invL = np.zeros(U.shape)
+    ustar = kappa * U / logz
+    thetastar = kappa * dtheta / logzt
+    converged = np.zeros(U.shape, dtype=bool)
+    active = np.arange(U.size)
+    niter = 0
+    while (niter < max_iter) and (active.size > 0):
+        niter += 1
+        zeta = np.clip(z[active]*invL[active], -zeta_max, zeta_max)
+        invL_act = zeta / z[active]
+        us = kappa * U[active] / (logz[active] - psi_m(zeta)
+                                  + psi_m(z0[active]*invL_act))
+        ts = kappa * dtheta[active] / (logzt[active]
+                                       - psi_h(zt[active]*invL_act)
+                                       + psi_h(z0h[active]*invL_act))
+        newinvL = kappa * g * ts / (theta_ref[active] * us**2)
+        newzeta = np.clip(z[active]*newinvL, -zeta_max, zeta_max)
+        ustar[active] = us
+        thetastar[active] = ts
+        invL[active] = newinvL
+        done = np.abs(newzeta - zeta) <= tol*(1 + np.abs(newzeta))
+        converged[active[done]] = True
+        active = active[~done]
+
+    with np.errstate(divide='ignore'):
+        L = 1.0 / invL
+    ustar, thetastar, L = [val.reshape(shape) for val in (ustar,thetastar,L)]
+    if shape == ():
+        ustar, thetastar, L = float(ustar), float(thetastar), float(L)
+    if full_output:
+        info = dict(iterations=niter, converged=converged.reshape(shape))
+        return ustar, thetastar, L, info
+    else:
+        return ustar, thetastar, L
+
+def wind_profile(z,ustar,L,z0,psi_m=Jimenez_m):
+    """Similarity-theory wind speed profiles
+
+    Parameters
+    ==========
+    z : array-like
+        Heights [m] at which to evaluate the profiles
+    ustar, L, z0 : float or array-like
+        Friction velocity [m/s], Obukhov length [m], and roughness
+        length [m] for one or more profiles
+    psi_m : callable, optional
+        Momentum similarity function of z/L
+
+    Returns
+    =======
+    U : np.ndarray
+        Wind speeds with dimensions (..., height), where the leading
+        dimensions are those of the (broadcasted) profile parameters
+    """
+    z = np.asarray(z, dtype=float)
+    ustar,L,z0 = [np.asarray(val, dtype=float)[...,np.newaxis]
+                  for val in (ustar,L,z0)]
+    return ustar/kappa * (np.log(z/z0) - psi_m(z/L) + psi_m(z0/L))
+
+def temperature_profile(z,thetastar,L,z0h,theta0,psi_h=Jimenez_h):
+    """Similarity-theory potential temperature profiles
+
+    Parameters
+    ==========
+    z : array-like
+        Heights [m] at which to evaluate the profiles
+    thetastar, L, z0h, theta0 : float or array-like
+        Temperature scale [K], Obukhov length [m], roughness length for
+        heat [m], and surface potential temperature [K] for one or more
+        profiles
+    psi_h : callable, optional
+        Heat similarity function of z/L
+
+    Returns
+    =======
+    theta : np.ndarray
+        Potential temperatures with dimensions (..., height), where the
+        leading dimensions are those of the (broadcasted) profile
+        parameters
+    """
+    z = np.asarray(z, dtype=float)
+    thetastar,L,z0h,theta0 = [np.asarray(val, dtype=float)[...,np.newaxis]
+                              for val in (thetastar,L,z0h,theta0)]
+    return theta0 + thetastar/kappa * (np.log(z/z0h) - psi_h(z/L)
+                                       + psi_h(z0h/L))
+
+def fit_roughness_length(z,values,L=np.inf,psi=Jimenez_m,offset=0.0,
+                         max_iter=10):
+    """Fit log profiles to one or more measured profiles by least
+    squares, given the Obukhov length, to estimate the scaling
+    parameter (ustar or thetastar) and roughness length (z0 or z0h)
+
+        values - offset = star/kappa * (log(z/z0) - psi(z/L) + psi(z0/L))
+
+    The psi(z0/L) term is accounted for by fixed-point iteration on z0,
+    starting from the fit that neglects it. Missing values (NaN) are
+    ignored.
+
+    Parameters
+    ==========
+    z : array-like
+        Measurement heights [m]
+    values : array-like
+        Wind speeds or potential temperatures with dimensions
+        (..., height)
+    L : float or array-like, optional
+        Obukhov length [m] for each profile; neutral by default
+    psi : callable, optional
+        Similarity function, e.g., Jimenez_m for wind speed or
+        Jimenez_h for potential temperature
+    offset : float or array-like, optional
+        Surface value for each profile, e.g., theta0 for potential
+        temperature profiles
+    max_iter : int, optional
+        Number of iterations to account for psi(z0/L)
+
+    Returns
+    =======
+    star, z0 : float or np.ndarray
+        Scaling parameter and roughness length for each profile
+    """
+    z = np.asarray(z, dtype=float)
+    L = np.asarray(L, dtype=float)[...,np.newaxis]
+    offset = np.asarray(offset, dtype=float)[...,np.newaxis]
+    y = np.asarray(values, dtype=float) - offset
+    x = np.log(z) - psi(z/L)
+    x, y = np.broadcast_arrays(x, y)
+    valid = np.isfinite(x) & np.isfinite(y)
+    n = np.sum(valid, axis=-1)
+    x = np.where(valid, x, 0.0)
+    y = np.where(valid, y, 0.0)
+    xmean = np.sum(x, axis=-1) / n
+    ymean = np.sum(y, axis=-1) / n
+    xdev = np.where(valid, x - xmean[...,np.newaxis], 0.0)
+    slope = np.sum(xdev*y, axis=-1) / np.sum(xdev**2, axis=-1)
+    intercept = ymean - slope*xmean
+    star = kappa * slope
+    logz0 = -intercept/slope
+    invL = np.broadcast_to(1.0/L[...,0], logz0.shape)
+    for _ in range(max_iter):
+        zeta0 = np.atleast_1d(np.exp(logz0) * invL)
+        logz0 = -intercept/slope + psi(zeta0).reshape(logz0.shape)
+    z0 = np.exp(logz0)
+    if star.ndim == 0:
+        star, z0 = float(star), float(z0)
+    return star, z0
@@ -11,6 +11,7 @@ import f90nml
 
 from .utils import Tower
 from .utils import combine_towers
+from ..datawriters import write_dataset
 
 def read_tslist(fpath,
                 snap_to_grid=None,grid_order='F',max_shift=1e-3,
@@ -570,7 +571,7 @@ class TowerArray(object):
         # save
         time0 = time.time()
         if outfile is not None:
-            ds.to_netcdf(outfile)
+            write_dataset(ds, outfile)
         totaltime1 = time.time()
         if self.verbose:
             print('  xarray output time = {:g}s'.format(totaltime1-time0))
@@ -0,0 +1,49 @@
+"""
+Tests for the streaming netCDF writer
+"""
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+from mmctools.datawriters import NetCDFStreamWriter
+
+variables = {'wspd': ('height',), 'ustar': ()}
+dims = {'height': [10., 50., 100.]}
+
+
+def write_records(out, times, offset=0.0):
+    N = len(times)
+    out.append(times,
+               wspd=offset + np.arange(3*N, dtype=float).reshape((N,3)),
+               ustar=offset + np.arange(N, dtype=float))
+
+
+@pytest.mark.parametrize('start', [0, 20])
+def test_restart(tmp_path, start):
+    fpath = str(tmp_path / 'stream.nc')
+    times = pd.date_range('2020-01-01', periods=50, freq='1min')
+    with NetCDFStreamWriter(fpath, variables, dims=dims) as out:
+        write_records(out, times)
+    # resume after the last committed record, leaving stale records
+    with NetCDFStreamWriter(fpath, variables, mode='a', start=start) as out:
+        write_records(out, times[start:start+10], offset=1000.0)
+    nrec = start + 10
+    with xr.open_dataset(fpath) as ds:
+        assert ds.sizes['datetime'] == 50
+        assert np.all(ds['datetime'].values[:nrec] == times[:nrec].values)
+        assert np.all(np.isnat(ds['datetime'].values[nrec:]))
+        assert np.all(ds['ustar'].values[:start] == np.arange(start))
+        assert np.all(ds['ustar'].values[start:nrec] == 1000 + np.arange(10))
+        assert np.all(np.isnan(ds['ustar'].values[nrec:]))
+        assert np.all(np.isnan(ds['wspd'].values[nrec:]))
+        assert ds['wspd'].dims == ('datetime','height')
+
+def test_high_rate_times(tmp_path):
+    fpath = str(tmp_path / 'stream.nc')
+    times = pd.date_range('2020-01-01', periods=1000, freq='50ms')
+    with NetCDFStreamWriter(fpath, variables, dims=dims) as out:
+        for i in range(0,1000,100):
+            write_records(out, times[i:i+100])
+    with xr.open_dataset(fpath) as ds:
+        assert np.all(ds['datetime'].values == times.values)
@@ -0,0 +1,37 @@
+"""
+Tests for the model output analysis helpers
+"""
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+from mmctools.helper_functions import lowess_smooth, model4D_calcQOIs
+
+
+@pytest.fixture
+def ds():
+    """Synthetic 4D model output with dimensions (datetime,nz,ny,nx)"""
+    rng = np.random.default_rng(0)
+    dims = ('datetime','nz','ny','nx')
+    shape = (40,3,2,4)
+    coords = {'datetime': pd.date_range('2020-01-01', periods=shape[0], freq='1s')}
+    data = {varn: (dims, rng.normal(size=shape))
+            for varn in ['u','v','w','theta','wspd','wdir','p']}
+    return xr.Dataset(data, coords=coords)
+
+
+def test_lowess_smooth_dims(ds):
+    smooth = lowess_smooth(ds['u'], 10)
+    assert smooth.dims == ds['u'].dims
+    smooth = lowess_smooth(ds['u'].chunk({'nz':1}), 10).compute()
+    assert smooth.dims == ds['u'].dims
+
+@pytest.mark.parametrize('method', ['tricube','statsmodels'])
+def test_lowess_means_dims(ds, method):
+    if method == 'statsmodels':
+        pytest.importorskip('statsmodels')
+    qois = model4D_calcQOIs(ds.copy(), 'datetime', mean_opt='lowess',
+                            lowess_window=10, lowess_method=method)
+    for varn in ['uMean','vMean','wMean','thetaMean','UMean','pMean','uu','wth']:
+        assert qois[varn].dims == ds['u'].dims, varn
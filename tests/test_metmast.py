@@ -0,0 +1,29 @@
+"""
+Tests for the met mast data readers
+"""
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+from mmctools.measurements.metmast import read_data
+
+
+def test_read_data_string_functions(tmp_path):
+    fpath = tmp_path / 'sonic.csv'
+    fpath.write_text('\n'.join([
+        '2020-01-01 00:00:00,1.5,0.0,0.25:ok, A ',
+        '2020-01-01 00:00:01,0.0,2.5,0.5:ok, B',
+        '2020-01-01 00:00:02,3.0,4.0,1.0:flag,C ',
+    ]) + '\n')
+    column_spec = OrderedDict([
+        ('datetime', '%Y-%m-%d %H:%M:%S'),
+        ('u', 1),
+        ('v', 1),
+        ('w', lambda s: float(s.split(':')[0])),
+        ('station', lambda x: x.strip()),
+    ])
+    df = read_data(str(fpath), column_spec, header=None)
+    assert np.all(df.index == pd.date_range('2020-01-01', periods=3, freq='1s'))
+    assert np.allclose(df['wspd'], [1.5, 2.5, 5.0])
+    assert np.allclose(df['w'], [0.25, 0.5, 1.0])
+    assert list(df['station']) == ['A', 'B', 'C']
@@ -0,0 +1,86 @@
+"""
+Round-trip tests for the legacy MMC ascii writer
+"""
+import numpy as np
+import pandas as pd
+import xarray
+import pytest
+
+from mmctools.mmcdata import MMCData, write_ascii, ascii_columns
+
+description = {
+    'institution': 'NREL',
+    'location': 'SWiFT',
+    'latitude': 33.6105,
+    'longitude': -102.0505,
+    'codename': 'WRF',
+    'codetype': 'mesoscale',
+    'casename': 'diurnal',
+    'benchmark': 'test',
+}
+
+# decimal places written for each column in `ascii_columns`
+precision = [3,3,3,3,2,2,3,5,5,5,5,5,5,5]
+
+
+@pytest.fixture
+def ds():
+    """Synthetic dataset with all legacy columns and surface fields"""
+    rng = np.random.default_rng(0)
+    datetime = pd.date_range('2013-11-08 00:00', periods=25, freq='10min')
+    height = np.array([10., 50., 100., 200.])
+    Nt, Nz = len(datetime), len(height)
+    data = {}
+    for varn in ascii_columns[1:]:
+        data[varn] = (('datetime','height'), rng.uniform(-5, 5, (Nt,Nz)))
+    data['theta'] = (('datetime','height'), 300 + rng.uniform(0, 5, (Nt,Nz)))
+    data['pres'] = (('datetime','height'), 1000 - rng.uniform(0, 30, (Nt,Nz)))
+    for varn in ['ustar','z0','T0','qwall']:
+        data[varn] = (('datetime',), rng.uniform(0, 1, Nt))
+    return xarray.Dataset(data, coords={'datetime':datetime, 'height':height})
+
+
+def check_roundtrip(ds, fpath):
+    mmc = MMCData(asciifile=str(fpath))
+    # header
+    assert mmc.description['lab'] == description['institution']
+    for key in ['location','codename','codetype','casename','benchmark']:
+        assert mmc.description[key] == description[key]
+    assert mmc.description['latitude'] == pytest.approx(description['latitude'], abs=1e-4)
+    assert mmc.description['longitude'] == pytest.approx(description['longitude'], abs=1e-4)
+    assert mmc.description['levels'] == ds.sizes['height']
+    # datetimes
+    assert mmc.dataSetLength == ds.sizes['datetime']
+    assert np.all(pd.DatetimeIndex(mmc.dataDict['datetime']) == ds['datetime'].values)
+    # profile fields
+    Nt = ds.sizes['datetime']
+    heights = np.tile(ds['height'].values, (Nt,1))
+    assert np.allclose(mmc.dataDict['z'], heights, rtol=0, atol=0.5e-3)
+    for varn,ndigits in zip(ascii_columns[1:], precision[1:]):
+        assert np.allclose(mmc.dataDict[varn], ds[varn].values,
+                           rtol=0, atol=0.5*10**-ndigits*(1+1e-6)), varn
+    # surface values
+    for varn,recname in [('ustar','ustar'),('z0','z0'),('T0','tskin'),('qwall','hflux')]:
+        values = [rec[recname] for rec in mmc.records]
+        assert np.allclose(values, ds[varn].values, rtol=0, atol=0.5e-5*(1+1e-6)), varn
+
+
+def test_write_ascii(ds, tmp_path):
+    fpath = tmp_path / 'test.dat'
+    write_ascii(ds, str(fpath), description, chunksize=7)
+    check_roundtrip(ds, fpath)
+
+def test_write_ascii_gzip(ds, tmp_path):
+    fpath = tmp_path / 'test.dat.gz'
+    write_ascii(ds, str(fpath), description, chunksize=7)
+    with open(fpath,'rb') as f:
+        assert f.read(2) == b'\x1f\x8b'
+    check_roundtrip(ds, fpath)
+
+def test_write_ascii_parallel(ds, tmp_path):
+    fpath = tmp_path / 'test.dat'
+    write_ascii(ds, str(fpath), description, chunksize=7, nprocs=2)
+    check_roundtrip(ds, fpath)
+    serial = tmp_path / 'serial.dat'
+    write_ascii(ds, str(serial), description, chunksize=7)
+    assert fpath.read_text() == serial.read_text()